@@ -7,212 +7,409 @@ Flask API для определения возраста по фотографи
 
 import os
 import base64
-import io
-import numpy as np
-import requests
-from datetime import datetime
-from flask import Flask, request, jsonify
+import time
+from datetime import datetime, timezone
+from flask import Flask, Response, g, request, jsonify, send_file
 from flask_cors import CORS
-from PIL import Image, ImageDraw, ImageFont
-from insightface.app import FaceAnalysis
+from facepp_client import FaceppClient, FaceppError, FACEPP_API_URL, face_from_result
+from result_cache import ResultCache, content_hash, AGE_CACHE_ENABLED
+from circuit_breaker import CircuitBreaker, OPEN
+from request_images import ImageInputError, read_image_bytes, read_collage_request, read_photo_id
+from image_limits import check_image, check_rows, body_limit, body_too_large, REQUEST_MAX_BYTES
+from provider_payload import prepare_payload, FACEPP_LIMITS
+from image_ingest import decode_bgr, DETECTOR_SIDE
+from inference_batcher import InferenceBatcher
+from inference_server import InferenceClient
+from model_loader import load_face_app, Readiness, AGE_MODEL_MODE, AGE_INFERENCE_SOCKET
+from collage import render_collage, stream_collage_response, parse_quality
+from tile_cache import tile_cache
+from collage_output import OutputFormatError, negotiate_format, content_type, save_options
+from hedging import Hedger, HedgeTimeout, AGE_HEDGE_ENABLED
+from collage_jobs import CollageJobQueue, QUEUED, DONE, FAILED
+from photo_store import PhotoStore
+from metrics import RequestTimer, record_estimate, set_model_load_seconds, route_label, export_metrics
+from stage_timings import stage
+from structured_log import get_logger, setup_logging, start_request
+
+# JSON логи через фоновый поток (stdout → journald)
+setup_logging()
+log = get_logger(__name__)
 
 app = Flask(__name__)
 CORS(app)  # Разрешаем CORS для фронтенда
 
+# Chunked тело больше лимита обрывается при чтении (Content-Length проверяет reject_large_body)
+app.config['MAX_CONTENT_LENGTH'] = REQUEST_MAX_BYTES
+
 # Face++ API credentials
 FACEPP_API_KEY = os.environ.get('FACEPP_API_KEY', '')
 FACEPP_API_SECRET = os.environ.get('FACEPP_API_SECRET', '')
-FACEPP_API_URL = 'https://api-us.faceplusplus.com/facepp/v3/detect'
 
-# InsightFace app (fallback)
+# Face++ клиент (один на worker, keep-alive пул соединений)
+facepp_client = None
+
+# Circuit breakers внешних провайдеров
+breakers = {
+    'facepp': CircuitBreaker('facepp')
+}
+
+# Hedging Face++ → InsightFace (локальная модель загружается и при наличии Face++)
+hedger = Hedger('facepp', 'insightface') if AGE_HEDGE_ENABLED else None
+
+# Общий для всех workers кэш результатов (по хэшу изображения)
+result_cache = ResultCache() if AGE_CACHE_ENABLED else None
+
+# Очередь асинхронных коллажей (рендерит collage_worker.py)
+collage_queue = CollageJobQueue()
+
+# Загруженные фото, на которые ссылаются по photoId
+photo_store = PhotoStore()
+
+# InsightFace app (fallback) и micro-batching очередь инференса
+# (или клиент inference server в режиме AGE_MODEL_MODE=server)
 face_app = None
+inference_batcher = None
 model_loaded = False
-use_facepp = bool(FACEPP_API_KEY and FACEPP_API_SECRET)
+model_load_seconds = None
+
+# loading → warming → ready (/health, /ready)
+readiness = Readiness()
 
 def load_insightface_model():
     """Загрузка InsightFace модели для определения возраста (fallback если Face++ недоступен)"""
-    global face_app, model_loaded, use_facepp
+    global face_app, inference_batcher, model_loaded, model_load_seconds, facepp_client
     
     # Проверяем Face++ credentials
     if FACEPP_API_KEY and FACEPP_API_SECRET:
-        print('✅ Face++ API configured (primary method)')
-        print(f'   API Key: {FACEPP_API_KEY[:8]}...')
+        log.info('✅ Face++ API configured (primary method), API Key: %s...', FACEPP_API_KEY[:8])
+        if facepp_client is None:
+            facepp_client = FaceppClient(FACEPP_API_KEY, FACEPP_API_SECRET, FACEPP_API_URL)
+        model_loaded = True
+        if hedger is None:
+            readiness.set_ready()
+            return True
+        log.info('🏁 Hedging enabled: loading InsightFace as hedge target')
+    
+    # Модель в отдельном процессе: worker только подключается к сокету
+    if AGE_MODEL_MODE == 'server':
+        log.info('🔌 Using inference server at %s', AGE_INFERENCE_SOCKET)
+        inference_batcher = InferenceClient(AGE_INFERENCE_SOCKET)
         model_loaded = True
-        use_facepp = True
+        readiness.warm_up(inference_batcher)
         return True
     
     # Fallback на InsightFace если Face++ недоступен
     try:
-        print('⚠️ Face++ not configured, loading InsightFace as fallback...')
-        face_app = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-        face_app.prepare(ctx_id=-1, det_size=(640, 640))
+        log.info('🔄 Loading InsightFace (%s)...', AGE_MODEL_MODE)
+        face_app, model_load_seconds = load_face_app(fork_safe=AGE_MODEL_MODE == 'preload')
+        inference_batcher = InferenceBatcher(face_app)
         model_loaded = True
-        use_facepp = False
-        print('✅ InsightFace buffalo_l model loaded successfully (fallback method)')
+        set_model_load_seconds(model_load_seconds)
+        log.info('✅ InsightFace buffalo_l model loaded in %.1fs (fallback method)', model_load_seconds)
+        # Синтетические запросы до приёма трафика (worker принимает соединения после импорта)
+        readiness.warm_up(inference_batcher)
         return True
     except Exception as e:
-        print(f'❌ Failed to load InsightFace model: {e}')
-        import traceback
-        traceback.print_exc()
+        log.exception('❌ Failed to load InsightFace model: %s', e)
+        if facepp_client is not None:
+            # Hedging без второго провайдера: запросы обслуживает Face++
+            readiness.set_ready()
+        else:
+            readiness.set_failed(e)
         return False
 
-def estimate_age(image):
+def _estimate_facepp(image_bytes, image_hash=None, cancel=None):
     """
-    Определение возраста по изображению
-    Использует Face++ API (primary) или InsightFace (fallback)
+    Определение возраста через Face++ API (вызов уже разрешён circuit breaker)
+
+    Возвращает: dict {'age', 'gender', 'provider'} или None, если лицо не найдено
+    Бросает: исключение при ошибке Face++ (breaker уже учёл результат)
+    """
+    breaker = breakers['facepp']
+    
+    # Hedged запрос уже выиграл InsightFace — Face++ не вызываем
+    if cancel is not None and cancel.is_set():
+        breaker.release()
+        raise HedgeTimeout('Cancelled')
+    
+    started = time.perf_counter()
+    try:
+        log.debug('🔍 Using Face++ API for age estimation...')
+        
+        # Исходный файл, если он укладывается в лимиты Face++,
+        # иначе уменьшенный JPEG в бюджете 2 MB
+        with stage('payload'):
+            payload = prepare_payload(image_bytes, FACEPP_LIMITS, image_hash)
+        
+        # Запрос к Face++ API (keep-alive пул + повторы с jitter)
+        with stage('facepp'):
+            result = facepp_client.detect(payload)
+        
+    except FaceppError as e:
+        if e.is_client_error:
+            # Face++ исправен, но не принял фото — breaker не трогаем
+            breaker.record_success(time.perf_counter() - started)
+        else:
+            breaker.record_failure(time.perf_counter() - started)
+        record_estimate('facepp', 'error')
+        log.warning('⚠️ Face++ error: %s', e)
+        raise
+    except Exception as e:
+        breaker.record_failure(time.perf_counter() - started)
+        record_estimate('facepp', 'error')
+        log.error('❌ Face++ error: %s', e)
+        raise
+    
+    breaker.record_success(time.perf_counter() - started)
+    
+    face = face_from_result(result)
+    if face is None:
+        record_estimate('facepp', 'no_face')
+        log.info('⚠️ No face detected by Face++')
+        return None
     
-    Возвращает: возраст (int) или None при ошибке
+    record_estimate('facepp', 'ok')
+    log.info('✅ Face++ estimated age: %s, gender: %s', face['age'], face['gender'],
+             extra={'provider': 'facepp', 'age': face['age'], 'gender': face['gender']})
+    return {'age': face['age'], 'gender': face['gender'], 'provider': 'facepp'}
+
+def _estimate_insightface(image_bytes, cancel=None):
+    """
+    Определение возраста локальной моделью InsightFace
+
+    Возвращает: dict {'age', 'gender', 'provider'} или None, если лицо не найдено
     """
-    global use_facepp
+    if cancel is not None and cancel.is_set():
+        raise HedgeTimeout('Cancelled')
     
-    # Метод 1: Face++ API (предпочтительный)
-    if use_facepp:
+    log.debug('🔍 Using InsightFace for age estimation...')
+    
+    try:
+        # Декодируем сразу в BGR в масштабе детектора (640 px)
+        with stage('decode'):
+            img_bgr, info = decode_bgr(image_bytes, DETECTOR_SIDE)
+        log.debug('📸 Input shape: %s (from %s, decode %s ms)', img_bgr.shape, info['original_size'], info['decode_ms'])
+        
+        # Hedged запрос: Face++ уже ответил — модель не запускаем
+        if cancel is not None and cancel.is_set():
+            raise HedgeTimeout('Cancelled')
+        
+        # Детекция + genderage батчем вместе с параллельными запросами
+        with stage('inference'):
+            face = inference_batcher.estimate(img_bgr)
+    except HedgeTimeout:
+        raise
+    except Exception:
+        record_estimate('insightface', 'error')
+        raise
+    
+    if face is None:
+        record_estimate('insightface', 'no_face')
+        log.info('⚠️ No face detected by InsightFace')
+        return None
+    
+    record_estimate('insightface', 'ok')
+    log.info('✅ InsightFace estimated age: %s, gender: %s', face['age'], face['gender'],
+             extra={'provider': 'insightface', 'age': face['age'], 'gender': face['gender']})
+    return {'age': face['age'], 'gender': face['gender'], 'provider': 'insightface'}
+
+def _estimate_hedged(image_bytes, image_hash=None):
+    """
+    Face++ с hedging: если Face++ не ответил за p90 своей латентности
+    (или упал), параллельно запускается InsightFace; побеждает первый ответ
+    """
+    delay = hedger.hedge_delay(facepp_client.latency_percentile(hedger.percentile))
+    try:
+        winner, result = hedger.run(
+            lambda cancel: _estimate_facepp(image_bytes, image_hash, cancel),
+            lambda cancel: _estimate_insightface(image_bytes, cancel),
+            delay
+        )
+    except Exception as e:
+        log.error('❌ Hedged estimation failed: %s', e)
+        return None
+    
+    log.debug('🏆 Hedged winner: %s', winner)
+    if winner == 'insightface':
+        record_estimate('facepp', 'fallback')
+    return result
+
+def estimate_age(image_bytes, image_hash=None):
+    """
+    Определение возраста по изображению (байты файла)
+    Использует Face++ API (primary) или InsightFace (fallback),
+    с AGE_HEDGE_ENABLED=1 — оба с hedging в пределах AGE_LATENCY_BUDGET
+    
+    Возвращает: dict {'age': int, 'gender': str, 'provider': str} или None при ошибке
+    """
+    # Метод 1: Face++ API (предпочтительный), если circuit breaker пропускает
+    if facepp_client is not None and breakers['facepp'].allow_request():
+        if hedger is not None and inference_batcher is not None:
+            return _estimate_hedged(image_bytes, image_hash)
         try:
-            print('🔍 Using Face++ API for age estimation...')
-            
-            # Конвертируем PIL Image в bytes
-            img_buffer = io.BytesIO()
-            if isinstance(image, Image.Image):
-                if image.mode != 'RGB':
-                    image = image.convert('RGB')
-                image.save(img_buffer, format='JPEG', quality=95)
-            else:
-                # Если numpy array, конвертируем через PIL
-                img_pil = Image.fromarray(image)
-                img_pil.save(img_buffer, format='JPEG', quality=95)
-            
-            img_buffer.seek(0)
-            image_bytes = img_buffer.read()
-            
-            print(f'📸 Image size: {len(image_bytes)} bytes')
-            
-            # Запрос к Face++ API
-            files = {'image_file': ('image.jpg', image_bytes, 'image/jpeg')}
-            payload = {
-                'api_key': FACEPP_API_KEY,
-                'api_secret': FACEPP_API_SECRET,
-                'return_attributes': 'age,gender'
-            }
-            
-            response = requests.post(FACEPP_API_URL, data=payload, files=files, timeout=30)
-            
-            if response.status_code != 200:
-                print(f'⚠️ Face++ API error: {response.status_code}, falling back to InsightFace')
-                use_facepp = False  # Временно переключаемся на fallback
-                return estimate_age(image)  # Retry with InsightFace
-            
-            result = response.json()
-            
-            if 'error_message' in result:
-                print(f'⚠️ Face++ error: {result["error_message"]}, falling back')
-                use_facepp = False
-                return estimate_age(image)
-            
-            if 'faces' not in result or len(result['faces']) == 0:
-                print('⚠️ No face detected by Face++')
-                return None
-            
-            face = result['faces'][0]
-            age = face['attributes']['age']['value']
-            gender = face['attributes'].get('gender', {}).get('value', 'Unknown')
-            
-            print(f'✅ Face++ estimated age: {age}, gender: {gender}')
-            return int(age)
-            
-        except Exception as e:
-            print(f'❌ Face++ error: {e}, falling back to InsightFace')
-            use_facepp = False
-            # Продолжаем с InsightFace fallback
+            return _estimate_facepp(image_bytes, image_hash)
+        except Exception:
+            log.warning('⚠️ Falling back to InsightFace')
     
     # Метод 2: InsightFace (fallback)
-    if face_app is None:
-        print('❌ No age estimation method available')
+    if inference_batcher is None:
+        log.error('❌ No age estimation method available')
         return None
     
+    if facepp_client is not None:
+        # Face++ настроен, но breaker открыт или запрос упал
+        record_estimate('facepp', 'fallback')
+    
     try:
-        print('🔍 Using InsightFace for age estimation (fallback)...')
-        
-        # Конвертируем PIL Image в numpy array (BGR)
-        if isinstance(image, Image.Image):
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            img_array = np.array(image)
-        else:
-            img_array = image
-        
-        img_bgr = img_array[:, :, ::-1]
-        print(f'📸 Input shape: {img_bgr.shape}')
-        
-        faces = face_app.get(img_bgr)
-        
-        if len(faces) == 0:
-            print('⚠️ No face detected by InsightFace')
-            return None
-        
-        face = faces[0]
-        estimated_age = int(face.age)
-        
-        print(f'✅ InsightFace estimated age: {estimated_age}')
-        return estimated_age
-        
+        return _estimate_insightface(image_bytes)
     except Exception as e:
-        print(f'❌ InsightFace error: {e}')
-        import traceback
-        traceback.print_exc()
+        log.exception('❌ InsightFace error: %s', e)
         return None
 
+@app.before_request
+def start_request_log():
+    # Correlation id и уровень логирования запроса (X-Debug-Log — DEBUG для одного запроса)
+    g.request_id = start_request(request.headers.get('X-Request-ID'), request.headers.get('X-Debug-Log'))
+
+@app.before_request
+def start_request_timer():
+    if request.path != '/metrics':
+        rule = request.url_rule
+        g.request_timer = RequestTimer(route_label(rule.rule) if rule else 'unmatched', request.method)
+
+@app.before_request
+def reject_large_body():
+    # 413 до чтения тела: лимит маршрута (одно фото или коллаж) по Content-Length
+    limit = body_limit(request.path)
+    if request.content_length is not None and request.content_length > limit:
+        log.info('🚫 Request body too large: %d bytes (limit %d)', request.content_length, limit)
+        return jsonify({'error': body_too_large(limit)}), 413
+
+@app.after_request
+def finish_request_timer(response):
+    timer = g.pop('request_timer', None)
+    if timer is not None:
+        # Потоковый ответ коллажа ещё не отправлен — время фиксируется при закрытии
+        response.call_on_close(lambda: timer.finish(response.status_code))
+    return response
+
+@app.after_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def abort_request_timer(error):
+    # after_request не вызывался (необработанное исключение)
+    timer = g.pop('request_timer', None)
+    if timer is not None:
+        timer.finish(500)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики Prometheus (всех gunicorn workers при PROMETHEUS_MULTIPROC_DIR)"""
+    body, metrics_type = export_metrics()
+    return Response(body, content_type=metrics_type)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверка здоровья сервиса"""
-    provider = 'Face++ API' if use_facepp else 'InsightFace (fallback)'
+    if facepp_client is not None and breakers['facepp'].state != OPEN:
+        provider = 'Face++ API'
+    else:
+        provider = 'InsightFace (fallback)'
     return jsonify({
         'status': 'ok',
+        'readiness': readiness.stats(),
         'model_loaded': model_loaded,
-        'provider': provider
+        'model_mode': AGE_MODEL_MODE,
+        'model_load_seconds': round(model_load_seconds, 2) if model_load_seconds else None,
+        'pid': os.getpid(),
+        'provider': provider,
+        'facepp': facepp_client.stats() if facepp_client else None,
+        'cache': result_cache.stats() if result_cache else None,
+        'tile_cache': tile_cache.stats() if tile_cache else None,
+        'breakers': {name: breaker.stats() for name, breaker in breakers.items()},
+        'inference': inference_batcher.stats() if inference_batcher else None,
+        'hedging': hedger.stats() if hedger else None,
+        'collage_jobs': collage_queue.stats(),
+        'photos': photo_store.stats()
     })
 
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    """Готовность worker'а (модель загружена и прогрета): 200 или 503 — для деплоя и балансировщика"""
+    return jsonify(readiness.stats()), 200 if readiness.ready else 503
+
 @app.route('/api/estimate-age', methods=['POST'])
 def estimate_age_endpoint():
     """
     Endpoint для определения возраста
     
-    Request JSON:
+    Request (любой из вариантов):
+    - multipart/form-data, файл в поле "image"
+    - сырое тело с Content-Type: image/jpeg (image/png, ...)
+    - JSON (старые клиенты):
     {
         "image": "base64_encoded_image_data"
     }
+    - JSON {"photoId": "..."} — фото, загруженное через POST /api/photos
     
     Response JSON:
     {
         "age": 35,
-        "confidence": 0.95
+        "gender": "Female",
+        "confidence": 0.95,
+        "cached": false
     }
     """
     try:
-        # Получаем данные
-        data = request.get_json()
-        
-        if not data or 'image' not in data:
-            return jsonify({'error': 'No image provided'}), 400
+        # Фото из photo_store: результат определения хранится вместе с фото
+        photo_id = read_photo_id(request)
+        photo = photo_store.get(photo_id) if photo_id else None
+        if photo_id and photo is None:
+            return jsonify({'error': f'Unknown or expired photoId: {photo_id}'}), 404
         
-        # Декодируем base64 изображение
-        image_data = data['image']
-        
-        # Убираем data:image prefix если есть
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        # Декодируем
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Конвертируем в RGB если нужно
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        # Получаем байты изображения (multipart, raw или base64 JSON)
+        try:
+            with stage('read'):
+                image_bytes = photo_store.read_file(photo_id) if photo else read_image_bytes(request)
+        except ImageInputError as e:
+            return jsonify({'error': str(e)}), e.status
+        if image_bytes is None:
+            return jsonify({'error': f'Unknown or expired photoId: {photo_id}'}), 404
+        
+        # Повторно присланное фото — отдаём результат из кэша без декодирования
+        cache_key = photo_id if photo else content_hash(image_bytes)
+        cached = photo['detection'] if photo else None
+        if cached is None and result_cache:
+            cached = result_cache.get(cache_key)
+        if cached is not None:
+            log.info('⚡ Cache hit: age %s (%s)', cached['age'], cached['provider'],
+                     extra={'provider': 'cache', 'age': cached['age']})
+            record_estimate('cache', 'ok')
+            if photo and photo['detection'] is None:
+                photo_store.set_detection(photo_id, cached)
+            return jsonify({
+                'success': True,
+                'age': cached['age'],
+                'gender': cached.get('gender'),
+                'confidence': 0.95,
+                'status': 'success',
+                'cached': True
+            })
+        
+        # Формат, размер и разрешение по заголовку — до декодирования
+        try:
+            with stage('check'):
+                check_image(image_bytes)
+        except ImageInputError as e:
+            return jsonify({'error': str(e)}), e.status
         
-        # Определяем возраст
-        age = estimate_age(image)
+        # Определяем возраст (декодирование — только если нужна локальная модель)
+        result = estimate_age(image_bytes, cache_key)
         
-        if age is None:
+        if result is None:
             return jsonify({
                 'success': False,
                 'message': 'Failed to estimate age',
@@ -220,15 +417,27 @@ def estimate_age_endpoint():
             }), 500
         
         # Возвращаем результат в формате, ожидаемом фронтендом
-        return jsonify({
-            'success': True,
-            'age': age,
-            'confidence': 0.95,
-            'status': 'success'
-        })
-        
+        if result_cache:
+            result_cache.set(cache_key, result)
+        if photo:
+            photo_store.set_detection(photo_id, result)
+        
+        with stage('json'):
+            response = jsonify({
+                'success': True,
+                'age': result['age'],
+                'gender': result['gender'],
+                'confidence': 0.95,
+                'status': 'success',
+                'cached': False
+            })
+        return response
+        
+    except ImageInputError as e:
+        # Тело больше лимита при чтении photoId
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
-        print(f'❌ Error processing request: {e}')
+        log.exception('❌ Error processing request: %s', e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/create-collage', methods=['POST'])
@@ -236,7 +445,19 @@ def create_collage():
     """
     Создание коллажа из загруженных фотографий
     
-    Request JSON (new format):
+    Ответ — JSON с base64 JPEG, либо сырой image/jpeg, image/webp или
+    image/avif, если он запрошен параметром ?format= или заголовком Accept
+    (?effort=fast|balanced|best, ?quality=1..100 — настройки кодировщика)
+    
+    ?quality=preview — мгновенный эскиз (тайлы 300 px, та же раскладка в масштабе),
+    ?quality=final (по умолчанию) — полное качество
+    
+    ?async=1 или Prefer: respond-async — 202 с jobId, рендерит collage_worker.py,
+    результат — GET /api/collage/<jobId> (preview всегда синхронно)
+    
+    Request JSON (new format) или multipart/form-data:
+    поле "data" с тем же JSON + файлы "beforePhoto_<N>" / "afterPhoto_<N>";
+    вместо фото — "beforePhotoId" / "afterPhotoId" из POST /api/photos
     {
         "rows": [
             {"beforePhoto": "base64_img", "afterPhoto": "base64_img", "photoType": "front"},
@@ -252,14 +473,18 @@ def create_collage():
     }
     """
     try:
-        print('🎨 create_collage called')
-        data = request.get_json()
+        log.debug('🎨 create_collage called')
+        try:
+            with stage('read'):
+                data = read_collage_request(request)
+        except ImageInputError as e:
+            return jsonify({'error': str(e)}), e.status
         
         if not data:
-            print('❌ No data provided')
+            log.info('❌ No data provided')
             return jsonify({'error': 'No data provided'}), 400
         
-        print(f'📦 Received data keys: {list(data.keys())}')
+        log.debug('📦 Received data keys: %s', list(data.keys()))
         
         # Поддержка новой структуры с rows
         rows = data.get('rows', [])
@@ -267,305 +492,156 @@ def create_collage():
         if not rows or len(rows) == 0:
             return jsonify({'error': 'No photo rows provided'}), 400
         
-        print(f'📸 Processing {len(rows)} photo rows for collage...')
-        
-        # Декодируем изображения из rows
-        before_images = []
-        after_images = []
-        
-        for idx, row in enumerate(rows):
-            # Обрабатываем фото "До"
-            before_base64 = row.get('beforePhoto')
-            if before_base64:
-                try:
-                    if ',' in before_base64:
-                        before_base64 = before_base64.split(',')[1]
-                    img_bytes = base64.b64decode(before_base64)
-                    img = Image.open(io.BytesIO(img_bytes))
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    before_images.append(img)
-                    print(f'  ✅ Row {idx}: Before photo loaded')
-                except Exception as e:
-                    print(f'  ⚠️ Row {idx}: Failed to load before photo: {e}')
-                    before_images.append(None)
-            else:
-                before_images.append(None)
-                print(f'  ⏭️ Row {idx}: No before photo')
-            
-            # Обрабатываем фото "После"
-            after_base64 = row.get('afterPhoto')
-            if after_base64:
-                try:
-                    if ',' in after_base64:
-                        after_base64 = after_base64.split(',')[1]
-                    img_bytes = base64.b64decode(after_base64)
-                    img = Image.open(io.BytesIO(img_bytes))
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    after_images.append(img)
-                    print(f'  ✅ Row {idx}: After photo loaded')
-                except Exception as e:
-                    print(f'  ⚠️ Row {idx}: Failed to load after photo: {e}')
-                    after_images.append(None)
-            else:
-                after_images.append(None)
-                print(f'  ⏭️ Row {idx}: No after photo')
-        
-        # Извлекаем userInfo и metadata
-        user_info = data.get('userInfo', {})
-        metadata = data.get('metadata', {})
-        username = user_info.get('username', 'Пользователь')
-        site_url = user_info.get('siteUrl', '')
-        print(f'📄 UserInfo: {user_info}')
-        print(f'🌐 Site URL: {site_url}')
-        print(f'📊 Metadata: {list(metadata.keys())}')
-        
-        # Создаём вертикальный коллаж с заголовком и футером
-        # Размеры одного фото в коллаже (КВАДРАТНЫЕ) - Увеличено для лучшего качества
-        photo_size = 800  # квадратные фото 800x800
-        
-        # Отступы (пропорционально увеличены)
-        padding = 30  # отступ между фото в паре
-        row_spacing = 120  # отступ между парами (увеличено для метаданных)
-        border = 60  # рамка по краям
-        header_height = 120  # высота заголовка
-        footer_height = 500  # высота футера с анкетой
-        metadata_height = 50  # высота для метаданных под фото
-        
-        # Определяем количество пар
-        num_pairs = len(rows)
-        
-        # Размер коллажа
-        pair_width = photo_size * 2 + padding
-        collage_width = pair_width + border * 2
-        photos_height = (photo_size + row_spacing) * num_pairs - row_spacing
-        collage_height = header_height + photos_height + footer_height + border * 2
-        
-        # Создаём белый фон
-        collage = Image.new('RGB', (collage_width, collage_height), 'white')
-        draw = ImageDraw.Draw(collage)
-        
-        # Шрифты (увеличенные для 800px фото)
+        # beforePhotoId / afterPhotoId — фото из photo_store;
+        # слишком большие остальные фото — 413 до очереди и рендеринга (битые пропускаются при рендеринге)
         try:
-            font_large = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 48)
-            font_normal = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 36)
-            font_small = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 28)
-            print('✅ Fonts loaded successfully')
-        except Exception as e:
-            print(f'⚠️ Font loading failed: {e}, using default')
-            font_large = ImageFont.load_default()
-            font_normal = ImageFont.load_default()
-            font_small = ImageFont.load_default()
-        
-        # ЗАГОЛОВОК: "Фотодневник | Имя | Дата"
-        current_date = datetime.now().strftime('%d.%m.%Y')
-        header_text = f"Фотодневник | {username} | {current_date}"
-        draw.text((border, 30), header_text, fill='black', font=font_large)
-        
-        # Функция для обрезки изображения в квадрат (для лица: 5% сверху, 15% снизу)
-        def crop_to_square(img):
-            width, height = img.size
-            size = min(width, height)
-            
-            # Центрируем по горизонтали
-            left = (width - size) // 2
-            
-            # Для вертикальной обрезки: 5% отступ сверху для лица
-            if height > width:
-                # Портретная ориентация - смещаем вверх для лица
-                top = int(height * 0.05)  # 5% отступ сверху
-            else:
-                # Горизонтальная или квадратная - центрируем
-                top = (height - size) // 2
-            
-            return img.crop((left, top, left + size, top + size))
-        
-        # Размещаем пары фото (До слева, После справа) с метаданными
-        photos_start_y = header_height + border
-        for i in range(num_pairs):
-            y_position = photos_start_y + i * (photo_size + row_spacing)
-            row = rows[i]
-            photo_type = row.get('photoType', 'front')
-            
-            # Фото "До" (левое)
-            if i < len(before_images) and before_images[i]:
-                img_before = before_images[i].copy()
-                img_before = crop_to_square(img_before)  # Квадратное
-                img_before = img_before.resize((photo_size, photo_size), Image.Resampling.LANCZOS)
-                x_before = border
-                collage.paste(img_before, (x_before, y_position))
-                
-                # Метаданные под фото "До"
-                meta_before = metadata.get('before', {}).get(photo_type, {})
-                exif_before = meta_before.get('exifData') or {}
-                date_time = exif_before.get('DateTime') or exif_before.get('captureDate')
-                upload_date = meta_before.get('uploadDate')
-                
-                if date_time:
-                    # DateTime format: "YYYY:MM:DD HH:MM:SS" or ISO
-                    if ':' in date_time[:10]:
-                        date_str = date_time[:10].replace(':', '.')
-                    else:
-                        date_str = date_time[:10].replace('-', '.')
-                    meta_text = f"↓ Снято: {date_str}"
-                elif upload_date:
-                    # Use upload date as fallback (ISO format)
-                    upload_str = upload_date[:10].replace('-', '.')
-                    meta_text = f"↓ Загружено: {upload_str}"
-                else:
-                    meta_text = f"↓ No EXIF data found (screenshot)"
-                draw.text((x_before + 10, y_position + photo_size + 10), meta_text, fill='#666666', font=font_small)
-            
-            # Фото "После" (правое)
-            if i < len(after_images) and after_images[i]:
-                img_after = after_images[i].copy()
-                img_after = crop_to_square(img_after)  # Квадратное
-                img_after = img_after.resize((photo_size, photo_size), Image.Resampling.LANCZOS)
-                x_after = border + photo_size + padding
-                collage.paste(img_after, (x_after, y_position))
-                
-                # Метаданные под фото "После"
-                meta_after = metadata.get('after', {}).get(photo_type, {})
-                exif_after = meta_after.get('exifData') or {}
-                date_time = exif_after.get('DateTime') or exif_after.get('captureDate')
-                upload_date = meta_after.get('uploadDate')
-                
-                if date_time:
-                    # DateTime format: "YYYY:MM:DD HH:MM:SS" or ISO
-                    if ':' in date_time[:10]:
-                        date_str = date_time[:10].replace(':', '.')
-                    else:
-                        date_str = date_time[:10].replace('-', '.')
-                    meta_text = f"↓ Снято: {date_str}"
-                elif upload_date:
-                    # Use upload date as fallback (ISO format)
-                    upload_str = upload_date[:10].replace('-', '.')
-                    meta_text = f"↓ Загружено: {upload_str}"
-                else:
-                    meta_text = f"↓ No EXIF data found (screenshot)"
-                draw.text((x_after + 10, y_position + photo_size + 10), meta_text, fill='#666666', font=font_small)
-            
-            # Водяной знак: ссылка на фотодневник поверх фотографий внизу по центру
-            if site_url:
-                # Центр между двумя фотографиями (spanning both photos)
-                watermark_x = border + pair_width // 2
-                watermark_y = y_position + photo_size - 45  # Поверх фото снизу
-                
-                # Получаем размер текста для центрирования
-                bbox = draw.textbbox((0, 0), site_url, font=font_small)
-                text_width = bbox[2] - bbox[0]
-                
-                # Рисуем водяной знак с центрированием (без фона)
-                draw.text(
-                    (watermark_x - text_width // 2, watermark_y), 
-                    site_url, 
-                    fill='#999999',  # Серый цвет
-                    font=font_small
-                )
-        
-        # ФУТЕР С АНКЕТОЙ (только заполненные поля)
-        footer_y = photos_start_y + photos_height + 60
-        
-        # Рисуем светлый фон для футера (лучшее визуальное отделение)
-        draw.rectangle(
-            [(border, footer_y - 20), (collage_width - border, collage_height - border)],
-            fill='#f5f5f5',
-            outline='#cccccc',
-            width=2
-        )
-        
-        draw.text((border + 20, footer_y), "Анкета:", fill='black', font=font_normal)
-        
-        # Собираем ВСЕ заполненные поля в порядке как в форме
-        footer_fields = []
-        
-        # Бот определил возраст
-        if user_info.get('botAgeBefore') or user_info.get('botAgeAfter'):
-            bot_ages = []
-            if user_info.get('botAgeBefore'):
-                bot_ages.append(str(user_info['botAgeBefore']))
-            if user_info.get('botAgeAfter'):
-                bot_ages.append(str(user_info['botAgeAfter']))
-            if bot_ages:
-                footer_fields.append(f"Бот определил возраст: {' / '.join(bot_ages)}")
-        
-        # Реальный возраст
-        if user_info.get('realAgeBefore') or user_info.get('realAgeAfter'):
-            ages = []
-            if user_info.get('realAgeBefore'):
-                ages.append(str(user_info['realAgeBefore']))
-            if user_info.get('realAgeAfter'):
-                ages.append(str(user_info['realAgeAfter']))
-            if ages:
-                footer_fields.append(f"Возраст: {' / '.join(ages)}")
-        
-        # Вес
-        if user_info.get('weightBefore') or user_info.get('weightAfter'):
-            weights = []
-            if user_info.get('weightBefore'):
-                weights.append(str(user_info['weightBefore']))
-            if user_info.get('weightAfter'):
-                weights.append(str(user_info['weightAfter']))
-            if weights:
-                footer_fields.append(f"Вес: {' / '.join(weights)} кг")
+            photo_store.resolve_rows(rows)
+            with stage('check'):
+                check_rows(rows)
+        except ImageInputError as e:
+            return jsonify({'error': str(e)}), e.status
         
-        # Рост
-        if user_info.get('heightBefore') or user_info.get('heightAfter'):
-            heights = []
-            if user_info.get('heightBefore'):
-                heights.append(str(user_info['heightBefore']))
-            if user_info.get('heightAfter'):
-                heights.append(str(user_info['heightAfter']))
-            if heights:
-                footer_fields.append(f"Рост: {' / '.join(heights)} см")
-        
-        # Пол
-        if user_info.get('gender'):
-            footer_fields.append(f"Пол: {user_info['gender']}")
-        
-        # Тип кожи
-        if user_info.get('skinType'):
-            footer_fields.append(f"Тип кожи: {user_info['skinType']}")
-        
-        # Процедуры
-        if user_info.get('procedures'):
-            footer_fields.append(f"Процедуры: {user_info['procedures']}")
-        
-        # Комментарии (До и После)
-        if user_info.get('commentsBefore'):
-            footer_fields.append(f"Комментарий До: {user_info['commentsBefore']}")
-        if user_info.get('commentsAfter'):
-            footer_fields.append(f"Комментарий После: {user_info['commentsAfter']}")
-        
-        print(f'📝 Footer fields: {footer_fields}')
-        print(f'📏 Footer position: y={footer_y}, collage_height={collage_height}')
-        
-        line_y = footer_y + 50
-        for field in footer_fields:
-            draw.text((border + 20, line_y), field, fill='black', font=font_small)
-            line_y += 45
-        
-        # Сохраняем в буфер как JPEG с максимальным качеством
-        output = io.BytesIO()
-        collage.save(output, format='JPEG', quality=95, optimize=True)
-        output.seek(0)
-        print(f'✅ Collage created: {collage.size}, {len(output.getvalue())} bytes')
+        # Бинарный ответ, если клиент его принимает
+        try:
+            output_format = negotiate_format(request.headers.get('Accept'), request.args.get('format'))
+            effort = request.args.get('effort')
+            tier, quality = parse_quality(request.args.get('quality'))
+            if output_format:
+                save_options(output_format, effort, quality)
+        except OutputFormatError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        async_requested = request.args.get('async') in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', '')
+        if async_requested and tier == 'final':
+            job_id = collage_queue.submit(data, output_format, effort, quality)
+            log.info('📨 Collage job %s queued: %d rows', job_id, len(rows), extra={'job_id': job_id})
+            status_url = f'/api/collage/{job_id}'
+            return jsonify({
+                'success': True,
+                'jobId': job_id,
+                'status': QUEUED,
+                'statusUrl': status_url
+            }), 202, {'Location': status_url}
+        
+        log.info('📸 Processing %d photo rows for collage (%s)...', len(rows), tier)
+        
+        if output_format:
+            return Response(
+                stream_collage_response(data, output_format, effort, quality, tier),
+                mimetype=content_type(output_format),
+                headers={
+                    'Vary': 'Accept',
+                    'Content-Disposition': f'inline; filename="collage.{output_format}"'
+                }
+            )
+        
+        collage_jpeg = render_collage(data, tier)
         
         # Возвращаем как base64
-        collage_base64 = base64.b64encode(output.getvalue()).decode('utf-8')
+        with stage('base64'):
+            collage_base64 = base64.b64encode(collage_jpeg).decode('utf-8')
         
-        return jsonify({
-            'success': True,
-            'collage': f'data:image/jpeg;base64,{collage_base64}'
-        })
+        with stage('json'):
+            response = jsonify({
+                'success': True,
+                'collage': f'data:image/jpeg;base64,{collage_base64}'
+            })
+        return response
         
     except Exception as e:
-        print(f'❌ Error creating collage: {e}')
-        import traceback
-        traceback.print_exc()
+        log.exception('❌ Error creating collage: %s', e)
         return jsonify({'error': str(e)}), 500
 
+def photo_response(info):
+    """Метаданные фото из photo_store для ответа клиенту"""
+    return {
+        'success': True,
+        'photoId': info['id'],
+        'format': info['format'],
+        'width': info['width'],
+        'height': info['height'],
+        'thumbnailUrl': f'/api/photos/{info["id"]}/thumbnail',
+        'expiresAt': datetime.fromtimestamp(info['expires'], timezone.utc).isoformat(timespec='seconds'),
+        'detection': info['detection']
+    }
+
+@app.route('/api/photos', methods=['POST'])
+def upload_photo():
+    """
+    Загрузка фото в photo_store (форматы запроса как у /api/estimate-age)
+    
+    Ответ: photoId — ссылка на фото для /api/estimate-age ({"photoId": ...})
+    и строк /api/create-collage ("beforePhotoId" / "afterPhotoId"),
+    миниатюра и результат определения возраста, если он уже известен
+    """
+    try:
+        try:
+            with stage('read'):
+                image_bytes = read_image_bytes(request)
+            with stage('store'):
+                info = photo_store.put(image_bytes)
+        except ImageInputError as e:
+            return jsonify({'error': str(e)}), e.status
+        return jsonify(photo_response(info)), 201
+    except Exception as e:
+        log.exception('❌ Error storing photo: %s', e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/photos/<photo_id>', methods=['GET'])
+def get_photo(photo_id):
+    """Метаданные загруженного фото (продлевает срок хранения)"""
+    info = photo_store.get(photo_id)
+    if info is None:
+        return jsonify({'error': 'Photo not found or expired'}), 404
+    return jsonify(photo_response(info))
+
+@app.route('/api/photos/<photo_id>/thumbnail', methods=['GET'])
+def get_photo_thumbnail(photo_id):
+    """Миниатюра загруженного фото (JPEG)"""
+    if photo_store.get(photo_id) is None:
+        return jsonify({'error': 'Photo not found or expired'}), 404
+    return send_file(photo_store.thumbnail_path(photo_id), mimetype='image/jpeg', max_age=3600)
+
+def collage_job_status(job):
+    """Тело ответа для незавершённой или упавшей задачи коллажа"""
+    body = {'success': job['status'] != FAILED, 'jobId': job['id'], 'status': job['status']}
+    if 'queue_position' in job:
+        body['queuePosition'] = job['queue_position']
+    if job['error']:
+        body['error'] = job['error']
+    return body
+
+@app.route('/api/collage/<job_id>', methods=['GET'])
+def get_collage_job(job_id):
+    """
+    Статус / результат асинхронного коллажа
+    
+    ?wait=N — long-poll: ответ, как только задача завершена, но не позже N сек
+    (не больше COLLAGE_JOB_MAX_WAIT). Пока задача в очереди — 202 со статусом,
+    готовая — в том же виде, что и синхронный ответ /api/create-collage.
+    """
+    wait = request.args.get('wait', 0, type=float)
+    job = collage_queue.wait(job_id, wait) if wait > 0 else collage_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    
+    if job['status'] == FAILED:
+        return jsonify(collage_job_status(job)), 500
+    if job['status'] != DONE:
+        return jsonify(collage_job_status(job)), 202, {'Retry-After': '1'}
+    
+    path = collage_queue.result_path(job)
+    if job['format']:
+        return send_file(path, mimetype=content_type(job['format']),
+                         download_name=f'collage.{job["format"]}', as_attachment=False)
+    
+    with open(path, 'rb') as f:
+        collage_base64 = base64.b64encode(f.read()).decode('utf-8')
+    return jsonify({
+        'success': True,
+        'collage': f'data:image/jpeg;base64,{collage_base64}'
+    })
+
 @app.route('/', methods=['GET'])
 def index():
     """Главная страница API"""
@@ -574,17 +650,23 @@ def index():
         'version': '1.0.0',
         'endpoints': {
             'health': '/health',
+            'ready': '/ready',
             'estimate_age': '/api/estimate-age (POST)',
-            'create_collage': '/api/create-collage (POST)'
+            'create_collage': '/api/create-collage (POST)',
+            'collage_job': '/api/collage/<jobId> (GET)',
+            'upload_photo': '/api/photos (POST)',
+            'photo': '/api/photos/<photoId> (GET)',
+            'metrics': '/metrics'
         }
     })
 
-# Загружаем InsightFace модель при импорте (для gunicorn workers)
-print('🔄 Initializing Age-bot API with InsightFace...')
+# Загружаем InsightFace модель при импорте (для gunicorn workers;
+# с AGE_MODEL_MODE=preload импорт и загрузка происходят один раз в gunicorn master)
+log.info('🔄 Initializing Age-bot API with InsightFace...')
 load_insightface_model()
 
 if __name__ == '__main__':
-    print('🚀 Starting Age-bot API...')
+    log.info('🚀 Starting Age-bot API...')
     
     # Загружаем модель при старте
     if not model_loaded:
@@ -0,0 +1,664 @@
+#!/usr/bin/env python3
+"""
+Age-bot API Service (asyncio вариант)
+Те же endpoints, что у app.py, но на Starlette + uvicorn
+
+Запросы к Face++ — await через httpx (AsyncFaceppClient): ожидание ответа
+провайдера не занимает поток, один процесс держит сотни запросов в полёте.
+CPU-работа (подготовка payload, декодирование, инференс, коллаж, base64)
+выполняется в пуле потоков AGE_CPU_THREADS, чтобы не блокировать event loop.
+
+Запуск:
+    uvicorn app_asgi:app --host 0.0.0.0 --port 5000 --workers 2
+"""
+
+import asyncio
+import base64
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Route
+
+from facepp_client import AsyncFaceppClient, FaceppError, FACEPP_API_URL, face_from_result
+from result_cache import ResultCache, content_hash, AGE_CACHE_ENABLED
+from circuit_breaker import CircuitBreaker, OPEN
+from request_images import (
+    ImageInputError, ImageTooLargeError, read_image_bytes_async, read_collage_request_async, read_photo_id_async
+)
+from image_limits import check_image, check_rows, body_limit, body_too_large
+from provider_payload import prepare_payload, FACEPP_LIMITS
+from image_ingest import decode_bgr, DETECTOR_SIDE
+from model_loader import Readiness, AGE_MODEL_MODE, AGE_INFERENCE_SOCKET
+from collage import render_collage, stream_collage_response, parse_quality
+from tile_cache import tile_cache
+from collage_output import negotiate_format, content_type, save_options
+from collage_jobs import CollageJobQueue, QUEUED, DONE, FAILED, COLLAGE_JOB_MAX_WAIT
+from photo_store import PhotoStore
+from metrics import RequestTimer, record_estimate, set_model_load_seconds, export_metrics
+from stage_timings import stage
+from structured_log import get_logger, setup_logging, start_request
+
+# JSON логи через фоновый поток (stdout → journald)
+setup_logging()
+log = get_logger(__name__)
+
+# Face++ API credentials
+FACEPP_API_KEY = os.environ.get('FACEPP_API_KEY', '')
+FACEPP_API_SECRET = os.environ.get('FACEPP_API_SECRET', '')
+
+# Потоки для CPU-работы (декодирование, инференс, коллаж)
+AGE_CPU_THREADS = int(os.environ.get('AGE_CPU_THREADS', os.cpu_count() or 4))
+
+# Создаются в lifespan (внутри event loop)
+cpu_executor = None
+facepp_client = None
+
+breakers = {
+    'facepp': CircuitBreaker('facepp')
+}
+
+result_cache = ResultCache() if AGE_CACHE_ENABLED else None
+
+# Очередь асинхронных коллажей (рендерит collage_worker.py)
+collage_queue = CollageJobQueue()
+
+# Загруженные фото, на которые ссылаются по photoId
+photo_store = PhotoStore()
+
+inference_batcher = None
+model_loaded = False
+model_load_seconds = None
+
+# loading → warming → ready (/health, /ready)
+readiness = Readiness()
+
+
+async def run_cpu(func, *args):
+    """Выполнение CPU-bound функции в пуле потоков (с контекстом запроса для логов)"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, context.run, func, *args)
+
+
+def load_insightface_model():
+    """Загрузка InsightFace (fallback если Face++ не настроен), режимы как у app.py"""
+    global inference_batcher, model_loaded, model_load_seconds
+
+    if AGE_MODEL_MODE == 'server':
+        from inference_server import InferenceClient
+
+        log.warning('⚠️ Face++ not configured, using inference server at %s', AGE_INFERENCE_SOCKET)
+        inference_batcher = InferenceClient(AGE_INFERENCE_SOCKET)
+        model_loaded = True
+        readiness.warm_up(inference_batcher)
+        return True
+
+    try:
+        # preload имеет смысл только для gunicorn master — здесь это local
+        from inference_batcher import InferenceBatcher
+        from model_loader import load_face_app
+
+        log.warning('⚠️ Face++ not configured, loading InsightFace as fallback...')
+        face_app, model_load_seconds = load_face_app()
+        inference_batcher = InferenceBatcher(face_app)
+        model_loaded = True
+        set_model_load_seconds(model_load_seconds)
+        log.info('✅ InsightFace buffalo_l model loaded in %.1fs (fallback method)', model_load_seconds)
+        # uvicorn принимает соединения после lifespan — трафик получает уже прогретая модель
+        readiness.warm_up(inference_batcher)
+        return True
+    except Exception as e:
+        log.exception('❌ Failed to load InsightFace model: %s', e)
+        readiness.set_failed(e)
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global cpu_executor, facepp_client, model_loaded
+
+    log.info('🔄 Initializing Age-bot API (asyncio)...')
+    cpu_executor = ThreadPoolExecutor(max_workers=AGE_CPU_THREADS, thread_name_prefix='age-cpu')
+    if FACEPP_API_KEY and FACEPP_API_SECRET:
+        log.info('✅ Face++ API configured (primary method), API Key: %s...', FACEPP_API_KEY[:8])
+        facepp_client = AsyncFaceppClient(FACEPP_API_KEY, FACEPP_API_SECRET, FACEPP_API_URL)
+        model_loaded = True
+        readiness.set_ready()
+    else:
+        await run_cpu(load_insightface_model)
+
+    try:
+        yield
+    finally:
+        if facepp_client is not None:
+            await facepp_client.aclose()
+        cpu_executor.shutdown(wait=False)
+
+
+def _estimate_local(image_bytes):
+    """Декодирование + InsightFace (выполняется в cpu_executor)"""
+    with stage('decode'):
+        img_bgr, info = decode_bgr(image_bytes, DETECTOR_SIDE)
+    log.debug('📸 Input shape: %s (from %s, decode %s ms)', img_bgr.shape, info['original_size'], info['decode_ms'])
+    with stage('inference'):
+        return inference_batcher.estimate(img_bgr)
+
+
+async def estimate_age(image_bytes, image_hash=None):
+    """
+    Определение возраста по изображению (байты файла)
+    Face++ API (primary, await) или InsightFace (fallback, в пуле потоков)
+
+    Возвращает: dict {'age': int, 'gender': str, 'provider': str} или None при ошибке
+    """
+    breaker = breakers['facepp']
+
+    if facepp_client is not None and breaker.allow_request():
+        started = time.perf_counter()
+        try:
+            log.debug('🔍 Using Face++ API for age estimation...')
+            with stage('payload'):
+                payload = await run_cpu(prepare_payload, image_bytes, FACEPP_LIMITS, image_hash)
+            with stage('facepp'):
+                result = await facepp_client.detect(payload)
+        except FaceppError as e:
+            if e.is_client_error:
+                breaker.record_success(time.perf_counter() - started)
+            else:
+                breaker.record_failure(time.perf_counter() - started)
+            record_estimate('facepp', 'error')
+            log.warning('⚠️ Face++ error: %s, falling back to InsightFace', e)
+        except Exception as e:
+            breaker.record_failure(time.perf_counter() - started)
+            record_estimate('facepp', 'error')
+            log.error('❌ Face++ error: %s, falling back to InsightFace', e)
+        else:
+            breaker.record_success(time.perf_counter() - started)
+
+            face = face_from_result(result)
+            if face is None:
+                record_estimate('facepp', 'no_face')
+                log.info('⚠️ No face detected by Face++')
+                return None
+
+            record_estimate('facepp', 'ok')
+            log.info('✅ Face++ estimated age: %s, gender: %s', face['age'], face['gender'],
+                     extra={'provider': 'facepp', 'age': face['age'], 'gender': face['gender']})
+            return {'age': face['age'], 'gender': face['gender'], 'provider': 'facepp'}
+
+    if inference_batcher is None:
+        log.error('❌ No age estimation method available')
+        return None
+
+    if facepp_client is not None:
+        # Face++ настроен, но breaker открыт или запрос упал
+        record_estimate('facepp', 'fallback')
+
+    try:
+        log.debug('🔍 Using InsightFace for age estimation (fallback)...')
+        face = await run_cpu(_estimate_local, image_bytes)
+
+        if face is None:
+            record_estimate('insightface', 'no_face')
+            log.info('⚠️ No face detected by InsightFace')
+            return None
+
+        record_estimate('insightface', 'ok')
+        log.info('✅ InsightFace estimated age: %s, gender: %s', face['age'], face['gender'],
+                 extra={'provider': 'insightface', 'age': face['age'], 'gender': face['gender']})
+        return {'age': face['age'], 'gender': face['gender'], 'provider': 'insightface'}
+
+    except Exception as e:
+        record_estimate('insightface', 'error')
+        log.exception('❌ InsightFace error: %s', e)
+        return None
+
+
+async def health_check(request):
+    """Проверка здоровья сервиса"""
+    if facepp_client is not None and breakers['facepp'].state != OPEN:
+        provider = 'Face++ API'
+    else:
+        provider = 'InsightFace (fallback)'
+
+    # inference server stats — блокирующий вызов сокета, остальное — sqlite и диск
+    inference = await run_cpu(inference_batcher.stats) if inference_batcher else None
+    cache_stats = await run_cpu(result_cache.stats) if result_cache else None
+    tile_cache_stats = await run_cpu(tile_cache.stats) if tile_cache else None
+    collage_job_stats = await run_cpu(collage_queue.stats)
+    photo_stats = await run_cpu(photo_store.stats)
+
+    return JSONResponse({
+        'status': 'ok',
+        'readiness': readiness.stats(),
+        'model_loaded': model_loaded,
+        'model_mode': AGE_MODEL_MODE,
+        'model_load_seconds': round(model_load_seconds, 2) if model_load_seconds else None,
+        'pid': os.getpid(),
+        'server': 'asgi',
+        'provider': provider,
+        'facepp': facepp_client.stats() if facepp_client else None,
+        'cache': cache_stats,
+        'tile_cache': tile_cache_stats,
+        'breakers': {name: breaker.stats() for name, breaker in breakers.items()},
+        'inference': inference,
+        'collage_jobs': collage_job_stats,
+        'photos': photo_stats
+    })
+
+
+async def ready_check(request):
+    """Готовность worker'а (модель загружена и прогрета): 200 или 503 — для деплоя и балансировщика"""
+    return JSONResponse(readiness.stats(), status_code=200 if readiness.ready else 503)
+
+
+async def estimate_age_endpoint(request):
+    """Endpoint для определения возраста (формат запроса и ответа как в app.py)"""
+    try:
+        photo_id = await read_photo_id_async(request)
+        # Кэш и photo_store — sqlite: блокирующие вызовы не в event loop
+        photo = await run_cpu(photo_store.get, photo_id) if photo_id else None
+        if photo_id and photo is None:
+            return JSONResponse({'error': f'Unknown or expired photoId: {photo_id}'}, status_code=404)
+
+        try:
+            with stage('read'):
+                if photo:
+                    image_bytes = await run_cpu(photo_store.read_file, photo_id)
+                else:
+                    image_bytes = await read_image_bytes_async(request)
+        except ImageInputError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status)
+        if image_bytes is None:
+            return JSONResponse({'error': f'Unknown or expired photoId: {photo_id}'}, status_code=404)
+
+        cache_key = photo_id if photo else content_hash(image_bytes)
+        cached = photo['detection'] if photo else None
+        if cached is None and result_cache:
+            cached = await run_cpu(result_cache.get, cache_key)
+        if cached is not None:
+            log.info('⚡ Cache hit: age %s (%s)', cached['age'], cached['provider'],
+                     extra={'provider': 'cache', 'age': cached['age']})
+            record_estimate('cache', 'ok')
+            if photo and photo['detection'] is None:
+                await run_cpu(photo_store.set_detection, photo_id, cached)
+            return JSONResponse({
+                'success': True,
+                'age': cached['age'],
+                'gender': cached.get('gender'),
+                'confidence': 0.95,
+                'status': 'success',
+                'cached': True
+            })
+
+        # Формат, размер и разрешение по заголовку — до декодирования
+        try:
+            with stage('check'):
+                check_image(image_bytes)
+        except ImageInputError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status)
+
+        result = await estimate_age(image_bytes, cache_key)
+
+        if result is None:
+            return JSONResponse({
+                'success': False,
+                'message': 'Failed to estimate age',
+                'age': None
+            }, status_code=500)
+
+        if result_cache:
+            await run_cpu(result_cache.set, cache_key, result)
+        if photo:
+            await run_cpu(photo_store.set_detection, photo_id, result)
+
+        with stage('json'):
+            response = JSONResponse({
+                'success': True,
+                'age': result['age'],
+                'gender': result['gender'],
+                'confidence': 0.95,
+                'status': 'success',
+                'cached': False
+            })
+        return response
+
+    except ImageInputError as e:
+        # Тело больше лимита при чтении photoId
+        return JSONResponse({'error': str(e)}, status_code=e.status)
+    except Exception as e:
+        log.exception('❌ Error processing request: %s', e)
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+def _render_collage_base64(data, tier):
+    collage_jpeg = render_collage(data, tier)
+    with stage('base64'):
+        return base64.b64encode(collage_jpeg).decode('utf-8')
+
+
+async def create_collage(request):
+    """Создание коллажа (формат запроса и ответа как в app.py, включая бинарный ответ)"""
+    try:
+        log.debug('🎨 create_collage called')
+        try:
+            with stage('read'):
+                data = await read_collage_request_async(request)
+        except ImageInputError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status)
+
+        if not data:
+            log.info('❌ No data provided')
+            return JSONResponse({'error': 'No data provided'}, status_code=400)
+
+        rows = data.get('rows', [])
+        if not rows:
+            return JSONResponse({'error': 'No photo rows provided'}, status_code=400)
+
+        # Слишком большие фото не из photo_store — 413 до очереди и рендеринга (битые пропускаются при рендеринге)
+        try:
+            await run_cpu(photo_store.resolve_rows, rows)
+            with stage('check'):
+                await run_cpu(check_rows, rows)
+        except ImageInputError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status)
+
+        try:
+            output_format = negotiate_format(request.headers.get('accept'), request.query_params.get('format'))
+            effort = request.query_params.get('effort')
+            tier, quality = parse_quality(request.query_params.get('quality'))
+            if output_format:
+                save_options(output_format, effort, quality)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+
+        async_requested = (request.query_params.get('async') in ('1', 'true')
+                           or 'respond-async' in request.headers.get('prefer', ''))
+        if async_requested and tier == 'final':
+            job_id = await run_cpu(collage_queue.submit, data, output_format, effort, quality)
+            log.info('📨 Collage job %s queued: %d rows', job_id, len(rows), extra={'job_id': job_id})
+            status_url = f'/api/collage/{job_id}'
+            return JSONResponse({
+                'success': True,
+                'jobId': job_id,
+                'status': QUEUED,
+                'statusUrl': status_url
+            }, status_code=202, headers={'Location': status_url})
+
+        log.info('📸 Processing %d photo rows for collage (%s)...', len(rows), tier)
+
+        if output_format:
+            chunks = await run_cpu(stream_collage_response, data, output_format, effort, quality, tier)
+            # Синхронный генератор Starlette итерирует в пуле потоков
+            return StreamingResponse(
+                chunks,
+                media_type=content_type(output_format),
+                headers={
+                    'Vary': 'Accept',
+                    'Content-Disposition': f'inline; filename="collage.{output_format}"'
+                }
+            )
+
+        collage_base64 = await run_cpu(_render_collage_base64, data, tier)
+
+        with stage('json'):
+            response = JSONResponse({
+                'success': True,
+                'collage': f'data:image/jpeg;base64,{collage_base64}'
+            })
+        return response
+
+    except Exception as e:
+        log.exception('❌ Error creating collage: %s', e)
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+def _photo_response(info):
+    return {
+        'success': True,
+        'photoId': info['id'],
+        'format': info['format'],
+        'width': info['width'],
+        'height': info['height'],
+        'thumbnailUrl': f'/api/photos/{info["id"]}/thumbnail',
+        'expiresAt': datetime.fromtimestamp(info['expires'], timezone.utc).isoformat(timespec='seconds'),
+        'detection': info['detection']
+    }
+
+
+async def upload_photo(request):
+    """Загрузка фото в photo_store (как в app.py)"""
+    try:
+        try:
+            with stage('read'):
+                image_bytes = await read_image_bytes_async(request)
+            with stage('store'):
+                info = await run_cpu(photo_store.put, image_bytes)
+        except ImageInputError as e:
+            return JSONResponse({'error': str(e)}, status_code=e.status)
+        return JSONResponse(_photo_response(info), status_code=201)
+    except Exception as e:
+        log.exception('❌ Error storing photo: %s', e)
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def get_photo(request):
+    """Метаданные загруженного фото (продлевает срок хранения)"""
+    info = await run_cpu(photo_store.get, request.path_params['photo_id'])
+    if info is None:
+        return JSONResponse({'error': 'Photo not found or expired'}, status_code=404)
+    return JSONResponse(_photo_response(info))
+
+
+async def get_photo_thumbnail(request):
+    """Миниатюра загруженного фото (JPEG)"""
+    photo_id = request.path_params['photo_id']
+    if await run_cpu(photo_store.get, photo_id) is None:
+        return JSONResponse({'error': 'Photo not found or expired'}, status_code=404)
+    return FileResponse(photo_store.thumbnail_path(photo_id), media_type='image/jpeg',
+                        headers={'Cache-Control': 'public, max-age=3600'})
+
+
+def _collage_job_status(job):
+    body = {'success': job['status'] != FAILED, 'jobId': job['id'], 'status': job['status']}
+    if 'queue_position' in job:
+        body['queuePosition'] = job['queue_position']
+    if job['error']:
+        body['error'] = job['error']
+    return body
+
+
+def _read_base64(path):
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+async def get_collage_job(request):
+    """Статус / результат асинхронного коллажа (как в app.py); long-poll без занятого потока"""
+    job_id = request.path_params['job_id']
+    try:
+        wait = min(float(request.query_params.get('wait') or 0), COLLAGE_JOB_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    deadline = time.monotonic() + wait
+    while True:
+        job = await run_cpu(collage_queue.get, job_id)
+        if job is None or job['status'] in (DONE, FAILED) or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.2)
+
+    if job is None:
+        return JSONResponse({'error': 'Job not found or expired'}, status_code=404)
+    if job['status'] == FAILED:
+        return JSONResponse(_collage_job_status(job), status_code=500)
+    if job['status'] != DONE:
+        return JSONResponse(_collage_job_status(job), status_code=202, headers={'Retry-After': '1'})
+
+    path = collage_queue.result_path(job)
+    if job['format']:
+        return FileResponse(path, media_type=content_type(job['format']),
+                            filename=f'collage.{job["format"]}', content_disposition_type='inline')
+
+    collage_base64 = await run_cpu(_read_base64, path)
+    return JSONResponse({
+        'success': True,
+        'collage': f'data:image/jpeg;base64,{collage_base64}'
+    })
+
+
+async def metrics_endpoint(request):
+    """Метрики Prometheus (всех uvicorn workers при PROMETHEUS_MULTIPROC_DIR)"""
+    body, metrics_type = await run_cpu(export_metrics)
+    return Response(body, headers={'Content-Type': metrics_type})
+
+
+async def index(request):
+    """Главная страница API"""
+    return JSONResponse({
+        'service': 'Age-bot API',
+        'version': '1.0.0',
+        'endpoints': {
+            'health': '/health',
+            'ready': '/ready',
+            'estimate_age': '/api/estimate-age (POST)',
+            'create_collage': '/api/create-collage (POST)',
+            'collage_job': '/api/collage/<jobId> (GET)',
+            'upload_photo': '/api/photos (POST)',
+            'photo': '/api/photos/<photoId> (GET)',
+            'metrics': '/metrics'
+        }
+    })
+
+
+class MetricsMiddleware:
+    """Длительность и in-flight запросов по шаблону маршрута (как before/after_request в app.py)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def route(scope):
+        for route in app.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] == '/metrics':
+            await self.app(scope, receive, send)
+            return
+
+        timer = RequestTimer(self.route(scope), scope['method'])
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            timer.finish(status)
+
+
+class BodyLimitMiddleware:
+    """
+    Лимит тела запроса (как MAX_CONTENT_LENGTH и reject_large_body в app.py)
+
+    Content-Length больше лимита маршрута — 413 до чтения тела; chunked тело
+    считается при чтении, и превышение — ImageTooLargeError в endpoint (413)
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        limit = body_limit(scope['path'])
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > limit:
+            log.info('🚫 Request body too large: %s bytes (limit %d)', content_length.decode(), limit)
+            await JSONResponse({'error': body_too_large(limit)}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise ImageTooLargeError(body_too_large(limit))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class RequestLogMiddleware:
+    """Correlation id и уровень логирования запроса, X-Request-ID в ответе (как в app.py)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        request_id = start_request(
+            headers.get(b'x-request-id', b'').decode('latin-1'),
+            headers.get(b'x-debug-log', b'').decode('latin-1')
+        )
+
+        async def send_with_request_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (b'x-request-id', request_id.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/ready', ready_check, methods=['GET']),
+        Route('/api/estimate-age', estimate_age_endpoint, methods=['POST']),
+        Route('/api/create-collage', create_collage, methods=['POST']),
+        Route('/api/collage/{job_id}', get_collage_job, methods=['GET']),
+        Route('/api/photos', upload_photo, methods=['POST']),
+        Route('/api/photos/{photo_id}', get_photo, methods=['GET']),
+        Route('/api/photos/{photo_id}/thumbnail', get_photo_thumbnail, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/', index, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(RequestLogMiddleware),
+        Middleware(MetricsMiddleware),
+        # Разрешаем CORS для фронтенда
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        # Внутри CORS — чтобы ответ 413 был виден фронтенду
+        Middleware(BodyLimitMiddleware)
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    log.info('🚀 Starting Age-bot API (asyncio)...')
+    port = int(os.environ.get('PORT', 5000))
+    uvicorn.run(app, host='0.0.0.0', port=port)
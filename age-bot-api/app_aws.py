@@ -12,6 +12,7 @@ import boto3
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from PIL import Image
+from provider_payload import prepare_payload, REKOGNITION_LIMITS
 
 app = Flask(__name__)
 CORS(app)
@@ -137,14 +138,13 @@ def estimate_age():
         # Декодируем base64
         image_bytes = base64.b64decode(image_data)
         
-        # Проверяем размер (AWS Rekognition limit: 5MB для DetectFaces)
-        if len(image_bytes) > 5 * 1024 * 1024:
-            return jsonify({'error': 'Image too large (max 5MB)'}), 413
-        
         print(f'Received image: {len(image_bytes)} bytes')
         
+        # AWS Rekognition limit: 5MB для DetectFaces — большие фото уменьшаем
+        payload = prepare_payload(image_bytes, REKOGNITION_LIMITS)
+        
         # Определяем возраст с помощью AWS Rekognition
-        result = detect_age_with_rekognition(image_bytes)
+        result = detect_age_with_rekognition(payload)
         
         if result is None:
             return jsonify({'error': 'No face detected'}), 400
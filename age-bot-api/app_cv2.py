@@ -6,12 +6,11 @@ Flask API для определения возраста по фотографи
 
 import os
 import base64
-import io
 import numpy as np
 import cv2
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from PIL import Image
+from image_ingest import decode_bgr
 
 app = Flask(__name__)
 CORS(app)
@@ -83,7 +82,7 @@ def detect_face(image):
     
     return best_box, best_confidence
 
-def estimate_age(image):
+def estimate_age(img_bgr):
     """
     Определение возраста по изображению
     
@@ -94,15 +93,6 @@ def estimate_age(image):
         return None
     
     try:
-        # Конвертируем PIL Image в numpy array (BGR для OpenCV)
-        if isinstance(image, Image.Image):
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            img_array = np.array(image)
-            img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        else:
-            img_bgr = image
-        
         print(f'📸 Input shape: {img_bgr.shape}')
         
         # Детекция лица
@@ -165,13 +155,11 @@ def estimate_age_endpoint():
         if ',' in image_data:
             image_data = image_data.split(',')[1]
         
-        # Декодируем
+        # Декодируем сразу в BGR, в уменьшенном масштабе
         image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
+        image, info = decode_bgr(image_bytes)
         
-        # Конвертируем в RGB если нужно
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        print(f'📸 Processing image: {info["decoded_size"]} from {info["original_size"]}, decode {info["decode_ms"]} ms')
         
         # Определяем возраст
         age = estimate_age(image)
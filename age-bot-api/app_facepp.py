@@ -11,6 +11,9 @@ import io
 import requests
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from PIL import UnidentifiedImageError
+from facepp_client import FaceppClient, FaceppError, FACEPP_API_URL
+from provider_payload import prepare_payload, FACEPP_LIMITS
 
 app = Flask(__name__)
 CORS(app)
@@ -18,14 +21,14 @@ CORS(app)
 # Face++ API credentials (из переменных окружения)
 FACEPP_API_KEY = os.environ.get('FACEPP_API_KEY', '')
 FACEPP_API_SECRET = os.environ.get('FACEPP_API_SECRET', '')
-FACEPP_API_URL = 'https://api-us.faceplusplus.com/facepp/v3/detect'
 
 # Глобальные переменные
+facepp_client = None
 model_loaded = False
 
 def load_models():
     """Проверка наличия API ключей"""
-    global model_loaded
+    global facepp_client, model_loaded
     
     try:
         print('Checking Face++ API credentials...')
@@ -36,6 +39,7 @@ def load_models():
             return False
         
         print(f'✅ Face++ API Key: {FACEPP_API_KEY[:8]}...')
+        facepp_client = FaceppClient(FACEPP_API_KEY, FACEPP_API_SECRET, FACEPP_API_URL)
         model_loaded = True
         return True
         
@@ -110,46 +114,32 @@ def estimate_age():
         
         print(f'Processing image: {len(image_bytes)} bytes')
         
-        # Подготовка запроса к Face++ API
-        files = {
-            'image_file': ('image.jpg', image_bytes, 'image/jpeg')
-        }
-        
-        payload = {
-            'api_key': FACEPP_API_KEY,
-            'api_secret': FACEPP_API_SECRET,
-            'return_attributes': 'age,gender'  # Запрашиваем возраст и пол
-        }
-        
-        # Отправляем запрос к Face++ API
+        # Отправляем запрос к Face++ API (keep-alive пул + повторы с jitter)
         print('Sending request to Face++ API...')
-        response = requests.post(
-            FACEPP_API_URL,
-            data=payload,
-            files=files,
-            timeout=30
-        )
-        
-        # Проверяем статус ответа
-        if response.status_code != 200:
-            print(f'Face++ API error: {response.status_code}')
-            print(f'Response: {response.text}')
+        try:
+            # Оригинал, если укладывается в лимиты Face++, иначе уменьшенный JPEG
+            payload = prepare_payload(image_bytes, FACEPP_LIMITS)
+            result = facepp_client.detect(payload)
+        except UnidentifiedImageError:
             return jsonify({
                 'success': False,
-                'message': f'Face++ API returned error: {response.status_code}',
+                'message': 'Failed to decode image',
                 'age': None
-            }), 500
-        
-        result = response.json()
-        
-        # Проверяем наличие ошибок в ответе
-        if 'error_message' in result:
-            print(f'Face++ error: {result["error_message"]}')
+            }), 400
+        except FaceppError as e:
+            print(f'Face++ error: {e}')
+            if e.status_code == 200:
+                # error_message в успешном ответе — проблема с фото
+                return jsonify({
+                    'success': False,
+                    'message': str(e),
+                    'age': None
+                }), 400
             return jsonify({
                 'success': False,
-                'message': result['error_message'],
+                'message': f'Face++ API returned error: {e.status_code}',
                 'age': None
-            }), 400
+            }), 500
         
         # Проверяем наличие лиц
         if 'faces' not in result or len(result['faces']) == 0:
@@ -207,7 +197,8 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'model_loaded': model_loaded,
-        'provider': 'Face++ API'
+        'provider': 'Face++ API',
+        'facepp': facepp_client.stats() if facepp_client else None
     }), 200
 
 # Загружаем модели при старте
@@ -12,6 +12,7 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 from google.cloud import vision
 from google.oauth2 import service_account
+from provider_payload import prepare_payload, VISION_LIMITS
 
 app = Flask(__name__)
 CORS(app)
@@ -119,8 +120,8 @@ def estimate_age():
         
         print(f'Processing image: {len(image_bytes)} bytes')
         
-        # Создаём Vision API Image объект
-        image = vision.Image(content=image_bytes)
+        # Создаём Vision API Image объект (большие фото уменьшаем под лимит запроса)
+        image = vision.Image(content=prepare_payload(image_bytes, VISION_LIMITS))
         
         # Вызываем Face Detection
         response = vision_client.face_detection(image=image)
@@ -7,31 +7,20 @@ Flask API для определения возраста на основе ан
 
 import os
 import base64
-import io
 import hashlib
-import numpy as np
 import cv2
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from PIL import Image
+from image_ingest import decode_bgr
 
 app = Flask(__name__)
 CORS(app)
 
 model_loaded = True  # OpenCV всегда доступен
 
-def detect_face_and_features(image):
+def detect_face_and_features(img_bgr):
     """Детекция лица и извлечение признаков для оценки возраста"""
     try:
-        # Конвертируем PIL Image в numpy array (BGR для OpenCV)
-        if isinstance(image, Image.Image):
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            img_array = np.array(image)
-            img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        else:
-            img_bgr = image
-        
         # Конвертируем в grayscale для детекции
         gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
         
@@ -122,15 +111,11 @@ def estimate_age_endpoint():
         if ',' in image_data:
             image_data = image_data.split(',')[1]
         
-        # Декодируем
+        # Декодируем сразу в BGR, в уменьшенном масштабе
         image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Конвертируем в RGB если нужно
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        image, info = decode_bgr(image_bytes)
         
-        print(f'📸 Processing image: {image.size}')
+        print(f'📸 Processing image: {info["decoded_size"]} from {info["original_size"]}, decode {info["decode_ms"]} ms')
         
         # Детектируем лицо и извлекаем признаки
         features = detect_face_and_features(image)
@@ -7,12 +7,9 @@ Flask API для определения возраста по фотографи
 
 import os
 import base64
-import io
-import numpy as np
-import cv2
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from PIL import Image
+from image_ingest import decode_bgr, DETECTOR_SIDE
 import insightface
 from insightface.app import FaceAnalysis
 
@@ -37,7 +34,7 @@ def load_models():
         )
         
         # Подготовка модели (ctx_id=-1 для CPU)
-        face_app.prepare(ctx_id=-1, det_size=(640, 640))
+        face_app.prepare(ctx_id=-1, det_size=(DETECTOR_SIDE, DETECTOR_SIDE))
         
         model_loaded = True
         print('✅ InsightFace model loaded successfully')
@@ -59,16 +56,9 @@ def decode_base64_image(base64_string):
         # Декодируем base64
         image_data = base64.b64decode(base64_string)
         
-        # Конвертируем в PIL Image
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Конвертируем в RGB если нужно
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Конвертируем в numpy array (BGR для OpenCV)
-        img_array = np.array(image)
-        img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+        # Декодируем сразу в BGR в масштабе детектора (640 px)
+        img_bgr, info = decode_bgr(image_data, DETECTOR_SIDE)
+        print(f'Decoded {info["original_size"]} → {info["decoded_size"]} in {info["decode_ms"]} ms')
         
         return img_bgr
         
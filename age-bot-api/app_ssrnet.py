@@ -7,12 +7,11 @@ Flask API для определения возраста по фотографи
 
 import os
 import base64
-import io
 import numpy as np
 import cv2
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from PIL import Image
+from image_ingest import decode_bgr
 import tensorflow as tf
 from tensorflow import keras
 
@@ -141,7 +140,7 @@ def estimate_age_from_features(face_img):
     
     return estimated_age
 
-def estimate_age(image):
+def estimate_age(img_bgr):
     """
     Определение точного возраста по изображению
     
@@ -152,15 +151,6 @@ def estimate_age(image):
         return None
     
     try:
-        # Конвертируем PIL Image в numpy array (BGR для OpenCV)
-        if isinstance(image, Image.Image):
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            img_array = np.array(image)
-            img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        else:
-            img_bgr = image
-        
         print(f'📸 Input shape: {img_bgr.shape}')
         
         # Детекция лица
@@ -231,15 +221,11 @@ def estimate_age_endpoint():
         if ',' in image_data:
             image_data = image_data.split(',')[1]
         
-        # Декодируем
+        # Декодируем сразу в BGR, в уменьшенном масштабе
         image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Конвертируем в RGB если нужно
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        image, info = decode_bgr(image_bytes)
         
-        print(f'📸 Processing image: {image.size}')
+        print(f'📸 Processing image: {info["decoded_size"]} from {info["original_size"]}, decode {info["decode_ms"]} ms')
         
         # Определяем возраст
         age = estimate_age(image)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк рендеринга коллажа: время по стадиям и пиковая память
+
+Синтетические фото реальных размеров (3, 8 и 12 MP, портрет «до» и ландшафт
+«после») генерируются детерминированно и кэшируются в --photos-dir. Каждый
+случай (число строк) выполняется в отдельном процессе, поэтому пиковый
+RSS относится только к нему. Путь — тот же, что у /api/create-collage:
+render_collage + base64 (JSON ответ) или stream_collage_response (?format=).
+
+Стадии (stage_timings.py): decode, crop, convert, resize, tile_cache, text,
+paste, encode, base64. Стадии тайлов идут в пуле потоков параллельно, их
+время — сумма по потокам; --concurrency 1 даёт последовательную картину.
+
+Запуск:
+    python bench_collage.py --output bench.json
+    python bench_collage.py --rows 1,3 --repeat 5 --format webp
+    python bench_collage.py --compare bench.json    # exit 1 при регрессии
+"""
+
+import argparse
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+# Размеры фото (ландшафт; портрет — те же стороны наоборот)
+PHOTO_SIZES = {
+    '3mp': (2048, 1536),
+    '8mp': (3264, 2448),
+    '12mp': (4032, 3024)
+}
+PHOTO_QUALITY = 92
+
+STAGES = ('decode', 'crop', 'convert', 'resize', 'tile_cache', 'text', 'paste', 'encode', 'base64')
+
+# Регрессия — медленнее/больше на долю threshold и не меньше чем на эти величины (шум)
+MIN_REGRESSION_MS = 20
+MIN_REGRESSION_MB = 5
+
+
+def photo_path(photos_dir, name, portrait):
+    return os.path.join(photos_dir, f'{name}-{"portrait" if portrait else "landscape"}.jpg')
+
+
+def generate_photos(photos_dir):
+    """Синтетические фото: плавные пятна (как на фото) + шум сенсора, фиксированный seed"""
+    import numpy as np
+    from PIL import Image
+
+    os.makedirs(photos_dir, exist_ok=True)
+    for seed, (name, (width, height)) in enumerate(PHOTO_SIZES.items()):
+        for portrait in (True, False):
+            path = photo_path(photos_dir, name, portrait)
+            if os.path.exists(path):
+                continue
+            w, h = (height, width) if portrait else (width, height)
+            rng = np.random.RandomState(seed * 2 + portrait)
+            base = Image.fromarray(rng.randint(40, 220, (h // 200 + 2, w // 200 + 2, 3), dtype=np.uint8))
+            base = np.asarray(base.resize((w, h), Image.Resampling.BICUBIC), dtype=np.int16)
+            noise = rng.normal(0, 6, (h, w, 1)).astype(np.int16)
+            pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+            Image.fromarray(pixels).save(path, format='JPEG', quality=PHOTO_QUALITY)
+            print(f'📸 Generated {os.path.basename(path)}: {w}x{h}, {os.path.getsize(path) // 1024} KB')
+
+
+def case_photos(photos_dir, rows):
+    """Пути фото для строк: размеры по кругу, «до» — портрет, «после» — ландшафт"""
+    names = list(PHOTO_SIZES)
+    return [
+        (photo_path(photos_dir, names[i % len(names)], True),
+         photo_path(photos_dir, names[(i + 1) % len(names)], False))
+        for i in range(rows)
+    ]
+
+
+def _max_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux — килобайты, macOS — байты
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_case(options):
+    """Один случай в отдельном процессе: {'wall': [...], 'stages': [...], 'peak_rss_mb': ...}"""
+    from collage import render_collage, stream_collage_response
+    from stage_timings import collect, stage
+
+    photos = []
+    for before_path, after_path in case_photos(options['photos_dir'], options['rows']):
+        with open(before_path, 'rb') as f:
+            before = f.read()
+        with open(after_path, 'rb') as f:
+            after = f.read()
+        photos.append((before, after))
+
+    def request_data():
+        return {
+            'rows': [
+                {'beforePhoto': before, 'afterPhoto': after, 'photoType': 'front'}
+                for before, after in photos
+            ],
+            'metadata': {'before': {'front': {'uploadDate': '2024-01-15T10:00:00Z'}}},
+            'userInfo': {
+                'username': 'bench@rejuvena.ru',
+                'siteUrl': 'seplitza.github.io/rejuvena',
+                'realAgeBefore': 42, 'realAgeAfter': 42,
+                'weightBefore': 64, 'weightAfter': 61,
+                'procedures': 'Массаж лица, гимнастика для шеи',
+                'commentsBefore': 'Исходное состояние'
+            }
+        }
+
+    fmt, tier = options['format'], options['quality']
+
+    def render():
+        if fmt == 'json':
+            collage_jpeg = render_collage(request_data(), tier)
+            with stage('base64'):
+                encoded = base64.b64encode(collage_jpeg)
+            return len(encoded)
+        return sum(len(chunk) for chunk in stream_collage_response(request_data(), fmt, None, None, tier))
+
+    if options['tile_cache']:
+        # Тайлы в кэше — замеряется повторная генерация (правка анкеты)
+        render()
+
+    baseline = _max_rss_bytes()
+    walls, stages, size = [], [], 0
+    for _ in range(options['repeat']):
+        with collect() as timings:
+            started = time.perf_counter()
+            size = render()
+            walls.append(time.perf_counter() - started)
+        stages.append(timings)
+
+    return {
+        'wall': walls,
+        'stages': stages,
+        'bytes': size,
+        'peak_rss_mb': round(_max_rss_bytes() / 2 ** 20, 1),
+        'peak_rss_delta_mb': round((_max_rss_bytes() - baseline) / 2 ** 20, 1)
+    }
+
+
+def _quiet_run_case(options):
+    # Логи рендеринга (structured_log, в т.ч. предупреждения о фото) не смешиваются с таблицей
+    logging.disable(logging.WARNING)
+    return run_case(options)
+
+
+def summarize(rows, raw, options):
+    def ms(seconds):
+        return round(seconds * 1000, 1)
+
+    stages = {}
+    for name in STAGES + tuple(sorted({n for t in raw['stages'] for n in t} - set(STAGES))):
+        values = [t.get(name, 0.0) for t in raw['stages']]
+        if any(values):
+            stages[name] = ms(statistics.median(values))
+    return {
+        'key': f'{rows}-{options["format"]}-{options["quality"]}',
+        'rows': rows,
+        'photos': [
+            [os.path.basename(before), os.path.basename(after)]
+            for before, after in case_photos(options['photos_dir'], rows)
+        ],
+        'wall_ms': {
+            'median': ms(statistics.median(raw['wall'])),
+            'min': ms(min(raw['wall'])),
+            'max': ms(max(raw['wall']))
+        },
+        'stages_ms': stages,
+        'bytes': raw['bytes'],
+        'peak_rss_mb': raw['peak_rss_mb'],
+        'peak_rss_delta_mb': raw['peak_rss_delta_mb']
+    }
+
+
+def environment():
+    from PIL import __version__ as pillow_version
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pillow': pillow_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def print_table(cases):
+    columns = ('decode', 'crop', 'resize', 'text', 'encode', 'base64')
+    print(f'{"rows":>4} {"wall ms":>9} ' + ' '.join(f'{c:>8}' for c in columns) + f' {"peak MB":>8} {"+MB":>6}')
+    for case in cases:
+        stages = case['stages_ms']
+        print(f'{case["rows"]:>4} {case["wall_ms"]["median"]:>9} '
+              + ' '.join(f'{stages.get(c, 0):>8}' for c in columns)
+              + f' {case["peak_rss_mb"]:>8} {case["peak_rss_delta_mb"]:>6}')
+
+
+def compare(cases, baseline_path, threshold):
+    """Сравнение с результатом прошлого запуска; возвращает число регрессий"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {case['key']: case for case in baseline['cases']}
+    print(f'\n📊 Compared with {baseline_path} (commit {baseline["environment"].get("commit")}):')
+
+    regressions = 0
+    for case in cases:
+        old = previous.get(case['key'])
+        if old is None:
+            print(f'  {case["key"]}: no baseline')
+            continue
+        checks = (
+            ('wall ms', old['wall_ms']['median'], case['wall_ms']['median'], MIN_REGRESSION_MS),
+            ('peak +MB', old['peak_rss_delta_mb'], case['peak_rss_delta_mb'], MIN_REGRESSION_MB)
+        )
+        for label, before, after, min_delta in checks:
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold and after - before >= min_delta
+            regressions += regressed
+            mark = '❌' if regressed else '✅'
+            print(f'  {mark} {case["key"]} {label}: {before} → {after} ({change:+.1%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collage rendering benchmark')
+    parser.add_argument('--rows', default='1,3,6,10', help='числа строк через запятую')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов на случай (медиана)')
+    parser.add_argument('--format', default='json', choices=('json', 'jpeg', 'webp', 'avif'),
+                        help='json — JSON ответ с base64, иначе бинарный ?format=')
+    parser.add_argument('--quality', default='final', choices=('final', 'preview'))
+    parser.add_argument('--tile-cache', action='store_true', help='тайлы из кэша (повторная генерация)')
+    parser.add_argument('--concurrency', type=int, help='COLLAGE_REQUEST_CONCURRENCY')
+    parser.add_argument('--photos-dir', default='/tmp/collage-bench')
+    parser.add_argument('--output', help='JSON файл с результатами')
+    parser.add_argument('--compare', help='JSON прошлого запуска: exit 1 при регрессии')
+    parser.add_argument('--threshold', type=float, default=0.10, help='допустимое ухудшение (доля)')
+    args = parser.parse_args()
+
+    # Генерация в отдельном процессе: ru_maxrss наследуется дочерними процессами
+    # (fork + exec), и пик генерации 12 MP фото попал бы в пик каждого случая
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        pool.apply(generate_photos, (args.photos_dir,))
+
+    # Настройки коллажа читаются при импорте — задаём до запуска процессов
+    if args.tile_cache:
+        os.environ['COLLAGE_TILE_CACHE_DIR'] = os.path.join(args.photos_dir, 'tiles')
+    else:
+        os.environ['COLLAGE_TILE_CACHE_ENABLED'] = '0'
+    if args.concurrency:
+        os.environ['COLLAGE_REQUEST_CONCURRENCY'] = str(args.concurrency)
+
+    options = {
+        'photos_dir': args.photos_dir,
+        'repeat': args.repeat,
+        'format': args.format,
+        'quality': args.quality,
+        'tile_cache': args.tile_cache
+    }
+    cases = []
+    for rows in [int(value) for value in args.rows.split(',')]:
+        with context.Pool(1) as pool:
+            raw = pool.apply(_quiet_run_case, ({**options, 'rows': rows},))
+        cases.append(summarize(rows, raw, options))
+        print(f'⏱️ {rows} rows: {cases[-1]["wall_ms"]["median"]} ms, peak +{cases[-1]["peak_rss_delta_mb"]} MB')
+
+    print()
+    print_table(cases)
+
+    result = {
+        'environment': environment(),
+        'settings': {
+            **{key: value for key, value in options.items() if key != 'photos_dir'},
+            'concurrency': args.concurrency,
+            'collage_threads': os.environ.get('COLLAGE_THREADS')
+        },
+        'cases': cases
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f'\n💾 Results saved to {args.output}')
+
+    if args.compare and compare(cases, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Circuit breaker для внешних провайдеров (Face++ и т.п.)
+
+Состояния:
+- closed    — запросы идут к провайдеру, ведётся статистика ошибок и медленных вызовов
+- open      — провайдер считается недоступным, запросы сразу уходят в fallback
+- half_open — после cooldown пропускается ограниченное число пробных запросов;
+              успешные пробы закрывают breaker, ошибка снова открывает его
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 5))
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+BREAKER_CONSECUTIVE_FAILURES = int(os.environ.get('BREAKER_CONSECUTIVE_FAILURES', 3))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('BREAKER_SLOW_CALL_SECONDS', 8))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get('BREAKER_SLOW_CALL_RATE', 0.5))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', 30))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('BREAKER_HALF_OPEN_PROBES', 1))
+BREAKER_HALF_OPEN_SUCCESSES = int(os.environ.get('BREAKER_HALF_OPEN_SUCCESSES', 2))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker с порогами по доле ошибок и доле медленных вызовов
+
+    Использование:
+        if breaker.allow_request():
+            try:
+                ...
+            except Exception:
+                breaker.record_failure(elapsed)
+            else:
+                breaker.record_success(elapsed)
+    """
+
+    def __init__(self, name,
+                 window=BREAKER_WINDOW,
+                 min_calls=BREAKER_MIN_CALLS,
+                 error_rate=BREAKER_ERROR_RATE,
+                 consecutive_failures=BREAKER_CONSECUTIVE_FAILURES,
+                 slow_call_seconds=BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate=BREAKER_SLOW_CALL_RATE,
+                 cooldown=BREAKER_COOLDOWN,
+                 half_open_probes=BREAKER_HALF_OPEN_PROBES,
+                 half_open_successes=BREAKER_HALF_OPEN_SUCCESSES):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.consecutive_failures = consecutive_failures
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.cooldown = cooldown
+        self.half_open_probes = half_open_probes
+        self.half_open_successes = half_open_successes
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        # Окно последних вызовов: (ok, slow)
+        self._window = deque(maxlen=window)
+        self._consecutive = 0
+        self._opened_at = None
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._times_opened = 0
+        self._rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+            log.info('🟡 Circuit %s: half-open, probing', self.name)
+
+    def allow_request(self):
+        """Можно ли сейчас обращаться к провайдеру"""
+        with self._lock:
+            self._maybe_half_open()
+
+            if self._state == CLOSED:
+                return True
+
+            if self._state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+
+            self._rejected += 1
+            return False
+
+    def release(self):
+        """Разрешённый allow_request() вызов не состоялся (например, отменён)"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record_success(self, elapsed):
+        """Успешный вызов (elapsed — длительность в секундах)"""
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if slow:
+                    self._open('slow probe')
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_successes:
+                    self._close()
+                return
+
+            self._consecutive = 0
+            self._window.append((True, slow))
+            self._check_thresholds()
+
+    def record_failure(self, elapsed):
+        """Неуспешный вызов (ошибка сети, таймаут, 5xx)"""
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._open('probe failed')
+                return
+
+            if self._state == OPEN:
+                return
+
+            self._consecutive += 1
+            self._window.append((False, slow))
+            if self._consecutive >= self.consecutive_failures:
+                self._open(f'{self._consecutive} consecutive failures')
+                return
+            self._check_thresholds()
+
+    def _rates(self):
+        calls = len(self._window)
+        if not calls:
+            return 0.0, 0.0
+        errors = sum(1 for ok, _ in self._window if not ok)
+        slow = sum(1 for _, is_slow in self._window if is_slow)
+        return errors / calls, slow / calls
+
+    def _check_thresholds(self):
+        if self._state != CLOSED or len(self._window) < self.min_calls:
+            return
+        error_rate, slow_rate = self._rates()
+        if error_rate >= self.error_rate:
+            self._open(f'error rate {error_rate:.0%}')
+        elif slow_rate >= self.slow_call_rate:
+            self._open(f'slow call rate {slow_rate:.0%}')
+
+    def _open(self, reason):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._times_opened += 1
+        self._window.clear()
+        self._consecutive = 0
+        log.warning('🔴 Circuit %s: open (%s), cooldown %.0fs', self.name, reason, self.cooldown)
+
+    def _close(self):
+        self._state = CLOSED
+        self._opened_at = None
+        self._window.clear()
+        self._consecutive = 0
+        log.info('🟢 Circuit %s: closed', self.name)
+
+    def stats(self):
+        """Состояние breaker для /health"""
+        with self._lock:
+            self._maybe_half_open()
+            error_rate, slow_rate = self._rates()
+            retry_in = None
+            if self._state == OPEN:
+                retry_in = round(max(0.0, self.cooldown - (time.monotonic() - self._opened_at)), 1)
+            return {
+                'state': self._state,
+                'error_rate': round(error_rate, 3),
+                'slow_call_rate': round(slow_rate, 3),
+                'window_calls': len(self._window),
+                'times_opened': self._times_opened,
+                'rejected': self._rejected,
+                'retry_in_seconds': retry_in
+            }
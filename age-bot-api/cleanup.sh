@@ -28,9 +28,13 @@ log "========================================="
 TMP_DIR="/var/www/age-bot-api/tmp"
 # Путь к загруженным фото (если backend сохраняет их локально)
 UPLOADS_DIR="/var/www/uploads"
+# Хранилище фото API (photo_store.py): срок хранения считает само хранилище
+# по последнему использованию фото, find по mtime его не трогает
+PHOTO_STORE_DIR="$UPLOADS_DIR/photos"
+API_DIR="/var/www/age-bot-api"
 # Путь к коллажам (если сохраняются локально)
 COLLAGES_DIR="/var/www/collages"
-# Путь к кэшу
+# Путь к кэшу (включая тайлы коллажей в collage-tiles/: mtime = последнее использование)
 CACHE_DIR="/var/www/cache"
 
 # Срок хранения файлов (в днях)
@@ -67,8 +71,23 @@ cleanup_directory() {
 # Очистка временных файлов (7 дней)
 cleanup_directory "$TMP_DIR" "$TEMP_RETENTION_DAYS" "temporary files"
 
-# Очистка старых загруженных фото (30 дней)
-cleanup_directory "$UPLOADS_DIR" "$RETENTION_DAYS" "uploaded photos"
+# Хранилище фото API: истёкшие фото и вытеснение по лимиту размера
+if [ -d "$PHOTO_STORE_DIR" ]; then
+    log "Purging photo store in $PHOTO_STORE_DIR..."
+    (cd "$API_DIR" && PHOTO_STORE_DIR="$PHOTO_STORE_DIR" ./venv/bin/python photo_store.py purge) \
+        || log "⚠️  Photo store purge failed"
+fi
+
+# Очистка старых загруженных фото вне хранилища (30 дней)
+if [ -d "$UPLOADS_DIR" ]; then
+    log "Cleaning uploaded photos in $UPLOADS_DIR (older than $RETENTION_DAYS days)..."
+    # -delete несовместим с -prune (включает -depth), поэтому rm через -exec
+    file_count=$(find "$UPLOADS_DIR" -path "$PHOTO_STORE_DIR" -prune -o -type f -mtime +$RETENTION_DAYS -print 2>/dev/null | wc -l)
+    find "$UPLOADS_DIR" -path "$PHOTO_STORE_DIR" -prune -o -type f -mtime +$RETENTION_DAYS -exec rm -f {} + 2>/dev/null || true
+    log "✅ Deleted $file_count files from $UPLOADS_DIR"
+else
+    log "⚠️  Directory $UPLOADS_DIR does not exist, skipping"
+fi
 
 # Очистка старых коллажей (30 дней)
 cleanup_directory "$COLLAGES_DIR" "$RETENTION_DAYS" "collages"
@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+"""
+Рендеринг коллажа "До / После" для /api/create-collage
+
+Общий код для Flask (app.py) и asyncio (app_asgi.py) версий API.
+"""
+
+import contextvars
+import io
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image, ImageDraw
+
+from request_images import photo_bytes
+from result_cache import content_hash
+from tile_cache import tile_cache
+from collage_fonts import FONT_BOLD, FONT_REGULAR, draw_text, text_bbox
+from collage_output import OutputFormatError, encode_collage, jpeg_from_strips, save_options, stream_collage
+from stage_timings import stage
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+
+# Пул потоков для декодирования и ресайза фото (Pillow отпускает GIL),
+# общий для всех запросов worker
+COLLAGE_THREADS = int(os.environ.get('COLLAGE_THREADS', os.cpu_count() or 4))
+# Сколько фото одного коллажа обрабатываются одновременно: большой коллаж
+# не должен занимать все ядра и тормозить /api/estimate-age
+COLLAGE_REQUEST_CONCURRENCY = int(os.environ.get('COLLAGE_REQUEST_CONCURRENCY', 2))
+
+# Коллажи от COLLAGE_STRIP_MIN_ROWS строк рисуются и кодируются полосами
+# (0 — всегда целиком); высота полосы кратна 16 (MCU при 4:2:0)
+COLLAGE_STRIP_MIN_ROWS = int(os.environ.get('COLLAGE_STRIP_MIN_ROWS', 6))
+COLLAGE_STRIP_HEIGHT = max(16, int(os.environ.get('COLLAGE_STRIP_HEIGHT', 256)) // 16 * 16)
+
+# Размеры одного фото в коллаже (КВАДРАТНЫЕ) - Увеличено для лучшего качества
+PHOTO_SIZE = 800  # квадратные фото 800x800
+
+# Во сколько раз тайл перед LANCZOS может быть больше PHOTO_SIZE: всё, что
+# сверх этого, уменьшается быстрым reduce() (для PNG и других не-JPEG фото)
+COLLAGE_REDUCING_GAP = 2
+
+# Уровень preview: тайлы COLLAGE_PREVIEW_SIZE вместо PHOTO_SIZE (вся раскладка
+# уменьшается в том же масштабе), быстрый фильтр и низкое качество JPEG
+COLLAGE_PREVIEW_SIZE = int(os.environ.get('COLLAGE_PREVIEW_SIZE', 300))
+COLLAGE_PREVIEW_QUALITY = int(os.environ.get('COLLAGE_PREVIEW_QUALITY', 60))
+
+# Уровни качества коллажа (?quality=preview|final); effort и quality —
+# настройки кодировщика по умолчанию (None — как у формата)
+CollageTier = namedtuple('CollageTier', ['name', 'tile_size', 'resample', 'effort', 'quality'])
+
+COLLAGE_TIERS = {
+    'final': CollageTier('final', PHOTO_SIZE, Image.Resampling.LANCZOS, None, None),
+    'preview': CollageTier('preview', COLLAGE_PREVIEW_SIZE, Image.Resampling.BILINEAR, 'fast', COLLAGE_PREVIEW_QUALITY)
+}
+
+
+def tile_params(tier):
+    """
+    Всё, от чего зависит тайл, кроме байтов фото (ключ в tile_cache);
+    при изменении crop_to_square или ресайза — поднять версию
+    """
+    params = f's{tier.tile_size}-g{COLLAGE_REDUCING_GAP}-v1'
+    if tier.resample != Image.Resampling.LANCZOS:
+        params += f'-r{int(tier.resample)}'
+    return params
+
+
+def parse_quality(value):
+    """?quality= → (уровень, качество кодировщика): preview, final или 1..100 (final)"""
+    if not value:
+        return 'final', None
+    if value in COLLAGE_TIERS:
+        return value, None
+    try:
+        quality = int(value)
+    except ValueError:
+        raise OutputFormatError(f'Unknown quality: {value} (use {", ".join(COLLAGE_TIERS)} or 1..100)')
+    if not 1 <= quality <= 100:
+        raise OutputFormatError('quality must be 1..100')
+    return 'final', quality
+
+_executor = ThreadPoolExecutor(max_workers=COLLAGE_THREADS, thread_name_prefix='collage')
+
+
+def crop_to_square(img):
+    """Обрезка изображения в квадрат (для лица: 5% сверху, 15% снизу)"""
+    width, height = img.size
+    size = min(width, height)
+    
+    # Центрируем по горизонтали
+    left = (width - size) // 2
+    
+    # Для вертикальной обрезки: 5% отступ сверху для лица
+    if height > width:
+        # Портретная ориентация - смещаем вверх для лица
+        top = int(height * 0.05)  # 5% отступ сверху
+    else:
+        # Горизонтальная или квадратная - центрируем
+        top = (height - size) // 2
+    
+    return img.crop((left, top, left + size, top + size))
+
+
+def _load_tile(value, label, tier=COLLAGE_TIERS['final']):
+    """
+    Декодирование фото строки и подготовка квадратного тайла tier.tile_size (в пуле потоков)
+
+    JPEG декодируется сразу в 1/2, 1/4 или 1/8 масштаба (наименьший, при котором
+    квадрат после обрезки не меньше тайла), обрезка делается до конвертации,
+    крупное целое уменьшение — через reduce(), финальный ресайз — фильтром уровня.
+    """
+    if not value:
+        log.debug('⏭️ %s: No photo', label)
+        return None
+    size = tier.tile_size
+    try:
+        # Фото из photo_store: хэш известен без чтения файла, а для preview
+        # достаточно сохранённой миниатюры
+        photo_id = getattr(value, 'photo_id', None)
+        data = None if photo_id else photo_bytes(value)
+        
+        # Тот же фото с теми же параметрами обрезки уже обрабатывался
+        key = f'{photo_id or content_hash(data)}-{tile_params(tier)}' if tile_cache else None
+        if key:
+            with stage('tile_cache'):
+                img = tile_cache.get(key)
+            if img is not None:
+                log.debug('⚡ %s: tile from cache', label)
+                return img
+        
+        with stage('decode'):
+            if photo_id:
+                data = value.read(size)
+            img = Image.open(io.BytesIO(data))
+            original_size = img.size
+            if img.format == 'JPEG':
+                img.draft('RGB', (size, size))
+            img.load()
+        with stage('crop'):
+            img = crop_to_square(img)  # Квадратное
+        with stage('convert'):
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+        with stage('resize'):
+            factor = img.width // (size * COLLAGE_REDUCING_GAP)
+            if factor >= 2:
+                img = img.reduce(factor)
+            img = img.resize((size, size), tier.resample)
+        log.debug('✅ %s: photo loaded (%dx%d)', label, *original_size)
+        if key:
+            with stage('tile_cache'):
+                tile_cache.set(key, img)
+        return img
+    except Exception as e:
+        log.warning('⚠️ %s: Failed to load photo: %s', label, e)
+        return None
+
+
+def _map_bounded(func, jobs, limit):
+    """
+    func(*job) для каждого job в общем пуле, не больше limit одновременно
+    Возвращает: результаты в порядке jobs
+    """
+    slots = threading.BoundedSemaphore(max(1, limit))
+    futures = []
+    for job in jobs:
+        slots.acquire()
+        # Контекст запроса (request_id в логах) — в поток пула
+        future = _executor.submit(contextvars.copy_context().run, func, *job)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+
+# Отступы (пропорционально увеличены)
+PADDING = 30  # отступ между фото в паре
+ROW_SPACING = 120  # отступ между парами (увеличено для метаданных)
+BORDER = 60  # рамка по краям
+HEADER_HEIGHT = 120  # высота заголовка
+FOOTER_HEIGHT = 500  # высота футера с анкетой
+
+# Шрифты (увеличенные для 800px фото) — загружены один раз на процесс
+FONT_LARGE = (FONT_BOLD, 48)
+FONT_NORMAL = (FONT_REGULAR, 36)
+FONT_SMALL = (FONT_REGULAR, 28)
+
+
+def caption_text(metadata, side, photo_type):
+    """Подпись под фото "До" / "После" (side = 'before' | 'after')"""
+    meta = metadata.get(side, {}).get(photo_type, {})
+    exif = meta.get('exifData') or {}
+    date_time = exif.get('DateTime') or exif.get('captureDate')
+    upload_date = meta.get('uploadDate')
+    
+    if date_time:
+        # DateTime format: "YYYY:MM:DD HH:MM:SS" or ISO
+        if ':' in date_time[:10]:
+            date_str = date_time[:10].replace(':', '.')
+        else:
+            date_str = date_time[:10].replace('-', '.')
+        return f"↓ Снято: {date_str}"
+    if upload_date:
+        # Use upload date as fallback (ISO format)
+        upload_str = upload_date[:10].replace('-', '.')
+        return f"↓ Загружено: {upload_str}"
+    return "↓ No EXIF data found (screenshot)"
+
+
+def collect_footer_fields(user_info):
+    """Заполненные поля анкеты в порядке как в форме"""
+    footer_fields = []
+    
+    # Бот определил возраст
+    if user_info.get('botAgeBefore') or user_info.get('botAgeAfter'):
+        bot_ages = []
+        if user_info.get('botAgeBefore'):
+            bot_ages.append(str(user_info['botAgeBefore']))
+        if user_info.get('botAgeAfter'):
+            bot_ages.append(str(user_info['botAgeAfter']))
+        if bot_ages:
+            footer_fields.append(f"Бот определил возраст: {' / '.join(bot_ages)}")
+    
+    # Реальный возраст
+    if user_info.get('realAgeBefore') or user_info.get('realAgeAfter'):
+        ages = []
+        if user_info.get('realAgeBefore'):
+            ages.append(str(user_info['realAgeBefore']))
+        if user_info.get('realAgeAfter'):
+            ages.append(str(user_info['realAgeAfter']))
+        if ages:
+            footer_fields.append(f"Возраст: {' / '.join(ages)}")
+    
+    # Вес
+    if user_info.get('weightBefore') or user_info.get('weightAfter'):
+        weights = []
+        if user_info.get('weightBefore'):
+            weights.append(str(user_info['weightBefore']))
+        if user_info.get('weightAfter'):
+            weights.append(str(user_info['weightAfter']))
+        if weights:
+            footer_fields.append(f"Вес: {' / '.join(weights)} кг")
+    
+    # Рост
+    if user_info.get('heightBefore') or user_info.get('heightAfter'):
+        heights = []
+        if user_info.get('heightBefore'):
+            heights.append(str(user_info['heightBefore']))
+        if user_info.get('heightAfter'):
+            heights.append(str(user_info['heightAfter']))
+        if heights:
+            footer_fields.append(f"Рост: {' / '.join(heights)} см")
+    
+    # Пол
+    if user_info.get('gender'):
+        footer_fields.append(f"Пол: {user_info['gender']}")
+    
+    # Тип кожи
+    if user_info.get('skinType'):
+        footer_fields.append(f"Тип кожи: {user_info['skinType']}")
+    
+    # Процедуры
+    if user_info.get('procedures'):
+        footer_fields.append(f"Процедуры: {user_info['procedures']}")
+    
+    # Комментарии (До и После)
+    if user_info.get('commentsBefore'):
+        footer_fields.append(f"Комментарий До: {user_info['commentsBefore']}")
+    if user_info.get('commentsAfter'):
+        footer_fields.append(f"Комментарий После: {user_info['commentsAfter']}")
+    
+    return footer_fields
+
+
+def _px(value, scale):
+    """Размер раскладки final (px) в масштабе уровня качества"""
+    return round(value * scale)
+
+
+def _font(font, scale):
+    path, size = font
+    return path, _px(size, scale)
+
+
+def render_header(width, username, scale=1.0):
+    """Заголовок "Фотодневник | Имя | Дата" (полоса до первой пары фото)"""
+    header = Image.new('RGB', (width, _px(HEADER_HEIGHT + BORDER, scale)), 'white')
+    current_date = datetime.now().strftime('%d.%m.%Y')
+    header_text = f"Фотодневник | {username} | {current_date}"
+    draw_text(header, (_px(BORDER, scale), _px(30, scale)), header_text, *_font(FONT_LARGE, scale), fill='black')
+    return header
+
+
+def render_footer(width, user_info, scale=1.0):
+    """
+    Футер с анкетой (только заполненные поля)
+
+    Полоса от верхней границы плашки анкеты до низа коллажа
+    """
+    # Плашка начинается на 20 px выше заголовка "Анкета:"
+    footer = Image.new('RGB', (width, _px(FOOTER_HEIGHT + BORDER - 40, scale)), 'white')
+    draw = ImageDraw.Draw(footer)
+    border = _px(BORDER, scale)
+    
+    # Рисуем светлый фон для футера (лучшее визуальное отделение)
+    draw.rectangle(
+        [(border, 0), (width - border, footer.height - border)],
+        fill='#f5f5f5',
+        outline='#cccccc',
+        width=max(1, _px(2, scale))
+    )
+    
+    draw_text(footer, (_px(BORDER + 20, scale), _px(20, scale)), "Анкета:", *_font(FONT_NORMAL, scale), fill='black')
+    
+    footer_fields = collect_footer_fields(user_info)
+    log.debug('📝 Footer fields: %d', len(footer_fields))
+    
+    line_y = 20 + 50
+    for field in footer_fields:
+        draw_text(footer, (_px(BORDER + 20, scale), _px(line_y, scale)), field, *_font(FONT_SMALL, scale), fill='black')
+        line_y += 45
+    return footer
+
+
+class _CollagePainter:
+    """
+    Раскладка коллажа и отрисовка любой горизонтальной полосы
+
+    paint(canvas, top) рисует на canvas часть коллажа, начинающуюся с
+    координаты top: весь коллаж (top=0, canvas во всю высоту) или полосу.
+    Тайлы загружаются для строк, попавших в полосу; при рисовании полосами
+    сверху вниз тайлы и исходные фото уже пройденных строк освобождаются.
+
+    Раскладка считается в координатах final и умножается на масштаб уровня
+    (tile_size / PHOTO_SIZE), поэтому preview пропорционален final.
+    """
+
+    def __init__(self, data, tier='final'):
+        self.rows = data['rows']
+        self.tier = COLLAGE_TIERS[tier]
+        self.scale = self.tier.tile_size / PHOTO_SIZE
+        
+        # Извлекаем userInfo и metadata
+        self.user_info = data.get('userInfo', {})
+        self.metadata = data.get('metadata', {})
+        self.username = self.user_info.get('username', 'Пользователь')
+        self.site_url = self.user_info.get('siteUrl', '')
+        # Только имена полей: значения анкеты — персональные данные
+        log.debug('📄 UserInfo fields: %s, site URL: %s, metadata: %s',
+                  sorted(self.user_info), self.site_url, sorted(self.metadata))
+        
+        # Создаём вертикальный коллаж с заголовком и футером
+        num_pairs = len(self.rows)
+        
+        # Размер коллажа (в координатах final)
+        self.pair_width = PHOTO_SIZE * 2 + PADDING
+        width = self.pair_width + BORDER * 2
+        photos_height = (PHOTO_SIZE + ROW_SPACING) * num_pairs - ROW_SPACING
+        height = HEADER_HEIGHT + photos_height + FOOTER_HEIGHT + BORDER * 2
+        self.photos_start_y = HEADER_HEIGHT + BORDER
+        self.footer_y = self.photos_start_y + photos_height + 60
+        log.debug('📏 Footer position: y=%d, collage_height=%d (%s)', self.footer_y, height, self.tier.name)
+        
+        # Размер изображения уровня качества
+        self.width = self._px(width)
+        self.height = self._px(height)
+        
+        self._header = None
+        self._footer = None
+        # Тайлы загруженных строк: {i: (before, after)}
+        self._tiles = {}
+
+    def _px(self, value):
+        return _px(value, self.scale)
+
+    def _row_top(self, i):
+        return self.photos_start_y + i * (PHOTO_SIZE + ROW_SPACING)
+
+    def _load_rows(self, indexes):
+        """Тайлы строк indexes (параллельно); исходные фото строк освобождаются"""
+        jobs = []
+        for idx in indexes:
+            row = self.rows[idx]
+            jobs.append((row.get('beforePhoto'), f'Row {idx} before', self.tier))
+            jobs.append((row.get('afterPhoto'), f'Row {idx} after', self.tier))
+        tiles = _map_bounded(_load_tile, jobs, COLLAGE_REQUEST_CONCURRENCY)
+        for n, idx in enumerate(indexes):
+            self._tiles[idx] = (tiles[2 * n], tiles[2 * n + 1])
+            self.rows[idx]['beforePhoto'] = self.rows[idx]['afterPhoto'] = None
+
+    def paint(self, canvas, top):
+        """top и canvas — в пикселях уровня качества"""
+        bottom = top + canvas.height
+        
+        # ЗАГОЛОВОК
+        if top < self._px(self.photos_start_y):
+            if self._header is None:
+                self._header = render_header(self.width, self.username, self.scale)
+            with stage('paste'):
+                canvas.paste(self._header, (0, -top))
+        
+        # Строки, задевающие полосу (с подписями и водяным знаком под фото)
+        visible = [
+            i for i in range(len(self.rows))
+            if self._px(self._row_top(i)) < bottom and self._px(self._row_top(i) + PHOTO_SIZE + ROW_SPACING) > top
+        ]
+        for i in [i for i in self._tiles if i not in visible and self._px(self._row_top(i)) < top]:
+            del self._tiles[i]
+        missing = [i for i in visible if i not in self._tiles]
+        if missing:
+            self._load_rows(missing)
+        
+        # Размещаем пары фото (До слева, После справа) с метаданными
+        for i in visible:
+            self._paint_row(canvas, top, i)
+        
+        # ФУТЕР С АНКЕТОЙ
+        if bottom > self._px(self.footer_y - 20):
+            if self._footer is None:
+                self._footer = render_footer(self.width, self.user_info, self.scale)
+            with stage('paste'):
+                canvas.paste(self._footer, (0, self._px(self.footer_y - 20) - top))
+
+    def _paint_row(self, canvas, top, i):
+        row_top = self._row_top(i)
+        photo_type = self.rows[i].get('photoType', 'front')
+        small = _font(FONT_SMALL, self.scale)
+        
+        for side, tile, x in (('before', self._tiles[i][0], BORDER),
+                              ('after', self._tiles[i][1], BORDER + PHOTO_SIZE + PADDING)):
+            if tile:
+                with stage('paste'):
+                    canvas.paste(tile, (self._px(x), self._px(row_top) - top))
+                
+                # Метаданные под фото
+                meta_text = caption_text(self.metadata, side, photo_type)
+                draw_text(canvas, (self._px(x + 10), self._px(row_top + PHOTO_SIZE + 10) - top),
+                          meta_text, *small, fill='#666666')
+        
+        # Водяной знак: ссылка на фотодневник поверх фотографий внизу по центру
+        if self.site_url:
+            # Центр между двумя фотографиями (spanning both photos)
+            watermark_x = self._px(BORDER + self.pair_width // 2)
+            watermark_y = self._px(row_top + PHOTO_SIZE - 45) - top  # Поверх фото снизу
+            
+            # Получаем размер текста для центрирования
+            bbox = text_bbox(self.site_url, *small)
+            text_width = bbox[2] - bbox[0]
+            
+            # Рисуем водяной знак с центрированием (без фона)
+            draw_text(
+                canvas,
+                (watermark_x - text_width // 2, watermark_y), 
+                self.site_url, 
+                *small,
+                fill='#999999'  # Серый цвет
+            )
+
+
+def compose_collage(data, tier='final'):
+    """
+    Коллаж из данных запроса (rows, metadata, userInfo)
+
+    Фото в rows — bytes или base64 строки (см. request_images.read_collage_request);
+    после построения тайлов фото в rows заменяются на None.
+    Коллаж собирается из готовых тайлов (tile_cache), заголовка и футера,
+    поэтому правка анкеты не требует повторного декодирования фото.
+    tier — уровень качества из COLLAGE_TIERS (preview — та же раскладка в масштабе).
+    Возвращает: PIL Image (RGB), кодирование — collage_output.py
+    """
+    painter = _CollagePainter(data, tier)
+    
+    # Создаём белый фон
+    collage = Image.new('RGB', (painter.width, painter.height), 'white')
+    painter.paint(collage, 0)
+    return collage
+
+
+def use_strips(data, fmt='jpeg', tier='final', effort=None):
+    """
+    Рисовать ли коллаж полосами (длинный JPEG коллаж в полном качестве)
+
+    Полосы — baseline JPEG без optimize и progressive. Явно запрошенный
+    effort, которому они нужны (balanced, best), рисуется целиком.
+    """
+    if not (fmt == 'jpeg' and tier == 'final' and COLLAGE_STRIP_MIN_ROWS > 0
+            and len(data['rows']) >= COLLAGE_STRIP_MIN_ROWS):
+        return False
+    if effort:
+        options = save_options(fmt, effort)
+        return not (options['optimize'] or options['progressive'])
+    return True
+
+
+def iter_collage_jpeg(data, quality=None):
+    """
+    Коллаж в JPEG полосами по COLLAGE_STRIP_HEIGHT строк: генератор кусков файла
+
+    Память не зависит от числа строк: в каждый момент живут одна полоса,
+    тайлы её строк, заголовок и футер. Кодирование — baseline JPEG без
+    optimize (таблицы Хаффмана на весь файл требуют всего изображения).
+    """
+    painter = _CollagePainter(data)
+    
+    def strips():
+        for top in range(0, painter.height, COLLAGE_STRIP_HEIGHT):
+            strip = Image.new('RGB', (painter.width, min(COLLAGE_STRIP_HEIGHT, painter.height - top)), 'white')
+            painter.paint(strip, top)
+            yield strip
+    
+    return jpeg_from_strips(strips(), painter.width, painter.height, quality)
+
+
+def stream_collage_response(data, fmt='jpeg', effort=None, quality=None, tier='final'):
+    """Генератор кусков бинарного ответа /api/create-collage"""
+    if use_strips(data, fmt, tier, effort):
+        log.debug('🧵 Rendering %d rows in %dpx strips', len(data['rows']), COLLAGE_STRIP_HEIGHT)
+        return iter_collage_jpeg(data, quality)
+    settings = COLLAGE_TIERS[tier]
+    return stream_collage(compose_collage(data, tier), fmt, effort or settings.effort, quality or settings.quality)
+
+
+def render_collage(data, tier='final'):
+    """Коллаж в JPEG (bytes) — для JSON ответа с base64"""
+    if use_strips(data, 'jpeg', tier):
+        log.debug('🧵 Rendering %d rows in %dpx strips', len(data['rows']), COLLAGE_STRIP_HEIGHT)
+        output = b''.join(iter_collage_jpeg(data))
+        log.info('✅ Collage created: %d bytes (strips)', len(output),
+                 extra={'rows': len(data['rows']), 'bytes': len(output), 'tier': tier})
+        return output
+    
+    collage = compose_collage(data, tier)
+    
+    # Сохраняем в буфер как JPEG (final — с максимальным качеством)
+    settings = COLLAGE_TIERS[tier]
+    output = io.BytesIO()
+    encode_collage(collage, output, 'jpeg', settings.effort, settings.quality)
+    log.info('✅ Collage created: %s, %d bytes (%s)', collage.size, output.tell(), tier,
+             extra={'rows': len(data['rows']), 'bytes': output.tell(), 'tier': tier})
+    
+    return output.getvalue()
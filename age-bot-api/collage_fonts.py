@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Шрифты и растеризованный текст для коллажа (кэш на время жизни worker)
+
+ImageFont.truetype загружается один раз на (шрифт, размер), а для строк
+текста кэшируются bbox и готовая маска глифов: повторяющиеся подписи
+("↓ Снято: ...", водяной знак с адресом сайта, "Анкета:") вставляются
+в коллаж одной операцией paste без повторной растеризации FreeType.
+Результат попиксельно совпадает с ImageDraw.text.
+"""
+
+import os
+import threading
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+from stage_timings import stage
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+FONT_REGULAR = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+FONT_BOLD = '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'
+
+# Сколько строк текста держать растеризованными (на worker)
+COLLAGE_TEXT_CACHE_SIZE = int(os.environ.get('COLLAGE_TEXT_CACHE_SIZE', 256))
+
+_measure_lock = threading.Lock()
+_measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+
+@lru_cache(maxsize=None)
+def get_font(path, size):
+    """Шрифт (path, size), загружается один раз на процесс"""
+    try:
+        font = ImageFont.truetype(path, size)
+        log.debug('✅ Font loaded: %s %dpx', os.path.basename(path), size)
+        return font
+    except OSError as e:
+        log.warning('⚠️ Font loading failed: %s, using default', e)
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=COLLAGE_TEXT_CACHE_SIZE * 4)
+def text_bbox(text, path, size):
+    """Bbox строки как у ImageDraw.textbbox((0, 0), ...)"""
+    with _measure_lock:
+        return _measure.textbbox((0, 0), text, font=get_font(path, size))
+
+
+@lru_cache(maxsize=COLLAGE_TEXT_CACHE_SIZE)
+def text_mask(text, path, size):
+    """
+    Растеризованная строка: (маска L, смещение маски от точки текста)
+    """
+    left, top, right, bottom = text_bbox(text, path, size)
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=get_font(path, size))
+    return mask, (left, top)
+
+
+def draw_text(canvas, xy, text, path, size, fill):
+    """Аналог ImageDraw.Draw(canvas).text(xy, text, fill, font) через кэш масок"""
+    if not text:
+        return
+    with stage('text'):
+        mask, (dx, dy) = text_mask(text, path, size)
+        canvas.paste(fill, (xy[0] + dx, xy[1] + dy), mask)
+
+
+def cache_stats():
+    """Статистика кэшей текста (для профилирования)"""
+    return {
+        'fonts': get_font.cache_info().currsize,
+        'bbox': text_bbox.cache_info()._asdict(),
+        'masks': text_mask.cache_info()._asdict()
+    }
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Очередь асинхронных задач коллажа (sqlite, общая для всех процессов)
+
+POST /api/create-collage?async=1 сохраняет входные данные задачи на диск
+и сразу отвечает jobId; рендерит отдельный процесс collage_worker.py,
+так что HTTP workers не заняты секундами рендеринга и /api/estimate-age
+не ждёт за длинным коллажем. Клиент опрашивает GET /api/collage/<id>
+(long-poll через ?wait=), готовый файл хранится COLLAGE_JOB_TTL.
+
+Файлы задачи в COLLAGE_JOBS_DIR:
+    <id>.input           — входные данные (pickle), удаляется после рендера
+    <id>.<jpeg|webp|avif> — результат
+"""
+
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+COLLAGE_JOBS_DIR = os.environ.get('COLLAGE_JOBS_DIR', '/var/www/collages/jobs')
+COLLAGE_JOB_TTL = int(os.environ.get('COLLAGE_JOB_TTL', 24 * 3600))
+# Максимальное ожидание long-poll запроса, сек
+COLLAGE_JOB_MAX_WAIT = float(os.environ.get('COLLAGE_JOB_MAX_WAIT', 25))
+# Worker обновляет heartbeat задачи во время рендеринга; задача в статусе
+# running без heartbeat дольше COLLAGE_JOB_STALE_SECONDS — worker упал,
+# задача возвращается в очередь (медленный, но живой рендер не перезапускается)
+COLLAGE_JOB_HEARTBEAT_SECONDS = float(os.environ.get('COLLAGE_JOB_HEARTBEAT_SECONDS', 10))
+COLLAGE_JOB_STALE_SECONDS = int(os.environ.get('COLLAGE_JOB_STALE_SECONDS', 60))
+COLLAGE_JOB_MAX_ATTEMPTS = 3
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def valid_job_id(job_id):
+    return bool(_JOB_ID.match(job_id or ''))
+
+
+class CollageJobQueue:
+    """Очередь задач: submit / get / wait (API) и claim / complete / fail (worker)"""
+
+    def __init__(self, directory=COLLAGE_JOBS_DIR, ttl=COLLAGE_JOB_TTL):
+        self.directory = directory
+        self.path = os.path.join(directory, 'jobs.sqlite3')
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connect(self):
+        # Соединение на поток и на процесс (после fork старое использовать нельзя)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                format TEXT,
+                effort TEXT,
+                quality INTEGER,
+                rows INTEGER NOT NULL,
+                created REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                heartbeat REAL,
+                size INTEGER,
+                error TEXT
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+        # Очередь, созданная до heartbeat
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+        if 'heartbeat' not in columns:
+            try:
+                conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+            except sqlite3.OperationalError:
+                pass  # добавил другой процесс
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def input_path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.input')
+
+    def result_path(self, job):
+        return os.path.join(self.directory, f'{job["id"]}.{job["format"] or "jpeg"}')
+
+    # --- API ---
+
+    def submit(self, data, fmt=None, effort=None, quality=None):
+        """Постановка задачи; возвращает job id"""
+        conn = self._connect()
+        job_id = uuid.uuid4().hex
+        path = self.input_path(job_id)
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+
+        with conn:
+            conn.execute(
+                'INSERT INTO jobs (id, status, format, effort, quality, rows, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, QUEUED, fmt, effort, quality, len(data.get('rows') or []), time.time())
+            )
+        return job_id
+
+    def get(self, job_id):
+        """Задача (dict) или None, если не найдена или истекла"""
+        if not valid_job_id(job_id):
+            return None
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or time.time() - row['created'] > self.ttl:
+            return None
+        job = dict(row)
+        if job['status'] == QUEUED:
+            job['queue_position'] = self._connect().execute(
+                'SELECT COUNT(*) FROM jobs WHERE status = ? AND created < ?', (QUEUED, job['created'])
+            ).fetchone()[0]
+        return job
+
+    def wait(self, job_id, timeout=0, poll_interval=0.2):
+        """Long-poll: задача, как только она завершена, или по истечении timeout"""
+        deadline = time.monotonic() + min(timeout, COLLAGE_JOB_MAX_WAIT)
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in (DONE, FAILED) or time.monotonic() >= deadline:
+                return job
+            time.sleep(poll_interval)
+
+    # --- worker ---
+
+    def claim(self, worker):
+        """Взять следующую задачу из очереди (атомарно между процессами)"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Задачи упавших workers (heartbeat давно не обновлялся) возвращаются в очередь
+            stale = now - COLLAGE_JOB_STALE_SECONDS
+            conn.execute(
+                'UPDATE jobs SET status = ? '
+                'WHERE status = ? AND COALESCE(heartbeat, started) < ? AND attempts < ?',
+                (QUEUED, RUNNING, stale, COLLAGE_JOB_MAX_ATTEMPTS)
+            )
+            conn.execute(
+                'UPDATE jobs SET status = ?, finished = ?, error = ? '
+                'WHERE status = ? AND COALESCE(heartbeat, started) < ?',
+                (FAILED, now, 'Worker crashed', RUNNING, stale)
+            )
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE status = ? ORDER BY created LIMIT 1', (QUEUED,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE jobs SET status = ?, started = ?, heartbeat = ?, attempts = attempts + 1, worker = ? '
+                    'WHERE id = ?',
+                    (RUNNING, now, now, worker, row['id'])
+                )
+                row = conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return dict(row) if row is not None else None
+
+    def heartbeat(self, job):
+        """Отметка, что worker жив и рендерит задачу; False — задача уже не его"""
+        with self._connect() as conn:
+            updated = conn.execute(
+                'UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ? AND worker = ? AND attempts = ?',
+                (time.time(), job['id'], RUNNING, job['worker'], job['attempts'])
+            ).rowcount
+        return updated == 1
+
+    def load_input(self, job):
+        with open(self.input_path(job['id']), 'rb') as f:
+            return pickle.load(f)
+
+    def _finish(self, job, status, **fields):
+        """Завершение задачи этим worker'ом и этой попыткой; False — задача уже не его"""
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            updated = conn.execute(
+                f'UPDATE jobs SET status = ?, finished = ?, {assignments} '
+                'WHERE id = ? AND status = ? AND worker = ? AND attempts = ?',
+                (status, time.time(), *fields.values(), job['id'], RUNNING, job['worker'], job['attempts'])
+            ).rowcount
+        if updated:
+            self._remove(self.input_path(job['id']))
+        return updated == 1
+
+    def complete(self, job, size):
+        return self._finish(job, DONE, size=size)
+
+    def fail(self, job, error):
+        return self._finish(job, FAILED, error=str(error)[:500])
+
+    def purge(self):
+        """Удаление истёкших задач и их файлов; возвращает число удалённых"""
+        conn = self._connect()
+        expired = conn.execute(
+            'SELECT * FROM jobs WHERE created < ?', (time.time() - self.ttl,)
+        ).fetchall()
+        for job in expired:
+            self._remove(self.input_path(job['id']))
+            self._remove(self.result_path(job))
+        with conn:
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(job['id'],) for job in expired])
+        return len(expired)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """Задачи по статусам и среднее время рендера для /health"""
+        try:
+            conn = self._connect()
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            avg_render = conn.execute(
+                'SELECT AVG(finished - started) FROM jobs WHERE status = ?', (DONE,)
+            ).fetchone()[0]
+            oldest = conn.execute(
+                'SELECT MIN(created) FROM jobs WHERE status = ?', (QUEUED,)
+            ).fetchone()[0]
+        except (sqlite3.Error, OSError) as e:
+            return {'error': str(e)}
+        return {
+            'queued': counts.get(QUEUED, 0),
+            'running': counts.get(RUNNING, 0),
+            'done': counts.get(DONE, 0),
+            'failed': counts.get(FAILED, 0),
+            'avg_render_seconds': round(avg_render, 2) if avg_render is not None else None,
+            'oldest_queued_seconds': round(time.time() - oldest, 1) if oldest else None
+        }
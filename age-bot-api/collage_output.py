@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Кодирование коллажа: JPEG / WebP / AVIF и потоковая отдача
+
+/api/create-collage по умолчанию отвечает JSON с data:image/jpeg;base64.
+Клиенты, которые принимают бинарный ответ, получают сырой image/* —
+формат выбирается параметром ?format= или заголовком Accept, а байты
+отдаются кусками по мере работы кодировщика (без BytesIO, base64 и JSON).
+
+Effort (?effort=fast|balanced|best):
+    JPEG — optimize (Huffman) и progressive
+    WebP — method 1 / 4 / 6
+    AVIF — speed 8 / 6 / 2
+"""
+
+import contextvars
+import io
+import os
+import queue
+import struct
+import threading
+
+from PIL import features
+
+from stage_timings import stage
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+# Формат ответа → (формат Pillow, Content-Type)
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif')
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+COLLAGE_JPEG_QUALITY = int(os.environ.get('COLLAGE_JPEG_QUALITY', 95))
+COLLAGE_WEBP_QUALITY = int(os.environ.get('COLLAGE_WEBP_QUALITY', 90))
+COLLAGE_AVIF_QUALITY = int(os.environ.get('COLLAGE_AVIF_QUALITY', 70))
+COLLAGE_ENCODER_EFFORT = os.environ.get('COLLAGE_ENCODER_EFFORT', 'balanced')
+
+EFFORTS = ('fast', 'balanced', 'best')
+
+# Размер куска потоковой отдачи и сколько кусков может ждать клиента
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_QUEUE_CHUNKS = 16
+
+
+def _supported(fmt):
+    if fmt == 'webp':
+        return features.check_module('webp')
+    if fmt == 'avif':
+        # Встроенный AVIF есть в Pillow >= 11.3
+        return 'avif' in features.modules and features.check_module('avif')
+    return True
+
+
+SUPPORTED_FORMATS = [fmt for fmt in OUTPUT_FORMATS if _supported(fmt)]
+
+# Порядок предпочтения при равном q в Accept: меньший размер — раньше
+_PREFERENCE = ('avif', 'webp', 'jpeg')
+
+
+class OutputFormatError(ValueError):
+    """Неизвестный или неподдерживаемый формат / effort (отдаётся клиенту как 400)"""
+
+
+def _parse_accept(accept):
+    """Accept → {'image/webp': 1.0, ...}"""
+    accepted = {}
+    for part in (accept or '').split(','):
+        fields = part.strip().split(';')
+        mimetype = fields[0].strip().lower()
+        if not mimetype:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[mimetype] = q
+    return accepted
+
+
+def negotiate_format(accept=None, requested=None):
+    """
+    Формат бинарного ответа или None (ответ JSON с base64, как раньше)
+
+    requested — параметр ?format= (jpeg, webp, avif); без него бинарный ответ
+    выбирается, только если Accept явно перечисляет image/jpeg, webp или avif
+    (*/* и image/* остаются JSON — так ведут себя существующие клиенты).
+    """
+    if requested:
+        fmt = FORMAT_ALIASES.get(requested.lower(), requested.lower())
+        if fmt not in OUTPUT_FORMATS:
+            raise OutputFormatError(f'Unknown format: {requested}')
+        if fmt not in SUPPORTED_FORMATS:
+            raise OutputFormatError(f'Format not supported by this server: {fmt}')
+        return fmt
+
+    accepted = _parse_accept(accept)
+    candidates = [
+        (accepted[OUTPUT_FORMATS[fmt][1]], -_PREFERENCE.index(fmt), fmt)
+        for fmt in SUPPORTED_FORMATS
+        if accepted.get(OUTPUT_FORMATS[fmt][1], 0) > 0
+    ]
+    if not candidates:
+        return None
+    return max(candidates)[2]
+
+
+def content_type(fmt):
+    return OUTPUT_FORMATS[fmt][1]
+
+
+def save_options(fmt, effort=None, quality=None):
+    """
+    Параметры Image.save для формата и уровня effort
+
+    Длинный JPEG коллаж (collage.use_strips) без явного effort кодируется
+    полосами — baseline без optimize и progressive, что бы ни стояло в
+    COLLAGE_ENCODER_EFFORT: память важнее нескольких процентов размера.
+    Явный ?effort=balanced|best кодируется целиком с этими параметрами.
+    """
+    effort = effort or COLLAGE_ENCODER_EFFORT
+    if effort not in EFFORTS:
+        raise OutputFormatError(f'Unknown effort: {effort} (use {", ".join(EFFORTS)})')
+    level = EFFORTS.index(effort)
+
+    if fmt == 'jpeg':
+        return {
+            'format': 'JPEG',
+            'quality': quality or COLLAGE_JPEG_QUALITY,
+            'optimize': level >= 1,
+            'progressive': level >= 2
+        }
+    if fmt == 'webp':
+        return {
+            'format': 'WEBP',
+            'quality': quality or COLLAGE_WEBP_QUALITY,
+            'method': (1, 4, 6)[level]
+        }
+    if fmt == 'avif':
+        return {
+            'format': 'AVIF',
+            'quality': quality or COLLAGE_AVIF_QUALITY,
+            'speed': (8, 6, 2)[level]
+        }
+    raise OutputFormatError(f'Unknown format: {fmt}')
+
+
+def encode_collage(image, fp, fmt='jpeg', effort=None, quality=None):
+    """Кодирование коллажа в файловый объект fp"""
+    options = save_options(fmt, effort, quality)
+    with stage('encode'):
+        image.save(fp, **options)
+
+
+class _ChunkWriter:
+    """Файловый объект для Image.save: куски уходят в ограниченную очередь"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self.closed = False
+        self.written = 0
+
+    def write(self, data):
+        if self.closed:
+            raise BrokenPipeError('Client went away')
+        self._buffer += data
+        self.written += len(data)
+        while len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self._chunks.put(bytes(self._buffer[:STREAM_CHUNK_SIZE]))
+            del self._buffer[:STREAM_CHUNK_SIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        if self._buffer:
+            self._chunks.put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+_DONE = object()
+
+
+def stream_collage(image, fmt='jpeg', effort=None, quality=None):
+    """
+    Генератор кусков закодированного коллажа
+
+    Кодировщик работает в отдельном потоке и отдаёт байты по мере готовности
+    (JPEG без optimize пишет по строкам MCU; WebP/AVIF и JPEG с optimize
+    выдают файл в конце кодирования). Параметры проверяются до первого куска.
+    """
+    options = save_options(fmt, effort, quality)
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    writer = _ChunkWriter(chunks)
+
+    def encode():
+        try:
+            with stage('encode'):
+                image.save(writer, **options)
+            writer.finish()
+            chunks.put(_DONE)
+        except Exception as e:
+            chunks.put(e)
+
+    def generate():
+        # Контекст запроса (request_id, route метрик) — и в поток кодировщика
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(encode,),
+                                  name='collage-encoder', daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _DONE:
+                    log.info('✅ Collage streamed: %s, %s, %d bytes', image.size, fmt, writer.written,
+                             extra={'format': fmt, 'bytes': writer.written})
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # Клиент отключился: останавливаем кодировщик и освобождаем очередь
+            writer.closed = True
+            while thread.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    return generate()
+
+
+# Маркеры JPEG
+_SOF0 = 0xC0
+_SOS = 0xDA
+_DRI = 0xDD
+_RST0 = 0xD0
+_EOI = b'\xff\xd9'
+
+# 4:2:0 — MCU 16x16 (полосы кратны 16 строкам)
+STRIP_SUBSAMPLING = 2
+MCU_SIZE = 16
+
+
+def _split_jpeg(data):
+    """
+    Baseline JPEG → (сегменты заголовка до SOS включительно, энтропийные данные)
+
+    Сегменты — список (marker, bytes сегмента целиком).
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG')
+    segments = []
+    pos = 2
+    while True:
+        marker = data[pos + 1]
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        segments.append((marker, data[pos:pos + 2 + length]))
+        pos += 2 + length
+        if marker == _SOS:
+            break
+    if data[-2:] != _EOI:
+        raise ValueError('JPEG without EOI')
+    return segments, data[pos:-2]
+
+
+def jpeg_from_strips(strips, width, height, quality=None):
+    """
+    Склейка JPEG из полос без общего холста: генератор кусков файла
+
+    Каждая полоса (высота кратна 16, кроме последней) кодируется Pillow
+    отдельно с одинаковыми таблицами (baseline, без optimize), из первой
+    берётся заголовок: в SOF записывается полная высота и добавляется DRI
+    с интервалом рестарта = число MCU в полосе. Энтропийные данные полос
+    идут подряд, разделённые маркерами RST0..RST7: на рестарте декодер
+    сбрасывает DC предсказание — ровно как в начале отдельно закодированной
+    полосы. Результат — обычный baseline JPEG.
+    """
+    quality = quality or COLLAGE_JPEG_QUALITY
+    mcu_columns = -(-width // MCU_SIZE)
+    index = 0
+    previous = None
+
+    for strip in strips:
+        if strip.width != width:
+            raise ValueError('Strip width mismatch')
+        if previous is not None and previous % MCU_SIZE:
+            raise ValueError('Only the last strip may be shorter than MCU multiple')
+
+        buffer = io.BytesIO()
+        with stage('encode'):
+            strip.save(buffer, format='JPEG', quality=quality, subsampling=STRIP_SUBSAMPLING,
+                       optimize=False, progressive=False)
+            segments, entropy = _split_jpeg(buffer.getvalue())
+
+        if index == 0:
+            restart_interval = mcu_columns * (strip.height // MCU_SIZE)
+            if not restart_interval or restart_interval > 0xFFFF:
+                raise ValueError('Bad strip height for restart interval')
+            header = [b'\xff\xd8']
+            for marker, segment in segments:
+                if marker == _SOF0:
+                    # Высота изображения — байты 5..6 сегмента SOF0
+                    segment = segment[:5] + struct.pack('>H', height) + segment[7:]
+                elif marker == _SOS:
+                    header.append(struct.pack('>BBHH', 0xFF, _DRI, 4, restart_interval))
+                header.append(segment)
+            yield b''.join(header)
+        else:
+            yield bytes((0xFF, _RST0 + (index - 1) % 8))
+
+        yield entropy
+        previous = strip.height
+        index += 1
+
+    yield _EOI
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Worker асинхронных коллажей (age-bot-collage.service)
+
+Берёт задачи из очереди collage_jobs (sqlite в COLLAGE_JOBS_DIR), рендерит
+коллаж тем же кодом, что и синхронный /api/create-collage, и пишет результат
+рядом с очередью. Несколько процессов COLLAGE_WORKER_PROCESSES забирают задачи
+атомарно; процессы работают с пониженным приоритетом (nice), чтобы рендеринг
+не отнимал CPU у /api/estimate-age.
+
+Запуск:
+    python collage_worker.py
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from collage_jobs import CollageJobQueue, COLLAGE_JOB_HEARTBEAT_SECONDS
+from collage import render_collage, stream_collage_response
+from structured_log import get_logger, setup_logging, start_request
+
+log = get_logger(__name__)
+
+COLLAGE_WORKER_PROCESSES = int(os.environ.get('COLLAGE_WORKER_PROCESSES', 2))
+COLLAGE_WORKER_NICE = int(os.environ.get('COLLAGE_WORKER_NICE', 10))
+# Пауза между проверками пустой очереди, сек
+COLLAGE_WORKER_POLL_INTERVAL = 0.2
+PURGE_INTERVAL = 60
+
+
+def render_job(jobs, job):
+    """Рендер одной задачи в файл результата; возвращает размер в байтах"""
+    data = jobs.load_input(job)
+    path = jobs.result_path(job)
+    # Свой временный файл у каждого процесса: задачу мог перезапустить другой worker
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        if job['format']:
+            for chunk in stream_collage_response(data, job['format'], job['effort'], job['quality']):
+                f.write(chunk)
+        else:
+            f.write(render_collage(data))
+        size = f.tell()
+    # Атомарная замена: API не отдаст недописанный файл
+    os.replace(tmp_path, path)
+    return size
+
+
+@contextmanager
+def heartbeat(jobs, job):
+    """Фоновое обновление heartbeat задачи, пока идёт рендеринг (иначе её сочтут брошенной)"""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(COLLAGE_JOB_HEARTBEAT_SECONDS):
+            try:
+                if not jobs.heartbeat(job):
+                    log.warning('⚠️ Collage job %s was taken over by another worker', job['id'])
+                    return
+            except Exception as e:
+                log.warning('⚠️ Collage job %s heartbeat failed: %s', job['id'], e)
+
+    thread = threading.Thread(target=beat, name='collage-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_worker(index):
+    os.nice(COLLAGE_WORKER_NICE)
+    name = f'{os.uname().nodename}:{os.getpid()}'
+    jobs = CollageJobQueue()
+    log.info('🧵 Collage worker %d started (%s)', index, name)
+
+    last_purge = 0
+    while True:
+        if time.monotonic() - last_purge > PURGE_INTERVAL:
+            purged = jobs.purge()
+            if purged:
+                log.info('🧹 Purged %d expired collage jobs', purged)
+            last_purge = time.monotonic()
+
+        job = jobs.claim(name)
+        if job is None:
+            time.sleep(COLLAGE_WORKER_POLL_INTERVAL)
+            continue
+
+        # Логи рендеринга задачи — с jobId вместо request_id
+        start_request(job['id'])
+        started = time.perf_counter()
+        log.info('🎨 Collage job %s: %d rows, %s (attempt %d, waited %.1fs)', job['id'], job['rows'],
+                 job['format'] or 'json', job['attempts'], time.time() - job['created'])
+        try:
+            with heartbeat(jobs, job):
+                size = render_job(jobs, job)
+        except Exception as e:
+            log.exception('❌ Collage job %s failed: %s', job['id'], e)
+            jobs.fail(job, e)
+        else:
+            if jobs.complete(job, size):
+                log.info('✅ Collage job %s done: %d bytes in %.2fs', job['id'], size, time.perf_counter() - started)
+            else:
+                log.warning('⚠️ Collage job %s finished after it was requeued, result already replaced', job['id'])
+
+
+def main():
+    setup_logging()
+    log.info('🚀 Starting %d collage workers (nice %d)...', COLLAGE_WORKER_PROCESSES, COLLAGE_WORKER_NICE)
+    if COLLAGE_WORKER_PROCESSES <= 1:
+        run_worker(0)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(i,), name=f'collage-worker-{i}')
+        for i in range(COLLAGE_WORKER_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        # Упавший процесс — перезапуск всего сервиса через systemd (Restart=always)
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
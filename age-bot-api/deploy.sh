@@ -13,7 +13,7 @@ ssh $SERVER "mkdir -p $REMOTE_DIR"
 
 # 2. Копирование файлов
 echo "📤 Uploading files..."
-scp -r app.py requirements.txt README.md $SERVER:$REMOTE_DIR/
+scp -r app.py app_asgi.py collage.py collage_fonts.py collage_output.py tile_cache.py facepp_client.py result_cache.py circuit_breaker.py hedging.py metrics.py stage_timings.py structured_log.py collage_jobs.py collage_worker.py photo_store.py request_images.py image_limits.py provider_payload.py image_ingest.py inference_batcher.py inference_server.py model_loader.py gunicorn.conf.py age-bot.service age-bot-inference.service age-bot-asgi.service age-bot-collage.service requirements.txt README.md $SERVER:$REMOTE_DIR/
 
 # 3. Копирование моделей (если есть)
 if [ -d "./models" ]; then
@@ -35,13 +35,46 @@ fi
 source venv/bin/activate
 pip install -r requirements.txt
 
-# Остановка старого процесса (если есть)
+# Установка, включение и перезапуск systemd unit'а; не запустился — деплой прерывается
+install_service() {
+    cp "$1.service" /etc/systemd/system/
+    systemctl daemon-reload
+    systemctl enable "$1"
+    systemctl restart "$1"
+    if ! systemctl is-active --quiet "$1"; then
+        echo "❌ $1 failed to start:"
+        systemctl status "$1" --no-pager
+        exit 1
+    fi
+}
+
+# Старый запуск через nohup (до age-bot.service) — systemd его не остановит
 pkill -f "gunicorn.*age-bot-api" || true
 
-# Запуск сервера
-nohup gunicorn --bind 0.0.0.0:5000 --workers 2 --timeout 120 app:app > logs.txt 2>&1 &
+# AGE_MODEL_MODE=server в age-bot.service: модель в отдельном age-bot-inference
+if grep -q 'AGE_MODEL_MODE=server' age-bot.service; then
+    install_service age-bot-inference
+else
+    systemctl disable --now age-bot-inference 2>/dev/null || true
+fi
+
+# API (gunicorn, параметры и env — в age-bot.service; каталог метрик — RuntimeDirectory)
+install_service age-bot
+
+# Worker асинхронных коллажей (?async=1): без него задачи навсегда остаются в очереди
+install_service age-bot-collage
 
-echo "✅ Age-bot API deployed and running on port 5000"
+# Ждём загрузки и прогрева модели (GET /ready — 200, когда worker готов)
+for i in $(seq 1 60); do
+    if curl -sf http://127.0.0.1:5000/ready > /dev/null; then
+        echo "✅ Age-bot API deployed and ready on port 5000"
+        exit 0
+    fi
+    sleep 2
+done
+echo "❌ Age-bot API not ready after 120s:"
+curl -s http://127.0.0.1:5000/health
+exit 1
 EOF
 
 echo ""
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Face++ API client
+Переиспользуемый HTTP клиент для Face++ detect API
+
+Создаётся один раз на gunicorn worker и держит пул keep-alive соединений,
+поэтому каждый запрос платит только за upload и время сервера Face++,
+а не за новый TCP + TLS handshake.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+# Адрес detect API (http://127.0.0.1:5100/facepp/v3/detect — facepp_mock.py для нагрузочных тестов)
+FACEPP_API_URL = os.environ.get('FACEPP_API_URL', 'https://api-us.faceplusplus.com/facepp/v3/detect')
+
+# Таймауты (секунды): connect короткий, read — с запасом на обработку фото
+FACEPP_CONNECT_TIMEOUT = float(os.environ.get('FACEPP_CONNECT_TIMEOUT', 3.05))
+FACEPP_READ_TIMEOUT = float(os.environ.get('FACEPP_READ_TIMEOUT', 15))
+
+# Размер пула соединений (на один worker)
+FACEPP_POOL_SIZE = int(os.environ.get('FACEPP_POOL_SIZE', 4))
+
+# Одновременных соединений у asyncio клиента (app_asgi.py)
+FACEPP_ASYNC_MAX_CONNECTIONS = int(os.environ.get('FACEPP_ASYNC_MAX_CONNECTIONS', 100))
+
+# Повторы при временных ошибках
+FACEPP_MAX_RETRIES = int(os.environ.get('FACEPP_MAX_RETRIES', 2))
+FACEPP_BACKOFF_BASE = float(os.environ.get('FACEPP_BACKOFF_BASE', 0.2))
+FACEPP_BACKOFF_MAX = float(os.environ.get('FACEPP_BACKOFF_MAX', 2.0))
+
+# HTTP статусы, после которых имеет смысл повторить запрос.
+# detect не меняет состояние на стороне Face++, поэтому повтор безопасен.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Face++ отвечает 403 CONCURRENCY_LIMIT_EXCEEDED при превышении QPS
+RETRY_ERROR_MESSAGES = {'CONCURRENCY_LIMIT_EXCEEDED'}
+
+
+class FaceppError(Exception):
+    """Ошибка Face++ API (HTTP статус или error_message в ответе)"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def is_client_error(self):
+        """Ошибка из-за самого фото (формат, размер) — провайдер при этом исправен"""
+        if str(self) in RETRY_ERROR_MESSAGES:
+            return False
+        return self.status_code is not None and self.status_code < 500 and self.status_code != 429
+
+
+class _FaceppClientBase:
+    """Общая часть sync/async клиентов: разбор ответа, политика повторов, статистика"""
+
+    def __init__(self, api_key, api_secret, api_url, max_retries, latency_window):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.api_url = api_url
+        self.max_retries = max_retries
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self._calls = 0
+        self._errors = 0
+        self._retries = 0
+
+    @property
+    def configured(self):
+        return bool(self.api_key and self.api_secret)
+
+    def _form(self, image_bytes, return_attributes):
+        files = {'image_file': ('image.jpg', image_bytes, 'image/jpeg')}
+        payload = {
+            'api_key': self.api_key,
+            'api_secret': self.api_secret,
+            'return_attributes': return_attributes
+        }
+        return payload, files
+
+    @staticmethod
+    def _parse_response(status_code, body):
+        """Проверка HTTP статуса и error_message в ответе Face++"""
+        try:
+            result = json.loads(body) if body else {}
+        except ValueError:
+            result = {}
+
+        if status_code != 200:
+            message = result.get('error_message') or f'HTTP {status_code}'
+            raise FaceppError(message, status_code=status_code)
+
+        if 'error_message' in result:
+            raise FaceppError(result['error_message'], status_code=status_code)
+
+        return result
+
+    @staticmethod
+    def _is_retryable_api_error(error):
+        if error.status_code in RETRY_STATUSES:
+            return True
+        return str(error) in RETRY_ERROR_MESSAGES
+
+    def _next_retry(self, attempt, error):
+        """Задержка перед следующей попыткой (exponential backoff с full jitter)"""
+        cap = min(FACEPP_BACKOFF_MAX, FACEPP_BACKOFF_BASE * (2 ** (attempt - 1)))
+        delay = random.uniform(0, cap)
+        with self._lock:
+            self._retries += 1
+        log.warning('🔁 Face++ retry %d/%d in %.2fs: %s', attempt, self.max_retries, delay, error)
+        return delay
+
+    def _record(self, elapsed, ok):
+        with self._lock:
+            self._calls += 1
+            if not ok:
+                self._errors += 1
+            self._latencies.append(elapsed)
+
+    def latency_percentile(self, percentile):
+        """Перцентиль латентности последних вызовов (секунды) или None"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def stats(self):
+        """Статистика вызовов для /health"""
+        p50 = self.latency_percentile(50)
+        p95 = self.latency_percentile(95)
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'errors': self._errors,
+                'retries': self._retries,
+                'latency_p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+                'latency_p95_ms': round(p95 * 1000, 1) if p95 is not None else None
+            }
+
+
+class FaceppClient(_FaceppClientBase):
+    """
+    Клиент Face++ detect API с пулом соединений, раздельными
+    connect/read таймаутами, повторами с jitter и учётом латентности
+    """
+
+    def __init__(self, api_key, api_secret, api_url=FACEPP_API_URL,
+                 connect_timeout=FACEPP_CONNECT_TIMEOUT,
+                 read_timeout=FACEPP_READ_TIMEOUT,
+                 pool_size=FACEPP_POOL_SIZE,
+                 max_retries=FACEPP_MAX_RETRIES,
+                 latency_window=200):
+        super().__init__(api_key, api_secret, api_url, max_retries, latency_window)
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Один Session на worker: keep-alive + ограниченный пул соединений.
+        # pool_block=True — не открываем больше pool_size соединений,
+        # лишние запросы ждут свободное соединение.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=0
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def detect(self, image_bytes, return_attributes='age,gender'):
+        """
+        Вызов Face++ detect
+
+        Возвращает: dict с ответом Face++ (JSON)
+        Бросает: FaceppError или requests.RequestException
+        """
+        payload, files = self._form(image_bytes, return_attributes)
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    self.api_url, data=payload, files=files, timeout=self.timeout
+                )
+                result = self._parse_response(response.status_code, response.content)
+                self._record(time.perf_counter() - started, ok=True)
+                return result
+            except (requests.ConnectionError, requests.Timeout, FaceppError) as e:
+                self._record(time.perf_counter() - started, ok=False)
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    raise
+                attempt += 1
+                time.sleep(self._next_retry(attempt, e))
+
+    def _is_retryable(self, error):
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        if isinstance(error, requests.Timeout):
+            # Read timeout: Face++ уже получил фото, повтор удвоит ожидание
+            return False
+        if isinstance(error, requests.ConnectionError):
+            return True
+        if isinstance(error, FaceppError):
+            return self._is_retryable_api_error(error)
+        return False
+
+
+class AsyncFaceppClient(_FaceppClientBase):
+    """
+    Asyncio клиент Face++ detect API (для app_asgi.py)
+
+    Те же таймауты, повторы и статистика, что у FaceppClient, но запрос
+    не занимает поток: одно событийное ядро держит сотни вызовов в полёте.
+    Создаётся внутри запущенного event loop (lifespan приложения).
+    """
+
+    def __init__(self, api_key, api_secret, api_url=FACEPP_API_URL,
+                 connect_timeout=FACEPP_CONNECT_TIMEOUT,
+                 read_timeout=FACEPP_READ_TIMEOUT,
+                 max_connections=FACEPP_ASYNC_MAX_CONNECTIONS,
+                 max_retries=FACEPP_MAX_RETRIES,
+                 latency_window=200):
+        import httpx
+
+        super().__init__(api_key, api_secret, api_url, max_retries, latency_window)
+        self._httpx = httpx
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            )
+        )
+
+    async def detect(self, image_bytes, return_attributes='age,gender'):
+        """Асинхронный вызов Face++ detect (см. FaceppClient.detect)"""
+        httpx = self._httpx
+        payload, files = self._form(image_bytes, return_attributes)
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await self.client.post(self.api_url, data=payload, files=files)
+                result = self._parse_response(response.status_code, response.content)
+                self._record(time.perf_counter() - started, ok=True)
+                return result
+            except (httpx.TransportError, FaceppError) as e:
+                self._record(time.perf_counter() - started, ok=False)
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    raise
+                attempt += 1
+                await asyncio.sleep(self._next_retry(attempt, e))
+
+    def _is_retryable(self, error):
+        httpx = self._httpx
+        if isinstance(error, httpx.ConnectTimeout):
+            return True
+        if isinstance(error, httpx.TimeoutException):
+            # Read timeout: Face++ уже получил фото, повтор удвоит ожидание
+            return False
+        if isinstance(error, httpx.TransportError):
+            return True
+        if isinstance(error, FaceppError):
+            return self._is_retryable_api_error(error)
+        return False
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def face_from_result(result):
+    """
+    Первое лицо из ответа Face++ detect
+
+    Возвращает: {'age': int, 'gender': str} или None, если лицо не найдено
+    """
+    faces = result.get('faces') or []
+    if not faces:
+        return None
+    attributes = faces[0]['attributes']
+    return {
+        'age': int(attributes['age']['value']),
+        'gender': attributes.get('gender', {}).get('value', 'Unknown')
+    }
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Локальная замена Face++ detect API для нагрузочных тестов без интернета
+
+Принимает те же запросы, что и https://api-us.faceplusplus.com/facepp/v3/detect
+(multipart: api_key, api_secret, image_file, return_attributes), и отвечает в
+формате Face++. Возраст и пол детерминированы по хэшу фото — повторное фото
+даёт тот же ответ. Поведение настраивается параметрами:
+
+- латентность: логнормальная с медианой --latency-ms и разбросом --latency-sigma;
+- ошибки: доля --error-rate ответов 500 INTERNAL_ERROR, --timeout-rate
+  запросов «зависают» на --timeout-seconds (проверка таймаутов клиента),
+  --no-face-rate ответов без лиц;
+- лимиты: больше --qps запросов в секунду или больше --max-concurrent
+  одновременно — 403 CONCURRENCY_LIMIT_EXCEEDED, как у Face++
+  (--limit-status 429 — обычный 429);
+- фото больше 2 MB — 400 IMAGE_FILE_TOO_LARGE.
+
+Запуск:
+    python facepp_mock.py --port 5100 --latency-ms 400 --error-rate 0.02 --qps 20
+    FACEPP_API_URL=http://127.0.0.1:5100/facepp/v3/detect \\
+        FACEPP_API_KEY=test FACEPP_API_SECRET=test gunicorn ... app:app
+
+GET /stats — счётчики ответов мока.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+import uuid
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+# Лимит Face++ на размер image_file
+MAX_IMAGE_BYTES = 2 * 1024 * 1024
+
+
+class MockSettings:
+    def __init__(self, args):
+        self.latency = args.latency_ms / 1000
+        self.sigma = args.latency_sigma
+        self.error_rate = args.error_rate
+        self.timeout_rate = args.timeout_rate
+        self.timeout_seconds = args.timeout_seconds
+        self.no_face_rate = args.no_face_rate
+        self.qps = args.qps
+        self.max_concurrent = args.max_concurrent
+        self.limit_status = args.limit_status
+        self.seed = args.seed
+
+
+class FaceppMock:
+    """Состояние мока: token bucket для --qps, счётчик одновременных запросов, статистика"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.tokens = settings.qps
+        self.refilled = time.monotonic()
+        self.in_flight = 0
+        self.responses = Counter()
+        self.started = time.time()
+
+    def _take_token(self):
+        if not self.settings.qps:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.settings.qps, self.tokens + (now - self.refilled) * self.settings.qps)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _error(self, status, message):
+        self.responses[message] += 1
+        return JSONResponse({
+            'request_id': _request_id(),
+            'time_used': 0,
+            'error_message': message
+        }, status_code=status)
+
+    async def detect(self, request):
+        started = time.perf_counter()
+        settings = self.settings
+
+        # Лимиты проверяются до чтения тела — как отказ на балансировщике Face++
+        if not self._take_token() or (settings.max_concurrent and self.in_flight >= settings.max_concurrent):
+            if settings.limit_status == 429:
+                return self._error(429, 'RATE_LIMIT_EXCEEDED')
+            return self._error(403, 'CONCURRENCY_LIMIT_EXCEEDED')
+
+        self.in_flight += 1
+        try:
+            form = await request.form()
+            if not form.get('api_key') or not form.get('api_secret'):
+                return self._error(401, 'AUTHENTICATION_ERROR')
+            upload = form.get('image_file')
+            if upload is None or isinstance(upload, str):
+                return self._error(400, 'MISSING_ARGUMENTS: image_file')
+            image = await upload.read()
+            if len(image) > MAX_IMAGE_BYTES:
+                return self._error(400, 'IMAGE_FILE_TOO_LARGE')
+
+            roll = self.random.random()
+            if roll < settings.timeout_rate:
+                await asyncio.sleep(settings.timeout_seconds)
+                return self._error(504, 'TIMEOUT')
+            await asyncio.sleep(settings.latency * self.random.lognormvariate(0, settings.sigma))
+            if roll < settings.timeout_rate + settings.error_rate:
+                return self._error(500, 'INTERNAL_ERROR')
+
+            faces = []
+            if roll >= 1 - settings.no_face_rate:
+                self.responses['no_face'] += 1
+            else:
+                self.responses['ok'] += 1
+                faces.append(_face(image))
+            return JSONResponse({
+                'request_id': _request_id(),
+                'time_used': int((time.perf_counter() - started) * 1000),
+                'image_id': hashlib.md5(image).hexdigest(),
+                'face_num': len(faces),
+                'faces': faces
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def stats(self, request):
+        return JSONResponse({
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'in_flight': self.in_flight,
+            'responses': dict(self.responses)
+        })
+
+
+def _request_id():
+    return f'{int(time.time())},{uuid.uuid4()}'
+
+
+def _face(image):
+    """Лицо с возрастом 18–70 и полом, детерминированными по байтам фото"""
+    digest = hashlib.blake2b(image, digest_size=8).digest()
+    return {
+        'face_token': digest.hex(),
+        'face_rectangle': {'top': 120, 'left': 90, 'width': 260, 'height': 260},
+        'attributes': {
+            'age': {'value': 18 + digest[0] % 53},
+            'gender': {'value': 'Female' if digest[1] % 2 else 'Male'}
+        }
+    }
+
+
+def create_app(settings):
+    mock = FaceppMock(settings)
+    return Starlette(routes=[
+        Route('/facepp/v3/detect', mock.detect, methods=['POST']),
+        Route('/stats', mock.stats, methods=['GET'])
+    ])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='Local Face++ detect API mock')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--latency-ms', type=float, default=400, help='медианная латентность')
+    parser.add_argument('--latency-sigma', type=float, default=0.35, help='разброс (sigma логнормального)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='доля «зависших» запросов')
+    parser.add_argument('--timeout-seconds', type=float, default=30)
+    parser.add_argument('--no-face-rate', type=float, default=0.0, help='доля ответов без лиц')
+    parser.add_argument('--qps', type=float, default=0, help='лимит запросов в секунду (0 — без лимита)')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='лимит одновременных запросов')
+    parser.add_argument('--limit-status', type=int, default=403, choices=(403, 429),
+                        help='ответ при превышении лимита: 403 CONCURRENCY_LIMIT_EXCEEDED или 429')
+    parser.add_argument('--seed', type=int, help='seed для воспроизводимых ошибок и латентности')
+    args = parser.parse_args()
+
+    print(f'🎭 Face++ mock on http://{args.host}:{args.port}/facepp/v3/detect '
+          f'(latency {args.latency_ms:.0f} ms, errors {args.error_rate:.0%}, qps limit {args.qps or "none"})')
+    uvicorn.run(create_app(MockSettings(args)), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
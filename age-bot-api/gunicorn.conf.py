@@ -0,0 +1,46 @@
+"""
+Gunicorn config для Age-bot API
+Подхватывается автоматически из рабочей директории (./gunicorn.conf.py)
+
+Параметры запуска (workers, bind, timeout) задаются в age-bot.service,
+здесь — только режим загрузки модели.
+
+AGE_MODEL_MODE=preload: app.py импортируется в master, модель загружается
+один раз и разделяется workers через copy-on-write. Чтобы страницы с
+объектами Python оставались общими, в master отключается сборщик мусора,
+перед fork() объекты замораживаются (gc.freeze), а в worker GC снова
+включается — так сборки в worker не трогают счётчики объектов master.
+
+PROMETHEUS_MULTIPROC_DIR: метрики workers собираются из общего каталога
+(metrics.py); gauge in-flight завершённого worker'а исключается в child_exit.
+Каталог создаётся здесь, до загрузки app (с preload метрики создаются в
+master); пустым при каждом старте его делает RuntimeDirectory в age-bot.service.
+"""
+
+import gc
+import os
+
+preload_app = os.environ.get('AGE_MODEL_MODE') == 'preload'
+
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+if preload_app:
+    gc.disable()
+
+
+def pre_fork(server, worker):
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        gc.enable()
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
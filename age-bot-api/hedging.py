@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Hedged запросы: основной провайдер + резервный с задержкой
+
+Основной вызов (Face++) стартует сразу. Если он не ответил за hedge delay
+(перцентиль его латентности, по умолчанию p90) или завершился ошибкой,
+параллельно запускается резервный вызов (локальный InsightFace).
+Возвращается первый успешный ответ в пределах бюджета латентности,
+проигравший вызов отменяется: cancel token проверяется вызовами перед
+началом работы и между этапами (начатый HTTP запрос к Face++ прервать
+нельзя — его ответ просто отбрасывается).
+
+Так хвост латентности для пользователя ограничен временем локальной
+модели, а лишняя нагрузка — только на ~10% самых медленных запросов.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+AGE_HEDGE_ENABLED = os.environ.get('AGE_HEDGE_ENABLED', '0') not in ('0', 'false', 'no', '')
+AGE_HEDGE_PERCENTILE = float(os.environ.get('AGE_HEDGE_PERCENTILE', 90))
+# Задержка, пока у основного провайдера нет статистики латентности
+AGE_HEDGE_DEFAULT_DELAY = float(os.environ.get('AGE_HEDGE_DEFAULT_DELAY', 1.0))
+AGE_HEDGE_MIN_DELAY = float(os.environ.get('AGE_HEDGE_MIN_DELAY', 0.25))
+# Общий бюджет латентности запроса, сек
+AGE_LATENCY_BUDGET = float(os.environ.get('AGE_LATENCY_BUDGET', 8))
+AGE_HEDGE_THREADS = int(os.environ.get('AGE_HEDGE_THREADS', 16))
+
+
+class HedgeTimeout(Exception):
+    """Ни один вызов не ответил в пределах бюджета"""
+
+
+class Hedger:
+    """
+    Выполнение пары вызовов с hedging
+
+    primary(cancel) и backup(cancel) вызываются в пуле потоков;
+    cancel — threading.Event, выставляется когда результат уже не нужен.
+    Вызов считается успешным, если не бросил исключение
+    (None — тоже ответ, например «лицо не найдено»).
+    """
+
+    def __init__(self, primary_name, backup_name,
+                 percentile=AGE_HEDGE_PERCENTILE,
+                 default_delay=AGE_HEDGE_DEFAULT_DELAY,
+                 min_delay=AGE_HEDGE_MIN_DELAY,
+                 budget=AGE_LATENCY_BUDGET,
+                 threads=AGE_HEDGE_THREADS):
+        self.primary_name = primary_name
+        self.backup_name = backup_name
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.budget = budget
+        # Потоки создаются при первом submit — после fork в gunicorn worker
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='hedge')
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._hedged = 0
+        self._failovers = 0
+        self._budget_exceeded = 0
+        self._wins = Counter()
+        self._hedged_wins = Counter()
+        self._last_delay = None
+
+    def hedge_delay(self, latency_seconds):
+        """Задержка перед резервным вызовом по перцентилю латентности основного"""
+        if latency_seconds is None:
+            delay = self.default_delay
+        else:
+            delay = max(self.min_delay, latency_seconds)
+        return min(delay, self.budget)
+
+    def run(self, primary, backup, delay):
+        """
+        Возвращает: (имя победителя, результат)
+        Бросает: HedgeTimeout если бюджет исчерпан, последнюю ошибку если оба упали
+        """
+        started = time.perf_counter()
+        deadline = started + self.budget
+        cancel = threading.Event()
+        # Контекст запроса (request_id в логах) — в потоки пула
+        context = contextvars.copy_context()
+        pending = {self.executor.submit(context.copy().run, primary, cancel): self.primary_name}
+        hedged = False
+        last_error = None
+
+        with self._lock:
+            self._requests += 1
+            self._last_delay = delay
+
+        try:
+            while True:
+                now = time.perf_counter()
+
+                # Основной вызов медленный или уже упал — запускаем резервный
+                if not hedged and (not pending or now >= started + delay):
+                    with self._lock:
+                        if pending:
+                            self._hedged += 1
+                        else:
+                            self._failovers += 1
+                    log.info('🏁 Hedging to %s after %.0f ms', self.backup_name, (now - started) * 1000)
+                    pending[self.executor.submit(context.copy().run, backup, cancel)] = self.backup_name
+                    hedged = True
+
+                if not pending:
+                    raise last_error
+
+                wait_until = deadline if hedged else min(deadline, started + delay)
+                if now >= deadline:
+                    with self._lock:
+                        self._budget_exceeded += 1
+                    raise HedgeTimeout(f'No answer within {self.budget:.1f}s budget')
+
+                done, _ = wait(pending, timeout=wait_until - now, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    try:
+                        value = future.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+
+                    with self._lock:
+                        self._wins[name] += 1
+                        if hedged:
+                            self._hedged_wins[name] += 1
+                    return name, value
+        finally:
+            # Проигравший вызов видит cancel и завершается без работы
+            # (Future.cancel не используем: вызов должен сам освободить ресурсы)
+            cancel.set()
+
+    def stats(self):
+        """Доля hedged запросов и побед резервного вызова для /health"""
+        with self._lock:
+            hedged = self._hedged + self._failovers
+            hedged_wins = sum(self._hedged_wins.values())
+            return {
+                'percentile': self.percentile,
+                'budget_seconds': self.budget,
+                'last_delay_ms': round(self._last_delay * 1000, 1) if self._last_delay is not None else None,
+                'requests': self._requests,
+                'hedged': self._hedged,
+                'failovers': self._failovers,
+                'budget_exceeded': self._budget_exceeded,
+                'wins': dict(self._wins),
+                'hedge_rate': round(hedged / self._requests, 3) if self._requests else None,
+                'backup_win_rate': round(self._hedged_wins[self.backup_name] / hedged_wins, 3) if hedged_wins else None
+            }
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Декодирование фото для локальных моделей (общий модуль для всех app_*.py)
+
+Вместо PIL decode в полном разрешении (12 MP) → convert('RGB') → np.array → BGR
+фото декодируется сразу в уменьшенном масштабе (JPEG DCT scaling через
+PIL draft()), с учётом EXIF ориентации, в непрерывный BGR uint8 массив.
+Масштаб выбирается по размеру входа детектора: меньшая сторона результата
+не меньше target_side, так что детектор не теряет деталей.
+"""
+
+import io
+import time
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+# Размер входа детектора InsightFace (det_size) и меньшая сторона декодирования
+# по умолчанию: детекторы и модели всех app_*.py работают на меньшем разрешении,
+# чем фото с камеры
+DETECTOR_SIDE = 640
+
+
+def decode_bgr(image_bytes, target_side=DETECTOR_SIDE):
+    """
+    Декодирование байтов изображения в BGR uint8 (C-contiguous)
+
+    target_side — минимальная сторона, ниже которой не уменьшаем
+                  (None — декодировать в полном разрешении)
+
+    Возвращает: (img_bgr, info), info = {
+        'decode_ms', 'original_size', 'decoded_size', 'scale'
+    }
+    """
+    started = time.perf_counter()
+
+    image = Image.open(io.BytesIO(image_bytes))
+    original_size = image.size
+
+    # JPEG: декодер сразу отдаёт изображение в 1/2, 1/4 или 1/8 масштаба
+    if image.format == 'JPEG' and target_side:
+        image.draft('RGB', (target_side, target_side))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    img_bgr = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+
+    decoded_size = (img_bgr.shape[1], img_bgr.shape[0])
+    info = {
+        'decode_ms': round((time.perf_counter() - started) * 1000, 1),
+        'original_size': original_size,
+        'decoded_size': decoded_size,
+        'scale': round(max(decoded_size) / max(original_size), 4)
+    }
+    return img_bgr, info
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Ранний отказ: лимиты размера запроса и изображения до полного декодирования
+
+Проверки по порядку, от самой дешёвой:
+- тело запроса — по Content-Length до чтения тела, chunked тело — во время
+  чтения (MAX_CONTENT_LENGTH в app.py, BodyLimitMiddleware в app_asgi.py);
+  коллажу (несколько фото) — REQUEST_MAX_BYTES, остальным — одно фото в base64;
+- файл фото — IMAGE_MAX_BYTES;
+- заголовок (Image.open читает только его): формат из IMAGE_FORMATS,
+  не больше 4 каналов, число пикселей.
+
+PNG и WebP декодируются только целиком (память ≈ пиксели × каналы), поэтому
+выше IMAGE_MAX_PIXELS — отказ. JPEG все пути декодируют сразу в уменьшенном
+масштабе (draft: DCT scaling до 1/8), так что огромное фото с камеры
+уменьшается при декодировании, и для JPEG лимит в JPEG_PIXELS_FACTOR раз
+больше. Image.MAX_IMAGE_PIXELS — страховка для путей без check_image:
+PIL сам бросает DecompressionBombError выше двойного лимита JPEG.
+"""
+
+import io
+import os
+
+from PIL import Image, UnidentifiedImageError
+
+from request_images import ImageInputError, ImageTooLargeError, photo_bytes
+
+MB = 1024 * 1024
+
+# Тело запроса /api/create-collage (все фото строк, base64 — на треть больше)
+REQUEST_MAX_BYTES = int(os.environ.get('REQUEST_MAX_BYTES', 100 * MB))
+# Один файл фото
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 25 * MB))
+# Пикселей в форматах без масштабирования при декодировании (50 MP — 8000×6250)
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50_000_000))
+IMAGE_FORMATS = set(os.environ.get('IMAGE_FORMATS', 'JPEG,MPO,PNG,WEBP').upper().split(','))
+
+# Целевые размеры декодирования JPEG (детектор, тайлы, payload Face++) — до ~2000 px,
+# поэтому фото больше 50 MP draft уменьшает минимум вдвое по стороне
+JPEG_PIXELS_FACTOR = 4
+MAX_CHANNELS = 4
+
+# Тело запроса с одним фото: base64 + поля формы
+IMAGE_REQUEST_MAX_BYTES = IMAGE_MAX_BYTES * 4 // 3 + 64 * 1024
+
+# PIL предупреждает выше MAX_IMAGE_PIXELS и отказывает выше двойного значения
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS * JPEG_PIXELS_FACTOR
+
+
+def body_limit(path):
+    """Лимит тела запроса для маршрута (байты)"""
+    if path == '/api/create-collage':
+        return REQUEST_MAX_BYTES
+    return IMAGE_REQUEST_MAX_BYTES
+
+
+def body_too_large(limit):
+    """Текст ответа 413 для тела запроса больше limit"""
+    return f'Request body too large (limit {limit / MB:.0f} MB)'
+
+
+def check_image(image_bytes):
+    """
+    Проверка фото по размеру файла и заголовку, без декодирования пикселей
+
+    Возвращает: dict {'format', 'width', 'height', 'mode'}
+    Бросает: ImageTooLargeError (413) — файл или разрешение больше лимита,
+             ImageInputError (400) — не изображение, формат или каналы
+    """
+    if len(image_bytes) > IMAGE_MAX_BYTES:
+        raise ImageTooLargeError(
+            f'Image too large: {len(image_bytes) / MB:.1f} MB (limit {IMAGE_MAX_BYTES / MB:.0f} MB)'
+        )
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(f'Image too large: {e}')
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise ImageInputError(f'Invalid image: {e}')
+
+    if image.format not in IMAGE_FORMATS:
+        raise ImageInputError(
+            f'Unsupported image format: {image.format} (supported: {", ".join(sorted(IMAGE_FORMATS))})'
+        )
+    if len(image.getbands()) > MAX_CHANNELS:
+        raise ImageInputError(f'Unsupported image mode: {image.mode}')
+
+    width, height = image.size
+    limit = IMAGE_MAX_PIXELS * (JPEG_PIXELS_FACTOR if image.format in ('JPEG', 'MPO') else 1)
+    if not width or not height:
+        raise ImageInputError(f'Invalid image size: {width}x{height}')
+    if width * height > limit:
+        raise ImageTooLargeError(
+            f'Image resolution too large: {width}x{height} '
+            f'({width * height / 1e6:.0f} MP, limit {limit / 1e6:.0f} MP for {image.format})'
+        )
+    return {'format': image.format, 'width': width, 'height': height, 'mode': image.mode}
+
+
+def check_rows(rows):
+    """
+    check_image для фото строк коллажа (до постановки в очередь и рендеринга)
+
+    Отклоняется только слишком большое фото; битое или не-фото остаётся в
+    rows как есть — его пропускает рендеринг тайла, как и раньше. base64
+    фото декодируются здесь один раз и заменяются в rows байтами; фото из
+    photo_store (beforePhotoId) проверены при загрузке.
+    Бросает: ImageTooLargeError с номером строки
+    """
+    for idx, row in enumerate(rows):
+        for side in ('beforePhoto', 'afterPhoto'):
+            value = row.get(side)
+            if not value or getattr(value, 'photo_id', None):
+                continue
+            try:
+                data = photo_bytes(value)
+                check_image(data)
+            except ImageTooLargeError as e:
+                raise ImageTooLargeError(f'Row {idx} {side}: {e}')
+            except ImageInputError:
+                continue
+            row[side] = data
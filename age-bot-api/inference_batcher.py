@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Micro-batching планировщик инференса InsightFace
+
+Параллельные запросы /api/estimate-age ставят изображения в общую очередь.
+Фоновый поток собирает их в окне 5–20 ms (до max_batch штук), прогоняет
+детекцию для каждого изображения, а модель genderage — одним батчем
+по всем найденным лицам, и раздаёт результаты ожидающим запросам.
+
+Для возраста и пола нужны только детектор и genderage, поэтому landmark
+и recognition модели buffalo_l (которые запускает FaceAnalysis.get)
+здесь не выполняются вовсе.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+from insightface.utils import face_align
+
+AGE_BATCH_WINDOW_MS = float(os.environ.get('AGE_BATCH_WINDOW_MS', 10))
+AGE_BATCH_MAX = int(os.environ.get('AGE_BATCH_MAX', 8))
+
+
+class _Job:
+    __slots__ = ('img_bgr', 'future', 'enqueued')
+
+    def __init__(self, img_bgr):
+        self.img_bgr = img_bgr
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class InferenceBatcher:
+    """
+    Очередь инференса с окном сбора и ограничением размера батча
+
+    estimate(img_bgr) блокирует вызывающий поток до получения результата:
+    {'age': int, 'gender': 'Male' | 'Female'} или None, если лицо не найдено.
+    """
+
+    def __init__(self, face_app, window_ms=AGE_BATCH_WINDOW_MS, max_batch=AGE_BATCH_MAX):
+        self.det_model = face_app.det_model
+        self.attr_model = face_app.models['genderage']
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+
+        # Модель с фиксированным batch=1 прогоняем по одному лицу
+        batch_dim = self.attr_model.session.get_inputs()[0].shape[0]
+        self.attr_batching = not isinstance(batch_dim, int) or batch_dim != 1
+
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._max_queue_depth = 0
+        self._jobs = 0
+        self._wait_total = 0.0
+        self._infer_total = 0.0
+
+    def _ensure_worker(self):
+        """
+        Фоновый поток запускается лениво и заново после fork():
+        при preload модели в gunicorn master потоки master в worker не переходят
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                            name='inference-batcher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, img_bgr):
+        """Поставить изображение в очередь, вернуть Future"""
+        self._ensure_worker()
+        job = _Job(img_bgr)
+        self._queue.put(job)
+        depth = self._queue.qsize()
+        with self._lock:
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+        return job.future
+
+    def estimate(self, img_bgr, timeout=None):
+        return self.submit(img_bgr).result(timeout=timeout)
+
+    def warm_up(self, images, rounds):
+        """
+        Прогрев до приёма трафика: изображения через очередь (поток batcher'а,
+        детектор), затем genderage на пустых вырезках всеми размерами батча —
+        на синтетике лиц нет, а каждая новая форма входа ORT выделяет память заново
+        """
+        for _ in range(rounds):
+            for img_bgr in images:
+                self.estimate(img_bgr)
+
+        width, height = self.attr_model.input_size
+        crop = np.zeros((height, width, 3), dtype=np.uint8)
+        for size in range(1, (self.max_batch if self.attr_batching else 1) + 1):
+            self._predict([crop] * size)
+
+    def _run(self, jobs):
+        while True:
+            batch = [jobs.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._process(batch)
+            except Exception as e:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+    def _process(self, batch):
+        started = time.perf_counter()
+        crops = []
+        owners = []
+
+        # Детекция — по изображению (разные размеры входа)
+        for job in batch:
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                bboxes, _ = self.det_model.detect(job.img_bgr, max_num=0, metric='default')
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+
+            if bboxes.shape[0] == 0:
+                job.future.set_result(None)
+                continue
+
+            # Лицо с максимальным score (как faces[0] у FaceAnalysis.get)
+            crops.append(self._align(job.img_bgr, bboxes[0]))
+            owners.append(job)
+
+        # genderage — одним батчем по всем лицам
+        if crops:
+            predictions = self._predict(crops)
+            for job, pred in zip(owners, predictions):
+                gender = 'Male' if int(np.argmax(pred[:2])) == 1 else 'Female'
+                age = int(np.round(pred[2] * 100))
+                job.future.set_result({'age': age, 'gender': gender})
+
+        finished = time.perf_counter()
+        with self._lock:
+            self._batch_sizes[len(batch)] += 1
+            self._jobs += len(batch)
+            self._wait_total += sum(started - job.enqueued for job in batch)
+            self._infer_total += finished - started
+
+    def _align(self, img_bgr, bbox):
+        """Вырезка лица под вход genderage (как в insightface Attribute.get)"""
+        input_size = self.attr_model.input_size[0]
+        width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
+        scale = input_size / (max(width, height) * 1.5)
+        aimg, _ = face_align.transform(img_bgr, center, input_size, scale, 0)
+        return aimg
+
+    def _predict(self, crops):
+        model = self.attr_model
+        mean = (model.input_mean, model.input_mean, model.input_mean)
+        size = tuple(model.input_size)
+
+        if not self.attr_batching:
+            return [
+                model.session.run(model.output_names, {
+                    model.input_name: cv2.dnn.blobFromImage(crop, 1.0 / model.input_std, size, mean, swapRB=True)
+                })[0][0]
+                for crop in crops
+            ]
+
+        blob = cv2.dnn.blobFromImages(crops, 1.0 / model.input_std, size, mean, swapRB=True)
+        return model.session.run(model.output_names, {model.input_name: blob})[0]
+
+    def stats(self):
+        """Глубина очереди и гистограмма размеров батчей для /health"""
+        with self._lock:
+            batches = sum(self._batch_sizes.values())
+            return {
+                'queue_depth': self._queue.qsize() if self._queue else 0,
+                'max_queue_depth': self._max_queue_depth,
+                'window_ms': self.window * 1000,
+                'max_batch': self.max_batch,
+                'batches': batches,
+                'jobs': self._jobs,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'avg_queue_wait_ms': round(self._wait_total / self._jobs * 1000, 2) if self._jobs else None,
+                'avg_batch_ms': round(self._infer_total / batches * 1000, 2) if batches else None
+            }
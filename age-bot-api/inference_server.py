@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Age-bot inference server
+Отдельный процесс, который владеет моделью InsightFace
+
+HTTP workers (gunicorn, AGE_MODEL_MODE=server) не загружают модель сами,
+а отправляют уже декодированное BGR изображение через Unix socket.
+Память под модель расходуется один раз, сколько бы ни было HTTP workers,
+а запросы от всех workers попадают в общую micro-batching очередь.
+
+Протокол (одно постоянное соединение на поток клиента):
+    запрос:  struct '!4sIII' (команда, height, width, channels) + h*w*c байт BGR
+    ответ:   struct '!I' (длина) + JSON
+Команды: b'INFR' — оценка возраста, b'STAT' — статистика сервера.
+
+Запуск:
+    python inference_server.py            # сокет из AGE_INFERENCE_SOCKET
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+from model_loader import AGE_INFERENCE_SOCKET
+from structured_log import get_logger, setup_logging
+
+log = get_logger(__name__)
+
+REQUEST_HEADER = struct.Struct('!4sIII')
+RESPONSE_HEADER = struct.Struct('!I')
+
+CMD_INFER = b'INFR'
+CMD_STATS = b'STAT'
+
+# Защита от мусора в сокете: больше 64 MP изображение не принимаем
+MAX_IMAGE_BYTES = 64 * 1024 * 1024 * 3
+
+
+def _recv_exact(sock, size):
+    """Чтение ровно size байт (None — соединение закрыто)"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        chunk = sock.recv_into(view[received:])
+        if chunk == 0:
+            return None
+        received += chunk
+    return buffer
+
+
+def _send_json(sock, payload):
+    body = json.dumps(payload).encode('utf-8')
+    sock.sendall(RESPONSE_HEADER.pack(len(body)) + body)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        while True:
+            header = _recv_exact(self.request, REQUEST_HEADER.size)
+            if header is None:
+                return
+            command, height, width, channels = REQUEST_HEADER.unpack(header)
+
+            if command == CMD_STATS:
+                _send_json(self.request, server.stats())
+                continue
+
+            size = height * width * channels
+            if command != CMD_INFER or size > MAX_IMAGE_BYTES:
+                _send_json(self.request, {'ok': False, 'error': 'Bad request'})
+                return
+
+            data = _recv_exact(self.request, size)
+            if data is None:
+                return
+
+            img_bgr = np.frombuffer(data, dtype=np.uint8).reshape(height, width, channels)
+            try:
+                face = server.batcher.estimate(img_bgr)
+                _send_json(self.request, {'ok': True, 'face': face})
+            except Exception as e:
+                log.warning('⚠️ Inference failed: %s', e)
+                _send_json(self.request, {'ok': False, 'error': str(e)})
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher, load_seconds):
+        self.batcher = batcher
+        self.load_seconds = load_seconds
+        self.started = time.time()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o660)
+
+    def stats(self):
+        return {
+            'ok': True,
+            'pid': os.getpid(),
+            'uptime_seconds': round(time.time() - self.started),
+            'model_load_seconds': round(self.load_seconds, 2),
+            'batcher': self.batcher.stats()
+        }
+
+
+class InferenceClient:
+    """
+    Клиент inference server для HTTP workers
+
+    Интерфейс совпадает с InferenceBatcher: estimate(img_bgr) и stats().
+    """
+
+    def __init__(self, socket_path=AGE_INFERENCE_SOCKET, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        # Соединение на поток и на процесс (после fork создаём заново)
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None and self._local.pid == os.getpid():
+            return sock
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self._local.sock = sock
+        self._local.pid = os.getpid()
+        return sock
+
+    def _drop_connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def _call(self, header, body=b''):
+        # Одна повторная попытка: сервер мог перезапуститься между запросами
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                sock.sendall(header)
+                if body:
+                    sock.sendall(body)
+                length = _recv_exact(sock, RESPONSE_HEADER.size)
+                if length is None:
+                    raise ConnectionError('Inference server closed connection')
+                payload = _recv_exact(sock, RESPONSE_HEADER.unpack(length)[0])
+                if payload is None:
+                    raise ConnectionError('Inference server closed connection')
+                return json.loads(payload)
+            except OSError:
+                self._drop_connection()
+                if attempt:
+                    raise
+
+    def estimate(self, img_bgr, timeout=None):
+        """{'age': int, 'gender': str} или None, если лицо не найдено"""
+        img_bgr = np.ascontiguousarray(img_bgr, dtype=np.uint8)
+        height, width, channels = img_bgr.shape
+        result = self._call(REQUEST_HEADER.pack(CMD_INFER, height, width, channels), memoryview(img_bgr).cast('B'))
+        if not result.get('ok'):
+            raise RuntimeError(f'Inference server error: {result.get("error")}')
+        return result['face']
+
+    def warm_up(self, images, rounds):
+        """
+        Проверка, что сервер отвечает: он прогревает модель сам до открытия
+        сокета, здесь — соединение и путь запроса worker'а
+        """
+        for img_bgr in images:
+            self.estimate(img_bgr)
+
+    def stats(self):
+        try:
+            return self._call(REQUEST_HEADER.pack(CMD_STATS, 0, 0, 0))
+        except OSError as e:
+            return {'ok': False, 'error': str(e)}
+
+
+def main():
+    from inference_batcher import InferenceBatcher
+    from model_loader import load_face_app, warmup_images, AGE_WARMUP_ROUNDS
+
+    setup_logging()
+    log.info('🔄 Loading InsightFace model for inference server...')
+    face_app, load_seconds = load_face_app()
+    batcher = InferenceBatcher(face_app)
+    log.info('✅ Model loaded in %.1fs', load_seconds)
+
+    # Прогрев до открытия сокета: workers подключаются уже к тёплой модели
+    if AGE_WARMUP_ROUNDS > 0:
+        started = time.perf_counter()
+        batcher.warm_up(warmup_images(), AGE_WARMUP_ROUNDS)
+        log.info('🔥 Model warmed up in %.1fs', time.perf_counter() - started)
+
+    directory = os.path.dirname(AGE_INFERENCE_SOCKET)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    server = InferenceServer(AGE_INFERENCE_SOCKET, batcher, load_seconds)
+    log.info('🚀 Inference server listening on %s', AGE_INFERENCE_SOCKET)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(AGE_INFERENCE_SOCKET):
+            os.unlink(AGE_INFERENCE_SOCKET)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест Age-bot API: папка реальных фото → /api/estimate-age и /api/create-collage
+
+Два режима нагрузки:
+- --concurrency N — N клиентов шлют запросы один за другим (замкнутый цикл,
+  пропускная способность при фиксированном параллелизме);
+- --rate R — R запросов в секунду с пуассоновскими интервалами (открытый
+  цикл, как реальный трафик: медленный сервер не снижает нагрузку).
+
+Фото из --photos (jpg, png, webp) читаются в память заранее; без --photos —
+синтетические 3–12 MP фото bench_collage.py. Каждому фото по умолчанию
+дописываются случайные байты после конца файла (декодеры их игнорируют),
+чтобы запросы не отдавались из кэша результатов (--no-cache-bust — с кэшем).
+
+Отчёт по каждому endpoint: p50/p95/p99 латентности, пропускная способность,
+ошибки по статусам и исключениям; --output — то же в JSON.
+
+Полностью офлайн — вместе с facepp_mock.py:
+    python facepp_mock.py --latency-ms 400 --qps 20 &
+    FACEPP_API_URL=http://127.0.0.1:5100/facepp/v3/detect FACEPP_API_KEY=test \\
+        FACEPP_API_SECRET=test gunicorn -w 4 --threads 4 -b 127.0.0.1:5000 app:app &
+    python load_test.py --url http://127.0.0.1:5000 --concurrency 16 --duration 60
+    python load_test.py --rate 10 --mix estimate-age=9,create-collage=1 --photos ~/photos
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+ENDPOINTS = ('estimate-age', 'create-collage')
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def load_photos(photos_dir):
+    """Байты фото из папки (рекурсивно); без папки — синтетические фото бенчмарка"""
+    if photos_dir is None:
+        from bench_collage import generate_photos
+
+        photos_dir = '/tmp/collage-bench'
+        generate_photos(photos_dir)
+
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(photos_dir)
+        for name in names if name.lower().endswith(PHOTO_EXTENSIONS)
+    )
+    if not paths:
+        raise SystemExit(f'❌ No photos in {photos_dir}')
+    photos = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            photos.append((os.path.basename(path), f.read()))
+    return photos
+
+
+def parse_mix(value):
+    """'estimate-age=9,create-collage=1' → {endpoint: вес}"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'unknown endpoint {name!r} (use {", ".join(ENDPOINTS)})')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+class LoadTest:
+    def __init__(self, args, photos):
+        self.args = args
+        self.photos = photos
+        self.random = random.Random(args.seed)
+        self.next_photo = 0
+        self.endpoints = list(args.mix)
+        self.weights = [args.mix[name] for name in self.endpoints]
+        self.results = {name: {'latencies': [], 'errors': Counter(), 'cached': 0} for name in self.endpoints}
+        self.dropped = 0
+
+    def _photo(self):
+        name, data = self.photos[self.next_photo % len(self.photos)]
+        self.next_photo += 1
+        if self.args.cache_bust:
+            data += self.random.randbytes(16)
+        return name, data
+
+    def _request(self, endpoint):
+        """(url, kwargs для httpx) следующего запроса"""
+        if endpoint == 'estimate-age':
+            name, data = self._photo()
+            return f'{self.args.url}/api/estimate-age', {'files': {'image': (name, data, 'image/jpeg')}}
+
+        files = {}
+        for idx in range(self.args.collage_rows):
+            for side in ('beforePhoto', 'afterPhoto'):
+                name, data = self._photo()
+                files[f'{side}_{idx}'] = (name, data, 'image/jpeg')
+        body = {
+            'rows': [{'photoType': 'front'} for _ in range(self.args.collage_rows)],
+            'userInfo': {'username': 'loadtest@rejuvena.ru', 'realAgeBefore': 42, 'realAgeAfter': 42}
+        }
+        params = {'quality': self.args.collage_quality}
+        if self.args.collage_format != 'json':
+            params['format'] = self.args.collage_format
+        return f'{self.args.url}/api/create-collage', {
+            'params': params, 'data': {'data': json.dumps(body)}, 'files': files
+        }
+
+    async def one(self, client):
+        endpoint = self.random.choices(self.endpoints, self.weights)[0]
+        url, kwargs = self._request(endpoint)
+        result = self.results[endpoint]
+        started = time.perf_counter()
+        try:
+            response = await client.post(url, **kwargs)
+        except httpx.HTTPError as e:
+            result['errors'][type(e).__name__] += 1
+            return
+        elapsed = time.perf_counter() - started
+
+        if response.status_code >= 400:
+            try:
+                message = response.json().get('error') or response.json().get('message') or ''
+            except ValueError:
+                message = ''
+            result['errors'][f'{response.status_code} {message[:60]}'.strip()] += 1
+            return
+        result['latencies'].append(elapsed)
+        if endpoint == 'estimate-age' and response.json().get('cached'):
+            result['cached'] += 1
+
+    def _more(self, deadline, sent):
+        if self.args.requests:
+            return sent < self.args.requests
+        return time.monotonic() < deadline
+
+    async def closed_loop(self, client, deadline):
+        sent = 0
+
+        async def worker():
+            nonlocal sent
+            while self._more(deadline, sent):
+                sent += 1
+                await self.one(client)
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def open_loop(self, client, deadline):
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        sent = 0
+        next_at = loop.time()
+        while self._more(deadline, sent):
+            next_at += self.random.expovariate(self.args.rate)
+            await asyncio.sleep(max(0.0, next_at - loop.time()))
+            sent += 1
+            if len(tasks) >= self.args.max_in_flight:
+                # Сервер не успевает — запрос не отправляется (учитывается в отчёте)
+                self.dropped += 1
+                continue
+            task = asyncio.create_task(self.one(client))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    async def run(self):
+        connections = self.args.concurrency if self.args.rate is None else self.args.max_in_flight
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits) as client:
+            started = time.monotonic()
+            deadline = started + self.args.duration
+            if self.args.rate is None:
+                await self.closed_loop(client, deadline)
+            else:
+                await self.open_loop(client, deadline)
+            return time.monotonic() - started
+
+    def report(self, elapsed):
+        def ms(seconds):
+            return round(seconds * 1000, 1) if seconds is not None else None
+
+        endpoints = {}
+        for name, result in self.results.items():
+            latencies = sorted(result['latencies'])
+            errors = sum(result['errors'].values())
+            total = len(latencies) + errors
+            endpoints[name] = {
+                'requests': total,
+                'ok': len(latencies),
+                'errors': errors,
+                'error_rate': round(errors / total, 4) if total else 0.0,
+                'throughput_rps': round(len(latencies) / elapsed, 2),
+                'latency_ms': {
+                    'p50': ms(percentile(latencies, 50)),
+                    'p95': ms(percentile(latencies, 95)),
+                    'p99': ms(percentile(latencies, 99)),
+                    'max': ms(latencies[-1] if latencies else None)
+                },
+                'error_breakdown': dict(result['errors'].most_common()),
+                'cached': result['cached']
+            }
+        return {
+            'url': self.args.url,
+            'mode': f'concurrency {self.args.concurrency}' if self.args.rate is None else f'rate {self.args.rate}/s',
+            'elapsed_seconds': round(elapsed, 1),
+            'photos': len(self.photos),
+            'dropped': self.dropped,
+            'endpoints': endpoints
+        }
+
+
+def print_report(report):
+    print(f'\n📊 {report["url"]}, {report["mode"]}, {report["elapsed_seconds"]}s, {report["photos"]} photos')
+    print(f'{"endpoint":<16} {"requests":>8} {"ok":>6} {"err %":>6} {"rps":>7} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for name, stats in report['endpoints'].items():
+        latency = stats['latency_ms']
+        print(f'{name:<16} {stats["requests"]:>8} {stats["ok"]:>6} {stats["error_rate"] * 100:>6.1f} '
+              f'{stats["throughput_rps"]:>7} ' + ' '.join(f'{str(latency[k]):>8}' for k in ('p50', 'p95', 'p99', 'max')))
+    for name, stats in report['endpoints'].items():
+        for error, count in stats['error_breakdown'].items():
+            print(f'  ❌ {name}: {error} × {count}')
+        if stats['cached']:
+            print(f'  ⚡ {name}: {stats["cached"]} answered from cache')
+    if report['dropped']:
+        print(f'  ⚠️ {report["dropped"]} requests not sent: --max-in-flight reached')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Age-bot API load test')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='адрес API')
+    parser.add_argument('--photos', help='папка с фото (по умолчанию — синтетические 3–12 MP)')
+    parser.add_argument('--concurrency', type=int, default=8, help='параллельных клиентов (замкнутый цикл)')
+    parser.add_argument('--rate', type=float, help='запросов в секунду (открытый цикл вместо --concurrency)')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='предел одновременных запросов при --rate')
+    parser.add_argument('--duration', type=float, default=30, help='длительность, сек')
+    parser.add_argument('--requests', type=int, help='число запросов вместо --duration')
+    parser.add_argument('--mix', type=parse_mix, default={'estimate-age': 1.0},
+                        help='endpoints с весами: estimate-age=9,create-collage=1')
+    parser.add_argument('--collage-rows', type=int, default=3)
+    parser.add_argument('--collage-format', default='json', choices=('json', 'jpeg', 'webp', 'avif'))
+    parser.add_argument('--collage-quality', default='final', choices=('final', 'preview'))
+    parser.add_argument('--cache-bust', action=argparse.BooleanOptionalAction, default=True,
+                        help='уникальные байты фото, чтобы не попадать в кэш результатов')
+    parser.add_argument('--timeout', type=float, default=60, help='таймаут запроса, сек')
+    parser.add_argument('--seed', type=int, help='seed для выбора endpoints и интервалов')
+    parser.add_argument('--output', help='JSON файл с отчётом')
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+
+    photos = load_photos(args.photos)
+    mode = f'{args.concurrency} clients' if args.rate is None else f'{args.rate} req/s'
+    limit = f'{args.requests} requests' if args.requests else f'{args.duration:.0f}s'
+    print(f'🚀 Load test {args.url}: {mode}, {limit}, mix {args.mix}, {len(photos)} photos')
+
+    test = LoadTest(args, photos)
+    report = test.report(asyncio.run(test.run()))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f'\n💾 Report saved to {args.output}')
+
+    if not any(stats['ok'] for stats in report['endpoints'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Метрики Prometheus для GET /metrics
+
+- agebot_request_duration_seconds{route, method, status} — время запроса
+  (до отправки последнего байта, включая потоковые ответы коллажа)
+- agebot_requests_in_flight{route} — запросы в обработке
+- agebot_stage_duration_seconds{route, stage} — стадии внутри запроса:
+  read (тело запроса, multipart, base64), check (заголовок PIL),
+  payload / facepp (подготовка и запрос к Face++), decode / inference
+  (InsightFace), json и стадии коллажа. Все стадии размечаются одинаково —
+  `with stage(...)` из stage_timings.py; route — маршрут текущего запроса
+  (RequestTimer, contextvars: в пулы потоков передаётся вместе с request_id)
+- agebot_estimates_total{provider, outcome} — ok, no_face, error по
+  провайдерам и fallback (Face++ пропущен, упал или проиграл hedge — ответ
+  даёт InsightFace); ответы из кэша — provider="cache"
+- agebot_model_load_seconds — время загрузки InsightFace
+
+gunicorn workers — отдельные процессы: с PROMETHEUS_MULTIPROC_DIR каждый
+пишет значения в файлы этого каталога, а /metrics любого worker'а
+собирает их все (MultiProcessCollector). Каталог должен быть пустым при
+старте сервиса (RuntimeDirectory в age-bot.service), файлы завершённых
+workers исключаются из in-flight в gunicorn.conf.py (child_exit).
+"""
+
+import contextvars
+import os
+import re
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
+
+import stage_timings
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_DURATION = Histogram(
+    'agebot_request_duration_seconds', 'HTTP request duration',
+    ['route', 'method', 'status'], buckets=REQUEST_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'agebot_requests_in_flight', 'HTTP requests being processed',
+    ['route'], multiprocess_mode='livesum'
+)
+STAGE_DURATION = Histogram(
+    'agebot_stage_duration_seconds', 'Duration of a processing stage within a request',
+    ['route', 'stage'], buckets=STAGE_BUCKETS
+)
+ESTIMATES = Counter(
+    'agebot_estimates_total', 'Age estimation outcomes by provider',
+    ['provider', 'outcome']
+)
+MODEL_LOAD_SECONDS = Gauge(
+    'agebot_model_load_seconds', 'InsightFace model load time',
+    multiprocess_mode='max'
+)
+
+_RULE_PARAM = re.compile(r'<(?:[^:>]+:)?([^>]+)>')
+
+# Маршрут текущего запроса — метка route стадий (вне запроса стадии не пишутся)
+_route = contextvars.ContextVar('metrics_route', default=None)
+
+
+def route_label(rule):
+    """Шаблон маршрута Flask (/api/photos/<photo_id>) в виде Starlette (/api/photos/{photo_id})"""
+    return _RULE_PARAM.sub(r'{\1}', rule)
+
+
+class RequestTimer:
+    """In-flight и длительность одного запроса: создаётся в начале, finish() — после ответа"""
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.finished = False
+        _route.set(route)
+        REQUESTS_IN_FLIGHT.labels(route).inc()
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        REQUESTS_IN_FLIGHT.labels(self.route).dec()
+        REQUEST_DURATION.labels(self.route, self.method, str(status)).observe(
+            time.perf_counter() - self.started
+        )
+
+
+def record_estimate(provider, outcome):
+    ESTIMATES.labels(provider, outcome).inc()
+
+
+def set_model_load_seconds(seconds):
+    MODEL_LOAD_SECONDS.set(seconds)
+
+
+def export_metrics():
+    """(тело, Content-Type) ответа /metrics"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def _observe_stage(name, seconds):
+    route = _route.get()
+    if route is not None:
+        STAGE_DURATION.labels(route, name).observe(seconds)
+
+
+stage_timings.add_observer(_observe_stage)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Загрузка InsightFace buffalo_l для определения возраста
+
+Общий код для app.py (режимы local/preload) и inference_server.py.
+Загружаются только детектор и genderage — landmark и recognition модели
+для возраста не нужны, а recognition (w600k_r50) самая тяжёлая в наборе.
+
+После загрузки — прогрев (Readiness.warm_up): первый run() сессии ONNX
+Runtime инициализирует граф, растит арену памяти и запускает пул потоков,
+и без прогрева эти секунды платит первый запрос каждого worker'а после
+деплоя или HUP. Прогрев гоняет синтетические фото в размерах с телефона
+тем же путём, что и запросы (decode_bgr → очередь инференса), и genderage
+всеми размерами батча. gunicorn worker (и uvicorn после lifespan)
+принимает соединения только после импорта приложения, поэтому трафик
+получают только прогретые workers; состояние — в /health и /ready.
+"""
+
+import io
+import os
+import threading
+import time
+
+import onnxruntime as ort
+from insightface.app import FaceAnalysis
+from PIL import Image, ImageDraw
+
+from image_ingest import decode_bgr, DETECTOR_SIDE
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+# Режим размещения модели:
+#   local   — каждый gunicorn worker загружает свою копию (по умолчанию)
+#   preload — модель загружается в gunicorn master (preload_app),
+#             workers разделяют её страницы памяти copy-on-write
+#   server  — модель живёт в отдельном процессе inference_server.py,
+#             workers отправляют ему изображения через Unix socket
+AGE_MODEL_MODE = os.environ.get('AGE_MODEL_MODE', 'local')
+AGE_INFERENCE_SOCKET = os.environ.get('AGE_INFERENCE_SOCKET', '/run/age-bot/inference.sock')
+
+# Прогонов каждого синтетического фото при прогреве (0 — без прогрева)
+AGE_WARMUP_ROUNDS = int(os.environ.get('AGE_WARMUP_ROUNDS', 2))
+# Пауза между попытками, если прогрев не удался (inference server ещё не запущен)
+AGE_WARMUP_RETRY_SECONDS = float(os.environ.get('AGE_WARMUP_RETRY_SECONDS', 2))
+
+# Фото с телефона: 12 MP портрет и ландшафт, кадр, уменьшенный фронтендом
+WARMUP_SIZES = [(3024, 4032), (4032, 3024), (1080, 1350)]
+
+# Состояния worker'а для /health и /ready
+LOADING = 'loading'
+WARMING = 'warming'
+READY = 'ready'
+FAILED = 'failed'
+
+MODEL_NAME = 'buffalo_l'
+MODEL_MODULES = ['detection', 'genderage']
+PROVIDERS = ['CPUExecutionProvider']
+
+
+def _single_threaded_sessions(face_app):
+    """
+    Пересоздание ONNX Runtime сессий без собственного пула потоков
+
+    Пул потоков ORT не переживает fork(): сессия, созданная в master,
+    зависает в worker при первом run(). Сессия с intra_op_num_threads=1
+    выполняется в вызывающем потоке и после fork работает корректно,
+    а веса модели остаются общими для всех workers (copy-on-write).
+    """
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    for model in face_app.models.values():
+        model.session = ort.InferenceSession(model.model_file, sess_options=options, providers=PROVIDERS)
+
+
+def load_face_app(fork_safe=False):
+    """
+    Загрузка и подготовка FaceAnalysis
+
+    fork_safe — сессии без пула потоков (для загрузки в gunicorn master)
+    Возвращает: (face_app, load_seconds)
+    """
+    started = time.perf_counter()
+    face_app = FaceAnalysis(name=MODEL_NAME, allowed_modules=MODEL_MODULES, providers=PROVIDERS)
+    if fork_safe:
+        _single_threaded_sessions(face_app)
+    face_app.prepare(ctx_id=-1, det_size=(DETECTOR_SIDE, DETECTOR_SIDE))
+    return face_app, time.perf_counter() - started
+
+
+def warmup_images(sizes=WARMUP_SIZES):
+    """Синтетические фото в BGR масштаба детектора — как их готовит decode_bgr для запросов"""
+    images = []
+    for width, height in sizes:
+        img = Image.new('RGB', (width, height), (150, 125, 110))
+        ImageDraw.Draw(img).ellipse(
+            (width // 4, height // 5, width * 3 // 4, height * 4 // 5), fill=(205, 170, 150)
+        )
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        images.append(decode_bgr(buffer.getvalue(), DETECTOR_SIDE)[0])
+    return images
+
+
+class Readiness:
+    """
+    Готовность worker'а принимать запросы: loading → warming → ready
+
+    failed — модель не загрузилась и определить возраст нечем.
+    Если прогрев не удался (inference server ещё не слушает сокет),
+    он повторяется в фоне, а worker остаётся в warming.
+    """
+
+    def __init__(self):
+        self.state = LOADING
+        self.warmup_seconds = None
+        self.error = None
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def set_ready(self):
+        """Модель не нужна (только Face++) — прогревать нечего"""
+        self.state = READY
+
+    def set_failed(self, error):
+        self.state = FAILED
+        self.error = str(error)
+
+    def warm_up(self, estimator, rounds=AGE_WARMUP_ROUNDS):
+        """estimator — InferenceBatcher или InferenceClient (метод warm_up)"""
+        if rounds <= 0:
+            self.state = READY
+            return
+        self.state = WARMING
+        try:
+            self._warm_up(estimator, rounds)
+        except Exception as e:
+            self.error = str(e)
+            log.warning('⚠️ Model warm-up failed: %s, retrying in background', e)
+            threading.Thread(target=self._retry, args=(estimator, rounds),
+                             name='model-warmup', daemon=True).start()
+
+    def _warm_up(self, estimator, rounds):
+        started = time.perf_counter()
+        estimator.warm_up(warmup_images(), rounds)
+        self.warmup_seconds = time.perf_counter() - started
+        self.error = None
+        self.state = READY
+        log.info('🔥 Model warmed up in %.1fs (%d rounds)', self.warmup_seconds, rounds)
+
+    def _retry(self, estimator, rounds):
+        while self.state == WARMING:
+            time.sleep(AGE_WARMUP_RETRY_SECONDS)
+            try:
+                self._warm_up(estimator, rounds)
+            except Exception as e:
+                self.error = str(e)
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'warmup_seconds': round(self.warmup_seconds, 2) if self.warmup_seconds is not None else None,
+            'error': self.error
+        }
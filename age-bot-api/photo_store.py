@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Хранилище загруженных фото (общее для всех workers)
+
+Фото загружается один раз (POST /api/photos) и дальше передаётся по photoId:
+/api/estimate-age принимает {"photoId": "..."}, строки /api/create-collage —
+"beforePhotoId" / "afterPhotoId". Повторные загрузки многомегабайтных фото
+(сначала на оценку возраста, потом в коллаж) и их base64 не нужны.
+
+photoId = content_hash байтов фото — тот же ключ, что у result_cache и
+tile_cache, поэтому тайлы коллажа находятся без чтения файла. Вместе с фото
+хранятся размеры, миниатюра (короткая сторона PHOTO_THUMB_SIZE — из неё
+строятся тайлы ?quality=preview) и результат определения возраста.
+
+Файлы в PHOTO_STORE_DIR:
+    photos.sqlite3          — метаданные и результаты определения
+    <id[:2]>/<id>           — исходные байты фото
+    <id[:2]>/<id>.thumb.jpg — миниатюра
+
+Срок хранения — PHOTO_STORE_TTL с последнего использования, плюс лимит
+размера (LRU). Удаление — purge(): при загрузках не чаще раза в
+PHOTO_STORE_PURGE_INTERVAL и из cleanup.sh:
+    python photo_store.py purge
+"""
+
+import io
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from PIL import Image, UnidentifiedImageError
+
+from image_limits import check_image
+from request_images import ImageInputError
+from result_cache import content_hash
+from structured_log import get_logger, setup_logging
+
+log = get_logger(__name__)
+
+PHOTO_STORE_DIR = os.environ.get('PHOTO_STORE_DIR', '/var/www/uploads/photos')
+# Совпадает со сроком хранения загрузок в cleanup.sh
+PHOTO_STORE_TTL = int(os.environ.get('PHOTO_STORE_TTL', 30 * 24 * 3600))
+PHOTO_STORE_MAX_BYTES = int(os.environ.get('PHOTO_STORE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+PHOTO_STORE_PURGE_INTERVAL = 3600
+# Короткая сторона миниатюры: не меньше COLLAGE_PREVIEW_SIZE
+PHOTO_THUMB_SIZE = int(os.environ.get('PHOTO_THUMB_SIZE', 320))
+PHOTO_THUMB_QUALITY = 85
+
+_PHOTO_ID_LENGTH = 40
+_HEX = set('0123456789abcdef')
+
+
+def valid_photo_id(photo_id):
+    return isinstance(photo_id, str) and len(photo_id) == _PHOTO_ID_LENGTH and set(photo_id) <= _HEX
+
+
+class StoredPhoto:
+    """
+    Ссылка на фото в хранилище — значение beforePhoto / afterPhoto в rows
+
+    Файл читается только при промахе tile_cache; объект переживает pickle
+    (асинхронные задачи коллажа), байты фото при этом не копируются.
+    """
+
+    def __init__(self, photo_id, path, thumbnail_path, thumbnail_side):
+        self.photo_id = photo_id
+        self.path = path
+        self.thumbnail_path = thumbnail_path
+        self.thumbnail_side = thumbnail_side
+
+    def read(self, min_side=None):
+        """Байты фото; с min_side — миниатюра, если её короткой стороны достаточно"""
+        path = self.path
+        if min_side and self.thumbnail_side and self.thumbnail_side >= min_side:
+            path = self.thumbnail_path
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class PhotoStore:
+    """put / get / read / ref (API), set_detection, purge и stats"""
+
+    def __init__(self, directory=PHOTO_STORE_DIR, ttl=PHOTO_STORE_TTL, max_bytes=PHOTO_STORE_MAX_BYTES):
+        self.directory = directory
+        self.path = os.path.join(directory, 'photos.sqlite3')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._last_purge = time.monotonic()
+
+    def _connect(self):
+        # Соединение на поток и на процесс (после fork старое использовать нельзя)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS photos (
+                id TEXT PRIMARY KEY,
+                format TEXT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                thumbnail_side INTEGER,
+                detection TEXT,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS photos_accessed ON photos (accessed)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def file_path(self, photo_id):
+        return os.path.join(self.directory, photo_id[:2], photo_id)
+
+    def thumbnail_path(self, photo_id):
+        return os.path.join(self.directory, photo_id[:2], f'{photo_id}.thumb.jpg')
+
+    def _info(self, row, now):
+        info = dict(row)
+        info['detection'] = json.loads(info['detection']) if info['detection'] else None
+        info['accessed'] = now
+        info['expires'] = now + self.ttl
+        return info
+
+    def put(self, data):
+        """
+        Сохранение фото (повторная загрузка того же фото — только продление срока)
+
+        Возвращает: dict с метаданными (id, format, width, height, size, detection)
+        Бросает: ImageInputError если это не изображение или оно больше лимитов
+        """
+        photo_id = content_hash(data)
+        info = self.get(photo_id)
+        if info is not None:
+            return info
+
+        # Формат и разрешение по заголовку — до построения миниатюры
+        check_image(data)
+
+        try:
+            img = Image.open(io.BytesIO(data))
+            # draft() при построении миниатюры меняет размер — запоминаем исходный
+            image_format, (width, height) = img.format, img.size
+            thumbnail = _make_thumbnail(img)
+        except (UnidentifiedImageError, OSError, SyntaxError) as e:
+            raise ImageInputError(f'Invalid image: {e}')
+
+        os.makedirs(os.path.dirname(self.file_path(photo_id)), exist_ok=True)
+        _write_atomic(self.file_path(photo_id), data)
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format='JPEG', quality=PHOTO_THUMB_QUALITY)
+        _write_atomic(self.thumbnail_path(photo_id), buffer.getvalue())
+
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO photos '
+                '(id, format, width, height, size, thumbnail_side, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (photo_id, image_format, width, height,
+                 len(data) + buffer.tell(), min(thumbnail.size), now, now)
+            )
+        log.info('💾 Photo stored: %s (%s %dx%d, %d bytes)', photo_id[:12], image_format, width, height, len(data))
+
+        if time.monotonic() - self._last_purge > PHOTO_STORE_PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            self.purge()
+        return self.get(photo_id)
+
+    def get(self, photo_id):
+        """Метаданные фото (dict) или None, если не найдено или истекло; продлевает срок"""
+        if not valid_photo_id(photo_id):
+            return None
+        conn = self._connect()
+        row = conn.execute('SELECT * FROM photos WHERE id = ?', (photo_id,)).fetchone()
+        now = time.time()
+        if row is None or now - row['accessed'] > self.ttl or not os.path.exists(self.file_path(photo_id)):
+            return None
+        with conn:
+            conn.execute('UPDATE photos SET accessed = ? WHERE id = ?', (now, photo_id))
+        return self._info(row, now)
+
+    def read(self, photo_id):
+        """Байты фото или None"""
+        if self.get(photo_id) is None:
+            return None
+        return self.read_file(photo_id)
+
+    def read_file(self, photo_id):
+        """Байты фото, уже найденного через get (без повторного запроса в sqlite), или None"""
+        try:
+            with open(self.file_path(photo_id), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def ref(self, photo_id):
+        """StoredPhoto для rows коллажа или None"""
+        info = self.get(photo_id)
+        if info is None:
+            return None
+        return StoredPhoto(photo_id, self.file_path(photo_id), self.thumbnail_path(photo_id),
+                           info['thumbnail_side'])
+
+    def resolve_rows(self, rows):
+        """
+        beforePhotoId / afterPhotoId в строках коллажа → StoredPhoto в beforePhoto / afterPhoto
+
+        Бросает: ImageInputError для неизвестного или истёкшего photoId
+        """
+        for row in rows:
+            for side in ('beforePhoto', 'afterPhoto'):
+                photo_id = row.get(f'{side}Id')
+                if not photo_id:
+                    continue
+                photo = self.ref(photo_id)
+                if photo is None:
+                    raise ImageInputError(f'Unknown or expired photoId: {photo_id}')
+                row[side] = photo
+
+    def set_detection(self, photo_id, result):
+        """Результат определения возраста для фото (отдаётся без повторного инференса)"""
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'UPDATE photos SET detection = ? WHERE id = ?',
+                    (json.dumps(result, ensure_ascii=False), photo_id)
+                )
+        except (sqlite3.Error, OSError) as e:
+            log.warning('⚠️ Photo store write failed: %s', e)
+
+    def _remove(self, photo_id):
+        for path in (self.file_path(photo_id), self.thumbnail_path(photo_id)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def purge(self):
+        """Удаление истёкших фото и LRU вытеснение до 90% лимита; возвращает число удалённых"""
+        conn = self._connect()
+        victims = [row[0] for row in conn.execute(
+            'SELECT id FROM photos WHERE accessed < ?', (time.time() - self.ttl,)
+        )]
+        total = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM photos WHERE accessed >= ?', (time.time() - self.ttl,)
+        ).fetchone()[0]
+        if total > self.max_bytes:
+            target = total - int(self.max_bytes * 0.9)
+            freed = 0
+            for photo_id, size in conn.execute(
+                'SELECT id, size FROM photos WHERE accessed >= ? ORDER BY accessed ASC', (time.time() - self.ttl,)
+            ):
+                victims.append(photo_id)
+                freed += size
+                if freed >= target:
+                    break
+
+        for photo_id in victims:
+            self._remove(photo_id)
+        with conn:
+            conn.executemany('DELETE FROM photos WHERE id = ?', [(photo_id,) for photo_id in victims])
+        if victims:
+            log.info('🧹 Photo store: removed %d photos', len(victims))
+        return len(victims)
+
+    def stats(self):
+        """Число фото и объём для /health"""
+        try:
+            photos, total, detected = self._connect().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(detection) FROM photos'
+            ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            return {'error': str(e)}
+        return {
+            'photos': photos,
+            'with_detection': detected,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl
+        }
+
+
+def _make_thumbnail(img):
+    """Миниатюра с короткой стороной PHOTO_THUMB_SIZE (без поворота по EXIF — как тайлы коллажа)"""
+    if img.format == 'JPEG':
+        img.draft('RGB', (PHOTO_THUMB_SIZE, PHOTO_THUMB_SIZE))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    scale = PHOTO_THUMB_SIZE / min(img.size)
+    if scale < 1:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return img
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['purge']:
+        print('Usage: python photo_store.py purge')
+        sys.exit(2)
+    setup_logging()
+    store = PhotoStore()
+    print(f'🧹 Purging photo store in {store.directory}...')
+    store.purge()
+    print(f'✅ {store.stats()}')
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Подготовка фото для внешних провайдеров (Face++, AWS Rekognition, Google Vision)
+
+Общий этап для всех провайдеров:
+1. Если исходный файл уже укладывается в лимиты провайдера — отправляем как есть,
+   без декодирования и перекодирования.
+2. Иначе уменьшаем (так, чтобы лицо оставалось достаточно крупным)
+   и кодируем JPEG в заданный бюджет по размеру.
+3. Подготовленный payload кэшируется по хэшу изображения.
+"""
+
+import io
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageOps
+
+from result_cache import content_hash
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+# Лимиты провайдера:
+#   max_bytes   — максимальный размер файла
+#   max_side    — максимальная сторона изображения (None — без ограничения)
+#   min_side    — минимальная сторона (меньше — провайдер не найдёт лицо)
+#   target_side — до какой стороны уменьшать при перекодировании
+#   formats     — форматы, которые провайдер принимает без конвертации
+ProviderLimits = namedtuple(
+    'ProviderLimits', ['name', 'max_bytes', 'max_side', 'min_side', 'target_side', 'formats']
+)
+
+# Лицо на селфи занимает заметную часть кадра, поэтому 1600 px по длинной
+# стороне оставляет лицу сотни пикселей — с запасом выше минимумов провайдеров
+PROVIDER_TARGET_SIDE = int(os.environ.get('PROVIDER_TARGET_SIDE', 1600))
+
+# Face++ detect: до 2 MB, от 48x48 до 4096x4096, JPG/PNG
+FACEPP_LIMITS = ProviderLimits(
+    'facepp', 2 * 1024 * 1024, 4096, 48, PROVIDER_TARGET_SIDE, {'JPEG', 'PNG'}
+)
+
+# AWS Rekognition DetectFaces (Bytes): до 5 MB, JPEG/PNG, лицо от 40 px
+REKOGNITION_LIMITS = ProviderLimits(
+    'rekognition', 5 * 1024 * 1024, None, 80, PROVIDER_TARGET_SIDE, {'JPEG', 'PNG'}
+)
+
+# Google Vision: тело JSON запроса до 10 MB, base64 увеличивает фото на треть
+VISION_LIMITS = ProviderLimits(
+    'google_vision', 7 * 1024 * 1024, None, 48, PROVIDER_TARGET_SIDE,
+    {'JPEG', 'PNG', 'GIF', 'BMP', 'WEBP'}
+)
+
+# Качества JPEG, которые перебираются, пока payload не уложится в бюджет
+JPEG_QUALITY_STEPS = (90, 85, 80, 70, 60)
+
+# EXIF тег Orientation
+EXIF_ORIENTATION = 0x0112
+
+PAYLOAD_CACHE_MAX_BYTES = int(os.environ.get('PAYLOAD_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+class PayloadCache:
+    """LRU кэш подготовленных payload в памяти процесса с лимитом по байтам"""
+
+    def __init__(self, max_bytes=PAYLOAD_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            payload = self._items.get(key)
+            if payload is not None:
+                self._items.move_to_end(key)
+            return payload
+
+    def set(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = payload
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+payload_cache = PayloadCache()
+
+
+def _fits(image, image_bytes, limits):
+    """Можно ли отправить исходный файл без изменений"""
+    if image.format not in limits.formats:
+        return False
+    if len(image_bytes) > limits.max_bytes:
+        return False
+    if limits.max_side and max(image.size) > limits.max_side:
+        return False
+    # Повёрнутые по EXIF фото пересохраняем уже в правильной ориентации
+    if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        return False
+    return True
+
+
+def _encode_to_budget(image, limits):
+    """JPEG кодирование с уменьшением качества/размера до укладывания в бюджет"""
+    while True:
+        for quality in JPEG_QUALITY_STEPS:
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality)
+            if buffer.tell() <= limits.max_bytes:
+                return buffer.getvalue(), quality
+
+        # Даже минимальное качество не влезает — уменьшаем ещё на четверть
+        width, height = image.size
+        if min(width, height) * 3 // 4 < limits.min_side:
+            return buffer.getvalue(), quality
+        image = image.resize((width * 3 // 4, height * 3 // 4), Image.Resampling.LANCZOS)
+
+
+def prepare_payload(image_bytes, limits, image_hash=None):
+    """
+    Байты фото, готовые к отправке провайдеру
+
+    image_bytes — исходный файл; image_hash — хэш (если уже посчитан)
+    """
+    key = (image_hash or content_hash(image_bytes), limits.name)
+    cached = payload_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Image.open читает только заголовок — полного декодирования здесь нет
+    image = Image.open(io.BytesIO(image_bytes))
+
+    if _fits(image, image_bytes, limits):
+        log.debug('📤 %s: sending original %s %dx%d, %d bytes',
+                  limits.name, image.format, *image.size, len(image_bytes))
+        payload_cache.set(key, image_bytes)
+        return image_bytes
+
+    target = limits.target_side
+    if limits.max_side:
+        target = min(target, limits.max_side)
+
+    # JPEG: декодируем сразу в уменьшенном масштабе (DCT scaling)
+    if image.format == 'JPEG':
+        image.draft('RGB', (target, target))
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((target, target), Image.Resampling.LANCZOS)
+
+    payload, quality = _encode_to_budget(image, limits)
+    log.debug('📤 %s: re-encoded to %dx%d q%d, %d → %d bytes',
+              limits.name, *image.size, quality, len(image_bytes), len(payload))
+    payload_cache.set(key, payload)
+    return payload
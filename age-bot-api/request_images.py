@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Приём изображений из HTTP запроса
+
+Поддерживаемые форматы тела запроса:
+- multipart/form-data — файл в поле формы (без base64, без JSON)
+- image/jpeg, image/png, ... или application/octet-stream — сырые байты фото
+- application/json — base64 строка (старые клиенты), с data:image prefix или без
+- photoId — ссылка на фото, загруженное в photo_store (POST /api/photos)
+
+Во всех случаях возвращаются байты файла изображения, которые дальше
+открываются через Image.open(io.BytesIO(...)) без лишних копий.
+"""
+
+import base64
+import binascii
+import functools
+import json
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+RAW_IMAGE_MIMETYPES = {'application/octet-stream'}
+
+
+class ImageInputError(ValueError):
+    """Некорректные входные данные (отдаётся клиенту со статусом status)"""
+
+    status = 400
+
+
+class ImageTooLargeError(ImageInputError):
+    """Тело запроса или изображение больше лимита (image_limits.py)"""
+
+    status = 413
+
+
+def _body_limited(func):
+    """Превышение MAX_CONTENT_LENGTH при чтении тела (chunked) → ImageTooLargeError"""
+    @functools.wraps(func)
+    def wrapper(req, *args, **kwargs):
+        try:
+            return func(req, *args, **kwargs)
+        except RequestEntityTooLarge:
+            raise ImageTooLargeError(f'Request body too large (limit {req.max_content_length / (1024 * 1024):.0f} MB)')
+    return wrapper
+
+
+def decode_base64_image(value):
+    """Декодирование base64 строки (data:image/...;base64, prefix допускается)"""
+    comma = value.find(',', 0, 128)
+    if comma != -1:
+        value = value[comma + 1:]
+    try:
+        return base64.b64decode(value)
+    except (binascii.Error, ValueError) as e:
+        raise ImageInputError(f'Invalid base64 image: {e}')
+
+
+def is_multipart(req):
+    return req.mimetype == 'multipart/form-data'
+
+
+def is_raw_image(req):
+    return req.mimetype.startswith('image/') or req.mimetype in RAW_IMAGE_MIMETYPES
+
+
+@_body_limited
+def read_image_bytes(req, field='image'):
+    """
+    Байты изображения из запроса (multipart, сырое тело или JSON base64)
+
+    Бросает: ImageInputError если изображение не передано
+    """
+    if is_multipart(req):
+        storage = req.files.get(field)
+        if storage is None:
+            raise ImageInputError('No image provided')
+        image_bytes = storage.read()
+    elif is_raw_image(req):
+        # Тело читается один раз, без кэширования в request
+        image_bytes = req.get_data(cache=False)
+    else:
+        data = req.get_json(silent=True)
+        if not isinstance(data, dict) or not data.get(field):
+            raise ImageInputError('No image provided')
+        image_bytes = decode_base64_image(data[field])
+
+    if not image_bytes:
+        raise ImageInputError('Empty image')
+    return image_bytes
+
+
+@_body_limited
+def read_photo_id(req):
+    """photoId из JSON тела или поля формы (вместо самого фото) или None"""
+    if is_multipart(req):
+        return req.form.get('photoId')
+    if is_raw_image(req):
+        return None
+    data = req.get_json(silent=True)
+    return data.get('photoId') if isinstance(data, dict) else None
+
+
+def _collage_data(data):
+    """
+    Проверка структуры JSON коллажа: объект, rows — список объектов
+
+    Пустое тело (None) возвращается как есть — 400 'No data provided' в app.
+    Бросает: ImageInputError
+    """
+    if data is None:
+        return None
+    if not isinstance(data, dict):
+        raise ImageInputError('Invalid request body: JSON object expected')
+    rows = data.get('rows')
+    if rows is not None and (not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows)):
+        raise ImageInputError('Invalid "rows": list of objects expected')
+    return data
+
+
+@_body_limited
+def read_collage_request(req):
+    """
+    Данные запроса /api/create-collage
+
+    JSON: {"rows": [{"beforePhoto": "base64", "afterPhoto": "base64", ...}], ...}
+    multipart: поле "data" с тем же JSON (фото в rows можно не передавать)
+               + файлы "beforePhoto_<N>" / "afterPhoto_<N>" для строки N
+
+    Возвращает: dict; фото в rows — bytes (multipart) или base64 строки (JSON)
+    Бросает: ImageInputError если тело не объект или rows не список объектов
+    """
+    if not is_multipart(req):
+        return _collage_data(req.get_json(silent=True))
+
+    try:
+        data = _collage_data(json.loads(req.form.get('data') or '{}')) or {}
+    except ValueError as e:
+        raise ImageInputError(f'Invalid "data" field: {e}')
+
+    for idx, row in enumerate(data.get('rows') or []):
+        for side in ('beforePhoto', 'afterPhoto'):
+            storage = req.files.get(f'{side}_{idx}')
+            if storage is not None:
+                row[side] = storage.read()
+    return data
+
+
+def _mimetype(headers):
+    return headers.get('content-type', '').split(';', 1)[0].strip().lower()
+
+
+async def read_image_bytes_async(req, field='image'):
+    """
+    read_image_bytes для Starlette request (app_asgi.py)
+
+    Бросает: ImageInputError если изображение не передано
+    """
+    mimetype = _mimetype(req.headers)
+    if mimetype == 'multipart/form-data':
+        form = await req.form()
+        upload = form.get(field)
+        if upload is None or isinstance(upload, str):
+            raise ImageInputError('No image provided')
+        image_bytes = await upload.read()
+    elif mimetype.startswith('image/') or mimetype in RAW_IMAGE_MIMETYPES:
+        image_bytes = await req.body()
+    else:
+        try:
+            data = json.loads(await req.body() or b'null')
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not data.get(field):
+            raise ImageInputError('No image provided')
+        image_bytes = decode_base64_image(data[field])
+
+    if not image_bytes:
+        raise ImageInputError('Empty image')
+    return image_bytes
+
+
+async def read_photo_id_async(req):
+    """read_photo_id для Starlette request (app_asgi.py)"""
+    mimetype = _mimetype(req.headers)
+    if mimetype == 'multipart/form-data':
+        photo_id = (await req.form()).get('photoId')
+        return photo_id if isinstance(photo_id, str) else None
+    if mimetype.startswith('image/') or mimetype in RAW_IMAGE_MIMETYPES:
+        return None
+    try:
+        data = json.loads(await req.body() or b'null')
+    except ValueError:
+        return None
+    return data.get('photoId') if isinstance(data, dict) else None
+
+
+async def read_collage_request_async(req):
+    """read_collage_request для Starlette request (app_asgi.py)"""
+    if _mimetype(req.headers) != 'multipart/form-data':
+        try:
+            data = json.loads(await req.body() or b'null')
+        except ValueError:
+            return None
+        return _collage_data(data)
+
+    form = await req.form()
+    try:
+        data = _collage_data(json.loads(form.get('data') or '{}')) or {}
+    except ValueError as e:
+        raise ImageInputError(f'Invalid "data" field: {e}')
+
+    for idx, row in enumerate(data.get('rows') or []):
+        for side in ('beforePhoto', 'afterPhoto'):
+            upload = form.get(f'{side}_{idx}')
+            if upload is not None and not isinstance(upload, str):
+                row[side] = await upload.read()
+    return data
+
+
+def photo_bytes(value):
+    """Байты фото из значения в rows (bytes из multipart или base64 строка)"""
+    if not value:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return value
+    return decode_base64_image(value)
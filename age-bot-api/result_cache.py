@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Age result cache
+Общий для всех gunicorn workers кэш результатов /api/estimate-age
+
+Ключ — хэш декодированных байтов изображения, значение — age/gender.
+Хранилище — локальный sqlite файл (WAL), поэтому кэш общий для всех
+worker-процессов и переживает перезапуск сервиса.
+Вытеснение: TTL + LRU по времени последнего обращения + лимит по памяти.
+
+Попадание в кэш — только чтение sqlite: время обращения обновляется не чаще
+раза в AGE_CACHE_TOUCH_FRACTION от TTL, счётчики hit/miss — в памяти
+процесса. Иначе каждый запрос брал бы единственную блокировку записи WAL
+файла, общую для всех workers и потоков.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+AGE_CACHE_ENABLED = os.environ.get('AGE_CACHE_ENABLED', '1') != '0'
+AGE_CACHE_PATH = os.environ.get('AGE_CACHE_PATH', '/var/www/cache/age-results.sqlite3')
+AGE_CACHE_TTL = int(os.environ.get('AGE_CACHE_TTL', 7 * 24 * 3600))
+AGE_CACHE_MAX_BYTES = int(os.environ.get('AGE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Доля TTL, после которой попадание обновляет время обращения (точность LRU)
+AGE_CACHE_TOUCH_FRACTION = float(os.environ.get('AGE_CACHE_TOUCH_FRACTION', 0.01))
+
+# Накладные расходы sqlite на одну строку (ключ, индексы, служебные поля)
+ROW_OVERHEAD_BYTES = 96
+
+
+def content_hash(data):
+    """Хэш содержимого изображения (hex), используется как ключ кэша"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU + TTL кэш в sqlite файле, разделяемый между процессами
+
+    Любая ошибка sqlite трактуется как промах — кэш никогда не ломает запрос.
+    """
+
+    def __init__(self, path=AGE_CACHE_PATH, ttl=AGE_CACHE_TTL, max_bytes=AGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.touch_interval = ttl * AGE_CACHE_TOUCH_FRACTION
+        self._local = threading.local()
+        # Счётчики этого процесса (/health отдаёт их вместе с pid)
+        self._counters = Counter()
+        self._counters_lock = threading.Lock()
+
+    def _connect(self):
+        # Соединение на поток и на процесс (после fork старое использовать нельзя)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = sqlite3.connect(self.path, timeout=1.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _bump(self, name):
+        with self._counters_lock:
+            self._counters[name] += 1
+
+    def get(self, key):
+        """Результат из кэша (dict) или None"""
+        try:
+            conn = self._connect()
+            now = time.time()
+            row = conn.execute(
+                'SELECT value, created, accessed FROM results WHERE key = ?', (key,)
+            ).fetchone()
+
+            # Истёкшие строки удаляет set(), промах обходится без записи
+            if row is None or now - row[1] > self.ttl:
+                self._bump('misses')
+                return None
+
+            self._bump('hits')
+            if now - row[2] > self.touch_interval:
+                with conn:
+                    conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+            return json.loads(row[0])
+        except (sqlite3.Error, OSError) as e:
+            log.warning('⚠️ Result cache read failed: %s', e)
+            return None
+
+    def set(self, key, value):
+        """Сохранение результата с вытеснением по TTL и лимиту памяти"""
+        try:
+            conn = self._connect()
+            now = time.time()
+            encoded = json.dumps(value, ensure_ascii=False)
+            size = len(key) + len(encoded) + ROW_OVERHEAD_BYTES
+
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO results (key, value, size, created, accessed) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, encoded, size, now, now)
+                )
+                conn.execute('DELETE FROM results WHERE created < ?', (now - self.ttl,))
+                self._evict(conn)
+        except (sqlite3.Error, OSError) as e:
+            log.warning('⚠️ Result cache write failed: %s', e)
+
+    def _evict(self, conn):
+        """LRU вытеснение, пока суммарный размер превышает лимит"""
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Освобождаем с запасом 10%, чтобы не вытеснять на каждой записи
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for key, size in conn.execute('SELECT key, size FROM results ORDER BY accessed ASC'):
+            victims.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany('DELETE FROM results WHERE key = ?', victims)
+        self._bump('evictions')
+
+    def stats(self):
+        """Счётчики hit/miss этого процесса и размер кэша (общий) для /health"""
+        with self._counters_lock:
+            counters = dict(self._counters)
+        try:
+            conn = self._connect()
+            entries, total = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results'
+            ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            return {'error': str(e)}
+
+        hits = counters.get('hits', 0)
+        misses = counters.get('misses', 0)
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 3) if lookups else None,
+            'evictions': counters.get('evictions', 0),
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes
+        }
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Время стадий обработки запроса (для bench_collage.py и metrics.py)
+
+Код размечает стадии через `with stage('decode'):` — и коллаж, и
+estimate-age. Внутри `with collect() as timings:` время стадий суммируется
+в timings ({стадия: секунды}) из всех потоков — стадии тайлов, идущие
+параллельно в пуле коллажа, дают сумму по потокам, а не wall time. Кроме
+того, каждый замер передаётся observers (add_observer) — так metrics.py
+строит гистограммы стадий по маршруту запроса. Без сборщика и observers
+stage() стоит один вызов perf_counter.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_collector = None
+_observers = []
+
+
+@contextmanager
+def stage(name):
+    collector = _collector
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if collector is not None or _observers:
+            elapsed = time.perf_counter() - started
+            if collector is not None:
+                with _lock:
+                    collector[name] = collector.get(name, 0.0) + elapsed
+            for observer in _observers:
+                observer(name, elapsed)
+
+
+@contextmanager
+def collect():
+    """Включить сбор на время блока (один сборщик на процесс)"""
+    global _collector
+    timings = {}
+    _collector = timings
+    try:
+        yield timings
+    finally:
+        _collector = None
+
+
+def add_observer(observer):
+    """observer(name, seconds) вызывается после каждой стадии"""
+    _observers.append(observer)
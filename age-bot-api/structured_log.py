@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Логирование: JSON записи через фоновый поток вместо print()
+
+Модули берут логгер через get_logger(__name__). Запись ниже уровня запроса
+отбрасывается до создания LogRecord, запись в потоке запроса — только
+LogRecord (без поиска файла и строки вызова) и put в очередь:
+форматирование сообщения, JSON и запись в stdout (journald) выполняет
+QueueListener в отдельном потоке, поэтому медленный stdout не тормозит
+обработку запросов. Аргументы сообщения форматируются позже — передавайте
+значения, которые после вызова не меняются.
+
+У каждого запроса (start_request) свои:
+- request_id — correlation id из X-Request-ID или новый, попадает в каждую
+  запись и в заголовок ответа;
+- уровень — LOG_LEVEL, но с вероятностью LOG_DEBUG_SAMPLE_RATE (и по
+  заголовку X-Debug-Log) весь запрос логируется с DEBUG.
+
+Контекст запроса — contextvars: в пулы потоков задачи передаются через
+contextvars.copy_context().run, иначе записи из них будут без request_id.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO').upper())
+# Доля запросов, логируемых целиком с DEBUG
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.01))
+# Значение X-Debug-Log, включающее DEBUG для запроса (пусто — достаточно "1")
+LOG_DEBUG_TOKEN = os.environ.get('LOG_DEBUG_TOKEN', '')
+# json (journald, сборщики логов) или text (локальная разработка)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+_request_level = contextvars.ContextVar('request_level', default=LOG_LEVEL)
+
+# Стандартные поля LogRecord — всё остальное пришло через extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'request_id'}
+
+
+class _RequestFilter(logging.Filter):
+    """request_id текущего запроса (выполняется в потоке, который пишет запись)"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get() or '-'
+        return True
+
+
+class RequestLogger(logging.LoggerAdapter):
+    """Логгер, уровень которого определяет текущий запрос, а не настройка логгера"""
+
+    def isEnabledFor(self, level):
+        return level >= _request_level.get() and not self.logger.disabled
+
+    def log(self, level, msg, *args, exc_info=None, extra=None, **kwargs):
+        if not self.isEnabledFor(level):
+            return
+        if exc_info:
+            if isinstance(exc_info, BaseException):
+                exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+            elif not isinstance(exc_info, tuple):
+                exc_info = sys.exc_info()
+        # findCaller (обход стека) — основная цена logging; файл и строка в JSON не нужны
+        self.logger.handle(self.logger.makeRecord(
+            self.logger.name, level, '(unknown file)', 0, msg, args, exc_info, extra=extra
+        ))
+
+
+def get_logger(name):
+    """Логгер модуля"""
+    return RequestLogger(logging.getLogger(name))
+
+
+def start_request(request_id=None, debug=None):
+    """
+    Контекст запроса: correlation id и уровень логирования
+
+    request_id — значение X-Request-ID клиента или балансировщика (если
+    корректное), debug — значение X-Debug-Log. Возвращает request_id.
+    """
+    if not request_id or not _REQUEST_ID.match(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    debug_requested = bool(debug) and debug == (LOG_DEBUG_TOKEN or '1')
+    sampled = LOG_DEBUG_SAMPLE_RATE > 0 and random.random() < LOG_DEBUG_SAMPLE_RATE
+    _request_id.set(request_id)
+    _request_level.set(logging.DEBUG if debug_requested or sampled else LOG_LEVEL)
+    return request_id
+
+
+def debug_enabled():
+    """DEBUG включён для текущего запроса (для дорогих сообщений)"""
+    return _request_level.get() <= logging.DEBUG
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, сообщение, request_id, extra"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName
+        }
+        request_id = getattr(record, 'request_id', '-')
+        if request_id != '-':
+            entry['request_id'] = request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в потоке запроса; после fork запускает свой listener"""
+
+    def __init__(self, handler):
+        super().__init__(queue.SimpleQueue())
+        self.handler = handler
+        self.listener = None
+        self.pid = None
+        self._lock_start = threading.Lock()
+
+    def start(self):
+        with self._lock_start:
+            if self.pid == os.getpid():
+                return
+            # Поток listener'а родителя после fork не существует — новый со своей очередью
+            self.queue = queue.SimpleQueue()
+            self.listener = QueueListener(self.queue, self.handler)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+
+    def handle(self, record):
+        # Очередь потокобезопасна — блокировка handler'а не нужна
+        if not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def prepare(self, record):
+        # Форматирование (getMessage, traceback) — в потоке listener'а
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super().emit(record)
+
+
+_queue_handler = None
+
+
+def setup_logging(stream=None):
+    """Корневой логгер → очередь → поток записи в stdout (повторный вызов ничего не делает)"""
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if LOG_FORMAT == 'text':
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(message)s'))
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    _queue_handler = _DeferredQueueHandler(handler)
+    _queue_handler.addFilter(_RequestFilter())
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    # Сторонние библиотеки (httpx, insightface) — только LOG_LEVEL и выше
+    root.setLevel(LOG_LEVEL)
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Дописать очередь (при завершении процесса)"""
+    if _queue_handler is not None:
+        _queue_handler.stop()
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
-"""Тест Age-bot API с реальным изображением"""
+"""Тест Age-bot API с реальным изображением
+
+    python test_api.py [http://127.0.0.1:5000]
+"""
 
 import base64
+import os
+import sys
 import requests
 from PIL import Image
 import io
 
+BASE_URL = (sys.argv[1] if len(sys.argv) > 1 else os.environ.get('AGE_BOT_URL', 'http://127.0.0.1:5000')).rstrip('/')
+
 # Создаём простое тестовое изображение лица 112x112
 img = Image.new('RGB', (112, 112), color=(128, 128, 128))
 buffer = io.BytesIO()
@@ -13,7 +20,7 @@ img.save(buffer, format='JPEG')
 img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
 
 # Отправляем запрос
-url = 'http://37.252.20.170:5000/api/estimate-age'
+url = f'{BASE_URL}/api/estimate-age'
 response = requests.post(url, json={'image': img_base64})
 
 print('Status Code:', response.status_code)
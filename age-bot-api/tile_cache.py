@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Дисковый кэш готовых тайлов коллажа (800x800, общий для всех workers)
+
+Пользователь перегенерирует коллаж много раз, меняя поля анкеты или одно
+фото. Тайл (фото после обрезки и ресайза) кэшируется по хэшу байтов фото
+и параметрам обрезки, так что при правке анкеты фото не декодируются
+заново — коллаж собирается из готовых тайлов и только перекодируется.
+
+Тайлы хранятся несжатыми PPM файлами (запись и чтение ~1 ms) в
+COLLAGE_TILE_CACHE_DIR. Время последнего использования — mtime файла:
+по нему работает LRU вытеснение при превышении лимита размера и
+cleanup.sh (find -mtime в /var/www/cache).
+"""
+
+import os
+import threading
+import time
+
+from PIL import Image
+
+from structured_log import get_logger
+
+log = get_logger(__name__)
+
+COLLAGE_TILE_CACHE_ENABLED = os.environ.get('COLLAGE_TILE_CACHE_ENABLED', '1') not in ('0', 'false', 'no', '')
+COLLAGE_TILE_CACHE_DIR = os.environ.get('COLLAGE_TILE_CACHE_DIR', '/var/www/cache/collage-tiles')
+COLLAGE_TILE_CACHE_MAX_BYTES = int(os.environ.get('COLLAGE_TILE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Совпадает со сроком хранения кэша в cleanup.sh
+COLLAGE_TILE_CACHE_TTL = int(os.environ.get('COLLAGE_TILE_CACHE_TTL', 30 * 24 * 3600))
+
+TILE_SUFFIX = '.ppm'
+
+
+class TileCache:
+    """
+    Кэш тайлов в директории: get(key) -> PIL Image или None, set(key, image)
+
+    Ошибки файловой системы не ломают рендеринг — кэш просто пропускается.
+    """
+
+    def __init__(self, directory=COLLAGE_TILE_CACHE_DIR,
+                 max_bytes=COLLAGE_TILE_CACHE_MAX_BYTES,
+                 ttl=COLLAGE_TILE_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evicted = 0
+        # Оценка размера директории (точный пересчёт — при вытеснении)
+        self._size = None
+
+    def _path(self, key):
+        # Подкаталог по первым символам ключа — без десятков тысяч файлов в одной директории
+        return os.path.join(self.directory, key[:2], key + TILE_SUFFIX)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.unlink(path)
+                raise FileNotFoundError(path)
+            with Image.open(path) as img:
+                img.load()
+            # mtime = время последнего использования (LRU)
+            os.utime(path)
+        except (OSError, SyntaxError):
+            with self._lock:
+                self._misses += 1
+            return None
+
+        with self._lock:
+            self._hits += 1
+        return img
+
+    def set(self, key, image):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.save(tmp_path, format='PPM')
+            size = os.path.getsize(tmp_path)
+            # Атомарная замена: другой worker не прочитает недописанный файл
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning('⚠️ Tile cache write failed: %s', e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._writes += 1
+            if self._size is not None:
+                self._size += size
+            over_limit = self._size is None or self._size > self.max_bytes
+        if over_limit:
+            self._evict()
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(TILE_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        """Удаление просроченных тайлов и LRU вытеснение до 90% лимита"""
+        entries = sorted(self._scan())
+        total = sum(size for _, size, _ in entries)
+        expire_before = time.time() - self.ttl
+        target = self.max_bytes * 0.9 if total > self.max_bytes else self.max_bytes
+        evicted = 0
+        for mtime, size, path in entries:
+            if mtime >= expire_before and total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._size = total
+            self._evicted += evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'writes': self._writes,
+                'evicted': self._evicted,
+                'size_bytes': self._size,
+                'max_bytes': self.max_bytes
+            }
+
+
+tile_cache = TileCache() if COLLAGE_TILE_CACHE_ENABLED else None